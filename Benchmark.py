@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+from urllib.parse import unquote
+
+import CairnProcessor as CP
+import FoxmlWorker as FW
+import PathResolver as PR
+import PidIndex as PI
+import RelsExtHarvester as RH
+import SyntheticFedora as SF
+
+STAGES = ('startup', 'pid_enumeration', 'path_resolution', 'foxml_parse', 'rels_harvest', 'mods_to_dc', 'mods_to_dc_cached',
+          'sqlite_load', 'traversal', 'saf_zip', 'saf_zip_pipeline', 'saf_directory')
+# Interpreter launches timed by the startup stage: the imports a spawned pool worker or a quick query pays for,
+# and the CLI itself.
+STARTUP_COMMANDS = (['-c', 'import CairnProcessor'],
+                    ['-c', 'import CairnUtilities'],
+                    ['-c', 'import FedoraData'],
+                    ['-c', 'import main'],
+                    ['CairnCli.py', '--help'])
+
+
+# Offline throughput benchmarks over a synthetic Fedora tree (see SyntheticFedora).
+# Each stage is run several times and its best run is reported as items/sec and MB/sec, so results can be saved
+# and compared against an earlier baseline to catch regressions.
+class Benchmark:
+    def __init__(self, root, namespace='bench', repeat=3, hash_pattern='##'):
+        self.root = Path(root)
+        self.namespace = namespace
+        self.table = namespace
+        self.repeat = repeat
+        self.cp = CP.CairnProcessor()
+        self.cp.objectStore = str(self.root / 'objectStore')
+        self.cp.datastreamStore = str(self.root / 'datastreamStore')
+        self.cp.mods_xsl = str(Path(__file__).with_name('assets') / 'xsl' / 'mods_to_dc.xsl')
+        self.cp.export_dir = str(self.root / 'outputs')
+        self.cp.hash_pattern = hash_pattern
+        # Transforms are measured without the result cache, except in mods_to_dc_cached.
+        self.cp.transform_cache_path = None
+        self.cp.ca.use_hash_pattern(hash_pattern)
+        self.ca = self.cp.ca
+        self.ca.objectStore = self.cp.objectStore
+        self.ca.datastreamStore = self.cp.datastreamStore
+        self.root_pid = f"{namespace}:root"
+        self.results = {}
+        self.pids = []
+        self.foxml_paths = []
+
+    # Runs a stage repeatedly and keeps the fastest run. The stage returns (items, bytes) processed.
+    def measure(self, name, stage):
+        best = None
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                items, size = stage()
+            seconds = time.perf_counter() - start
+            if best is None or seconds < best[0]:
+                best = (seconds, items, size)
+        seconds, items, size = best
+        self.results[name] = {'items': items,
+                              'bytes': size,
+                              'seconds': round(seconds, 4),
+                              'items_per_sec': round(items / seconds, 1) if seconds else 0.0,
+                              'mb_per_sec': round(size / 1024 ** 2 / seconds, 2) if seconds else 0.0}
+        return self.results[name]
+
+    def run(self, stages=STAGES):
+        for name in stages:
+            result = self.measure(name, getattr(self, name))
+            print(f"{name:<20}{result['items']:>10}{result['seconds']:>10.3f}{result['items_per_sec']:>12.1f}"
+                  f"{result['mb_per_sec']:>10.2f}")
+        return self.results
+
+    # Launches a fresh interpreter for each startup command.
+    def startup(self):
+        for command in STARTUP_COMMANDS:
+            subprocess.run([sys.executable, *command], cwd=Path(__file__).parent, check=True,
+                           stdout=subprocess.DEVNULL)
+        return len(STARTUP_COMMANDS), 0
+
+    def pid_enumeration(self):
+        index = PI.PidIndex(self.cp.objectStore, str(self.root / 'benchmark_index.db'), self.cp.hash_pattern)
+        index.refresh(full=True)
+        self.pids = index.get_pids(self.namespace)
+        size = index.conn.execute("SELECT SUM(size) FROM objectstore_index WHERE namespace = ?",
+                                  (self.namespace,)).fetchone()[0]
+        index.conn.close()
+        return len(self.pids), size or 0
+
+    # Resolves every FOXML and managed datastream location with a cold resolver.
+    def path_resolution(self):
+        if not self.pids:
+            self.pid_enumeration()
+        identifiers = list(self.pids)
+        for path in (path for path in Path(self.cp.datastreamStore).rglob('*') if path.is_file()):
+            identifiers.append(unquote(path.name).replace('info:fedora/', '').replace('/', '+'))
+        PR.PathResolver(self.ca.resolver.pattern).resolve_many(identifiers)
+        return len(identifiers), 0
+
+    def foxml_files(self):
+        if not self.foxml_paths:
+            if not self.pids:
+                self.pid_enumeration()
+            self.foxml_paths = [self.cp.resolve_foxml(pid) for pid in self.pids]
+        return self.foxml_paths
+
+    def foxml_parse(self):
+        size = 0
+        for path in self.foxml_files():
+            FW.FWorker(path)
+            size += os.path.getsize(path)
+        return len(self.foxml_paths), size
+
+    # Harvests RELS-EXT of every object into a CSV with the sharded parallel harvester.
+    def rels_harvest(self):
+        if not self.pids:
+            self.pid_enumeration()
+        harvester = RH.RelsExtHarvester(self.cp.objectStore, self.ca.rels_map, resolver=self.ca.resolver)
+        harvester.run(self.pids, str(self.root / 'harvest.csv'))
+        return len(self.pids), sum(os.path.getsize(path) for path in self.foxml_files())
+
+    def mods_to_dc(self):
+        count = size = 0
+        for pid, path in zip(self.pids, self.foxml_files()):
+            files_info = FW.FWorker(path).get_file_data()
+            if 'MODS' not in files_info:
+                continue
+            mods_path = f"{self.cp.datastreamStore}/{self.ca.dereference(files_info['MODS']['filename'])}"
+            self.cp.apply_transform(mods_path, pid)
+            count += 1
+            size += os.path.getsize(mods_path)
+        return count, size
+
+    # Repeated runs of this stage are served from the transform result cache.
+    def mods_to_dc_cached(self):
+        self.cp.transform_cache_path = str(self.root / 'transform_cache.db')
+        try:
+            return self.mods_to_dc()
+        finally:
+            self.cp.transform_cache.close()
+            self.cp.transform_cache_path = None
+            self.cp.transform_cache = None
+
+    def sqlite_load(self):
+        csv_file = self.root / f"{self.namespace}.csv"
+        self.ca.process_clean_institution(self.table, str(csv_file))
+        count = self.ca.conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        return count, csv_file.stat().st_size
+
+    def traversal(self):
+        self.ca.graphs.pop(self.table, None)
+        members = self.ca.get_collection_recursive_pid_model_map(self.table, self.root_pid)
+        count = len(members)
+        for pid, model in members.items():
+            if model == 'islandora:bookCModel':
+                count += len(self.ca.get_pages(self.table, pid))
+        return count, 0
+
+    def package(self, output, engine='process'):
+        shutil.rmtree(self.cp.export_dir, ignore_errors=True)
+        self.cp.engine = engine
+        self.cp.process_collection(self.table, self.root_pid, 'y', output=output)
+        count = len(self.ca.get_collection_recursive_pid_model_map(self.table, self.root_pid))
+        size = sum(path.stat().st_size for path in Path(self.cp.export_dir).rglob('*') if path.is_file())
+        return count, size
+
+    def saf_zip(self):
+        return self.package('zip')
+
+    def saf_zip_pipeline(self):
+        return self.package('zip', 'pipeline')
+
+    def saf_directory(self):
+        return self.package('directory')
+
+
+# Lists stages whose items/sec fell more than tolerance below the baseline.
+def regressions(results, baseline, tolerance):
+    slower = {}
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous and result['items_per_sec'] < previous['items_per_sec'] * (1 - tolerance):
+            slower[name] = (previous['items_per_sec'], result['items_per_sec'])
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the migration tools against a synthetic Fedora tree.')
+    parser.add_argument('root', help='Directory holding (or to hold) the synthetic objectStore and datastreamStore')
+    parser.add_argument('--build', action='store_true', help='Rebuild the synthetic tree first')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--collections', type=int, default=4)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--items', type=int, default=50, help='Items per leaf collection')
+    parser.add_argument('--books', type=int, default=2, help='Books per leaf collection')
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--file-size', type=int, default=64 * 1024)
+    parser.add_argument('--hash-pattern', default='##')
+    parser.add_argument('--save', help='Write results to this JSON file')
+    parser.add_argument('--baseline', help='Compare with results saved by an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed items/sec drop against the baseline')
+    args = parser.parse_args()
+    root = os.path.abspath(args.root)
+    save = os.path.abspath(args.save) if args.save else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    if args.build:
+        shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(root, exist_ok=True)
+    # CairnUtilities keeps its database in the working directory.
+    os.chdir(root)
+    if not os.path.isdir('objectStore'):
+        generator = SF.SyntheticFedora(root, seed=args.seed, file_size=args.file_size,
+                                       hash_pattern=args.hash_pattern)
+        generator.build(args.collections, args.depth, args.items, args.books, args.pages)
+        print(f"Built {generator.counts['objects']} objects, {generator.counts['bytes'] / 1024 ** 2:.1f} MB "
+              f"of datastreams")
+    benchmark = Benchmark(root, repeat=args.repeat, hash_pattern=args.hash_pattern)
+    if any(stage in args.stages for stage in ('traversal', 'saf_zip', 'saf_zip_pipeline', 'saf_directory')) \
+            and 'sqlite_load' not in args.stages:
+        benchmark.sqlite_load()
+    print(f"{'stage':<20}{'items':>10}{'seconds':>10}{'items/sec':>12}{'MB/sec':>10}")
+    results = benchmark.run(args.stages)
+    if save:
+        with open(save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if baseline:
+        with open(baseline) as f:
+            slower = regressions(results, json.load(f), args.tolerance)
+        for name, (before, after) in slower.items():
+            print(f"REGRESSION {name}: {before} -> {after} items/sec")
+        sys.exit(1 if slower else 0)
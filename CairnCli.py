@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+
+import SafWriter as SW
+
+
+# Command line entry point for the migration tools:
+#   export collection TABLE COLLECTION, export books TABLE COLLECTION, plan TABLE COLLECTION..., harvest NAMESPACE,
+#   census, ocr
+# Only argparse and SafWriter are imported up front. Each command imports the modules it needs (and so lxml,
+# the process pool machinery, ...) when it runs, so --help and quick commands start without loading them.
+
+def export_collection(args):
+    import CairnProcessor as CPM
+    CP = CPM.CairnProcessor()
+    CP.materialize = args.materialize
+    CP.engine = args.engine
+    CP.metrics_path = args.metrics
+    CP.hash_pattern = args.hash_pattern
+    if args.no_transform_cache:
+        CP.transform_cache_path = None
+    CP.fixity = not args.no_fixity
+    CP.verify_links = args.verify_links
+    CP.ca.use_hash_pattern(args.hash_pattern)
+    CP.profile = args.profile
+    CP.profile_memory = args.profile_memory
+    CP.profile_path = args.profile_out
+    for setting in filter(None, args.stage_workers.split(',')):
+        stage, count = setting.split('=')
+        CP.stage_workers[stage.strip()] = int(count)
+    shard_bytes = int(args.shard_gb * 1024 ** 3)
+    if args.delta:
+        CP.process_collection_delta(args.table, args.collection, args.transform, args.workers, args.output)
+    else:
+        CP.process_collection(args.table, args.collection, args.transform, args.workers, args.output, args.resume,
+                              args.checkpoint, args.shard_items, shard_bytes)
+
+
+def export_books(args):
+    import CairnProcessor as CPM
+    CP = CPM.CairnProcessor()
+    CP.materialize = args.materialize
+    CP.fixity = not args.no_fixity
+    CP.verify_links = args.verify_links
+    CP.ca.use_hash_pattern(args.hash_pattern)
+    CP.build_book_collection(args.table, args.collection)
+
+
+def plan(args):
+    import json
+    import CairnProcessor as CPM
+    CP = CPM.CairnProcessor()
+    CP.ca.use_hash_pattern(args.hash_pattern)
+    plans = CP.plan_collections(args.table, args.collections, args.workers, args.metrics)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(plans, f, indent=2)
+
+
+def harvest(args):
+    import CairnUtilities as CAM
+    CA = CAM.CairnUtilities()
+    CA.use_hash_pattern(args.hash_pattern)
+    if args.object_store:
+        CA.objectStore = args.object_store
+    if args.refresh_index:
+        CA.get_pid_index().refresh()
+    CA.build_record_from_pids(args.namespace, args.output, args.table, args.workers, args.shard_size)
+
+
+def census(args):
+    import PidIndex as PIM
+    PI = PIM.PidIndex(args.object_store, args.database, args.hash_pattern)
+    print(f"{'namespace':<20}{'objects':>10}{'active':>10}{'inactive':>10}{'unreadable':>12}{'managed GB':>14}")
+    for namespace, counts in PI.census(args.workers, args.refresh).items():
+        print(f"{namespace:<20}{counts['objects']:>10}{counts['active']:>10}{counts['inactive']:>10}"
+              f"{counts['unreadable']:>12}{(counts['managed_bytes'] or 0) / 1024 ** 3:>14.2f}")
+
+
+def ocr(args):
+    import CairnProcessor as CPM
+    CP = CPM.CairnProcessor()
+    CP.ca.use_hash_pattern(args.hash_pattern)
+    CP.get_nscc_ocr()
+
+
+def add_collection_export_arguments(parser):
+    parser.add_argument('table')
+    parser.add_argument('collection')
+    parser.add_argument('--transform', choices=['y', 'n'], default='y', help='Transform DC from MODS')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--output', choices=['zip', 'directory'], default='zip', help='Package format')
+    parser.add_argument('--resume', action='store_true', help='Skip items completed by an earlier run')
+    parser.add_argument('--checkpoint', type=int, default=None,
+                        help='Close the zip and record progress every N items (writes numbered parts, default 500; '
+                             '0 writes one zip, recorded only when it closes)')
+    parser.add_argument('--shard-items', type=int, default=0,
+                        help='Split the package into self-contained SAF shards of at most N items, built in parallel')
+    parser.add_argument('--shard-gb', type=float, default=0,
+                        help='Split the package into self-contained SAF shards of at most this many GB')
+    parser.add_argument('--delta', action='store_true',
+                        help='Export only items changed since the last export, plus a deletion manifest')
+    parser.add_argument('--materialize', choices=SW.MATERIALIZE_STRATEGIES, default='copy',
+                        help='How datastreams are placed into directory packages')
+    parser.add_argument('--engine', choices=['process', 'pipeline'], default='process',
+                        help='Run whole items in worker processes, or overlap item stages in threads')
+    parser.add_argument('--stage-workers', default='',
+                        help='Threads per pipeline stage, e.g. extract=4,transform=4,copy=2')
+    parser.add_argument('--hash-pattern', default='##', help="Fedora hash path pattern, e.g. '##' or '##/##'")
+    parser.add_argument('--no-transform-cache', action='store_true',
+                        help='Run the MODS transform for every item instead of reusing cached results')
+    parser.add_argument('--no-fixity', action='store_true',
+                        help='Copy datastreams without checking them against their FOXML digests')
+    parser.add_argument('--verify-links', action='store_true',
+                        help='Also check datastreams placed without copying (hardlink, reflink, copy_file_range), '
+                             'which reads every byte of them')
+    parser.add_argument('--metrics', help='Append per-item and per-stage metrics to this JSONL file')
+    parser.add_argument('--profile', metavar='run|PID',
+                        help='Profile the whole run, or one item (exported first, in this process), with cProfile')
+    parser.add_argument('--profile-memory', action='store_true', help='Trace allocations with tracemalloc too')
+    parser.add_argument('--profile-out', help='Save cProfile stats to this file')
+    parser.set_defaults(command=export_collection)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Fedora 3 to DSpace migration tools.')
+    commands = parser.add_subparsers(required=True, metavar='command')
+
+    export = commands.add_parser('export', help='Export DSpace Simple Archive Format packages')
+    packages = export.add_subparsers(required=True, metavar='package')
+    add_collection_export_arguments(packages.add_parser('collection', help='Export every item of a collection'))
+    books = packages.add_parser('books', help='Export the books of a collection as page zips')
+    books.add_argument('table')
+    books.add_argument('collection')
+    books.add_argument('--materialize', choices=SW.MATERIALIZE_STRATEGIES, default='copy')
+    books.add_argument('--hash-pattern', default='##')
+    books.add_argument('--no-fixity', action='store_true')
+    books.add_argument('--verify-links', action='store_true')
+    books.set_defaults(command=export_books)
+
+    dry_run = commands.add_parser('plan', help='Dry run collection exports: sizes, missing objects, runtime estimate')
+    dry_run.add_argument('table')
+    dry_run.add_argument('collections', nargs='+', metavar='collection')
+    dry_run.add_argument('--workers', type=int, default=None)
+    dry_run.add_argument('--metrics', help='Metrics file of an earlier export, to estimate runtime from')
+    dry_run.add_argument('--json', help='Also write the plans to this JSON file')
+    dry_run.add_argument('--hash-pattern', default='##')
+    dry_run.set_defaults(command=plan)
+
+    rels = commands.add_parser('harvest', help='Harvest RELS-EXT of active objects into a CSV and/or table')
+    rels.add_argument('namespace')
+    rels.add_argument('--output', help='Write the harvest to this CSV file')
+    rels.add_argument('--table', help='Load the harvest straight into this institution table')
+    rels.add_argument('--workers', type=int, default=None)
+    rels.add_argument('--shard-size', type=int, default=5000, help='Objects per worker shard')
+    rels.add_argument('--object-store', help='objectStore to harvest instead of the configured one')
+    rels.add_argument('--hash-pattern', default='##')
+    rels.add_argument('--refresh-index', action='store_true',
+                      help='Re-scan changed hash directories before listing PIDs from the objectStore index')
+    rels.set_defaults(command=harvest)
+
+    counts = commands.add_parser('census', help='Count objects and managed bytes per namespace')
+    counts.add_argument('--object-store', default='/usr/local/fedora/data/objectStore')
+    counts.add_argument('--database', default='cairn.db')
+    counts.add_argument('--workers', type=int, default=None)
+    counts.add_argument('--hash-pattern', default='##')
+    counts.add_argument('--refresh', action='store_true', help='Re-scan changed hash directories first')
+    counts.set_defaults(command=census)
+
+    pages = commands.add_parser('ocr', help='Zip the page OCR of the NSCC yearbooks')
+    pages.add_argument('--hash-pattern', default='##')
+    pages.set_defaults(command=ocr)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == harvest and not (args.output or args.table):
+        sys.exit('harvest needs --output, --table or both')
+    args.command(args)
+
+
+if __name__ == '__main__':
+    main()
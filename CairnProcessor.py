@@ -1,14 +1,27 @@
 #!/usr/bin/env python3
 
+import hashlib
+import os
 import re
-import shutil
+import sys
 import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from contextlib import nullcontext
+from multiprocessing import util
 from pathlib import Path
 
 import lxml.etree as ET
 
 import CairnUtilities as CA
+import ExportJournal as EJ
+import ExportMetrics as EM
+import ExportPipeline as EP
+import ExportPlanner as EX
 import FoxmlWorker as FW
+import SafWriter as SW
+import TransformCache as TC
+import XsltRegistry as XR
 
 
 class CairnProcessor:
@@ -29,6 +42,33 @@ class CairnProcessor:
         self.ca = CA.CairnUtilities()
         self.mods_xsl = '/usr/local/fedora/cairn_migration/assets/islandora-dspace/xsl-transforms/udm_research_mods_to_dc.xsl'
         self.export_dir = '/usr/local/fedora/cairn_migration/outputs'
+        # How datastreams are placed into unzipped packages: copy, copy_file_range, reflink or hardlink.
+        self.materialize = 'copy'
+        # Export engine: 'process' runs whole items in a process pool, 'pipeline' overlaps the stages of
+        # many items in threads, with the thread count of each stage set in stage_workers.
+        self.engine = 'process'
+        self.stage_workers = {'resolve': 1, 'extract': 4, 'transform': 4, 'copy': 2}
+        # Most items either engine has in flight at once.
+        self.pipeline_window = 32
+        # Per-item metrics are appended to metrics_path as JSONL when it is set. profile is 'run' to profile the
+        # whole export, or a PID to profile just that item, with tracemalloc as well when profile_memory is set.
+        self.metrics = EM.ExportMetrics()
+        self.metrics_path = None
+        self.profile = None
+        self.profile_path = None
+        self.profile_memory = False
+        # Fedora hash path pattern of the objectStore and datastreamStore.
+        self.hash_pattern = '##'
+        # On-disk cache of MODS transform results; set transform_cache_path to None to always run the XSLT.
+        self.transform_cache_path = 'transform_cache.db'
+        self.transform_cache_size = 256 * 1024 ** 2
+        self.transform_cache = None
+        # Datastreams are hashed as they are copied, checked against their FOXML contentDigest and listed in a
+        # fixity manifest beside the package; a mismatch stops the export.
+        self.fixity = True
+        # Datastreams placed by hardlink, reflink or copy_file_range never pass through this process, so checking
+        # them means reading every byte of the source; they are checked only when verify_links is set.
+        self.verify_links = False
         self.mimemap = {"image/jpeg": ".jpg",
                         "image/jp2": ".jp2",
                         "image/png": ".png",
@@ -45,6 +85,8 @@ class CairnProcessor:
                         "video/x-m4v": ".m4v",
                         "audio/vnd.wave": '.wav'
                         }
+        # XSLT cache (hits, misses) last reported by each pool worker process, keyed by process id.
+        self.worker_xslt = {}
         self.start = time.time()
 
     def selector(self):
@@ -64,29 +106,328 @@ class CairnProcessor:
         except:
             print(f"No results found for {pid}")
 
-    def process_collection(self, table, collection, transform_mods):
-        collection_map = self.ca.get_collection_recursive_pid_model_map(table, collection)
-        print(f"Processing {len(collection_map)} pids.")
-        # Build collection directory
+    # shard_items and shard_bytes split the package into shards of at most that many items or bytes, written
+    # concurrently by the worker pool (see export_sharded); checkpoint and the pipeline engine do not apply then.
+    # Without a checkpoint interval, zip output is closed every EJ.ZIP_CHECKPOINT items, as its items are only
+    # recorded (and skipped on resume) once their archive is closed.
+    def process_collection(self, table, collection, transform_mods, workers=1, output='zip', resume=False,
+                           checkpoint=None, shard_items=0, shard_bytes=0):
+        if checkpoint is None:
+            checkpoint = EJ.ZIP_CHECKPOINT if output == 'zip' else 0
+        self.metrics = EM.ExportMetrics(self.metrics_path)
+        self.worker_xslt = {}
+        self.ca.preload_resolved_paths()
         archive = collection.replace(':', '_')
         archive_path = f"{self.export_dir}/{archive}"
-        Path(archive_path).mkdir(parents=True, exist_ok=True)
-        current_number = 1
-        # Process each PID in collectipn
+        Path(self.export_dir).mkdir(parents=True, exist_ok=True)
+        with self.metrics.timer('db_query'):
+            journal = EJ.ExportJournal(self.ca.conn)
+            if not resume:
+                journal.reset(collection)
+        # Members are streamed from indexed queries on the institution table and numbered as they are read, so
+        # the first item is exported straight away and the table is never loaded whole. Numbers are kept in the
+        # journal, so parallel, serial and resumed runs produce the same layout.
+        # Their queries run lazily as items are consumed, and are timed there.
+        members = self.ca.iter_collection_members(table, collection, self.metrics)
+        items = ((pid, model, str(number).zfill(4))
+                 for pid, model, number in journal.number(collection, members, self.metrics))
+        if shard_items or shard_bytes:
+            print(f"Writing {output} shards of {archive}")
+            package = EJ.ShardedPackage(journal, collection, output, archive_path, shard_items, shard_bytes)
+            failures = self.export_sharded(table, items, transform_mods, package, workers)
+        else:
+            print(f"Writing {output} package {archive}")
+            with EJ.CheckpointedPackage(journal, collection, output, archive_path, self.materialize,
+                                        checkpoint, self.verify_links) as package:
+                failures = self.export_items(table, items, transform_mods, package, workers)
+        if journal.counts['skipped']:
+            print(f"Skipped {journal.counts['skipped']} items completed by an earlier run.")
+        self.report(journal.counts['items'], failures)
+        self.ca.save_resolved_paths()
+        return failures
+
+    # Exports only items that are new or changed since the last export of the collection, plus a manifest
+    # of items that have left it, as a separate delta package.
+    # An item is unchanged when its FOXML mtime matches the journal, or when its lastModifiedDate does.
+    def process_collection_delta(self, table, collection, transform_mods, workers=1, output='zip'):
+        self.metrics = EM.ExportMetrics(self.metrics_path)
+        self.worker_xslt = {}
+        try:
+            return self.export_delta(table, collection, transform_mods, workers, output)
+        finally:
+            self.metrics.close()
+
+    def export_delta(self, table, collection, transform_mods, workers, output):
+        self.ca.preload_resolved_paths()
+        with self.metrics.timer('db_query'):
+            collection_map = self.ca.get_collection_recursive_pid_model_map(table, collection)
+            journal = EJ.ExportJournal(self.ca.conn)
+            stamps = journal.stamps(collection)
+        changed = {}
+        touched = {}
+        paths = self.ca.resolver.resolve_many(collection_map)
         for pid, model in collection_map.items():
-            item_number = str(current_number).zfill(4)
-            foxml_file = self.ca.dereference(pid)
-            book_info = {}
-            copy_streams = {}
-            metadata = {}
-            foxml = f"{self.objectStore}/{foxml_file}"
+            stamp = stamps.get(pid)
+            foxml = f"{self.objectStore}/{paths[pid]}"
+            if stamp:
+                try:
+                    mtime = Path(foxml).stat().st_mtime_ns
+                    if mtime == stamp[1]:
+                        continue
+                    if stamp[0] and FW.read_properties(foxml).get('lastModifiedDate') == stamp[0]:
+                        touched[pid] = mtime
+                        continue
+                except Exception:
+                    pass
+            changed[pid] = model
+        journal.touch(collection, touched)
+        deleted = [pid for pid in stamps if pid not in collection_map]
+        if not changed and not deleted:
+            print(f"No changes to {collection} since the last export.")
+            return {}
+        with self.metrics.timer('db_query'):
+            numbers = journal.assign(collection, changed)
+        items = [(pid, model, str(numbers[pid]).zfill(4)) for pid, model in changed.items()]
+        print(f"Processing {len(items)} new or changed pids, {len(deleted)} deleted.")
+        archive = f"{collection.replace(':', '_')}_delta_{time.strftime('%Y%m%d%H%M%S')}"
+        print(f"Writing {output} delta package {archive}")
+        archive_path = f"{self.export_dir}/{archive}"
+        Path(self.export_dir).mkdir(parents=True, exist_ok=True)
+        with EJ.CheckpointedPackage(journal, collection, output, archive_path, self.materialize,
+                                    verify_links=self.verify_links) as package:
+            failures = self.export_items(table, items, transform_mods, package, workers)
+            if deleted:
+                manifest = ''.join(f"item_{str(numbers[pid]).zfill(4)}\t{pid}\n" for pid in deleted)
+                package.writer().write_text('deleted_items', manifest)
+        journal.mark_deleted(collection, deleted)
+        self.report(len(items), failures)
+        self.ca.save_resolved_paths()
+        return failures
+
+    # Plans and writes items into a package, collecting failures per PID.
+    def export_items(self, table, items, transform_mods, package, workers=1):
+        failures = {}
+        if self.profile and self.profile != 'run':
+            # The profiled item is exported first, serially in this process, so the profile sees all of it.
+            items = list(items)
+            target = [entry for entry in items if entry[0] == self.profile]
+            items = [entry for entry in items if entry[0] != self.profile]
+            with EM.profiled(self.profile, self.profile_path, self.profile_memory):
+                self.export_serial(table, target, transform_mods, package, failures)
+        profile = EM.profiled('run', self.profile_path, self.profile_memory) if self.profile == 'run' else nullcontext()
+        with profile:
+            if self.engine == 'pipeline':
+                self.export_items_pipelined(table, items, transform_mods, package, failures)
+            elif workers > 1:
+                self.export_pooled(table, items, transform_mods, package, workers, failures)
+            else:
+                self.export_serial(table, items, transform_mods, package, failures)
+        return failures
+
+    def export_serial(self, table, items, transform_mods, package, failures):
+        for pid, model, item_number in items:
             try:
-                fw = FW.FWorker(foxml)
-            except:
-                print(f"No record found for {pid}")
-                continue
-            dublin_core = None
-            files_info = fw.get_file_data()
+                plan = self.plan_item(table, pid, model, item_number, transform_mods)
+                print(self.write_item(package.writer(), plan))
+                self.finish_item(package, plan)
+            except Exception as e:
+                self.fail_item(package, failures, pid, e)
+
+    def export_pooled(self, table, items, transform_mods, package, workers, failures):
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(self.worker_settings(),)) as executor:
+            # Directory packages are written by the workers themselves; zip packages are planned
+            # in the workers and streamed into the archive here, in item order.
+            # Submission runs at most pipeline_window items ahead of the oldest unfinished one.
+            def collect(pid, future):
+                try:
+                    plan = self.worker_result(future)
+                    if package.output != 'directory':
+                        self.write_item(package.writer(), plan)
+                    self.finish_item(package, plan)
+                    print(plan['item'])
+                except Exception as e:
+                    self.fail_item(package, failures, pid, e)
+
+            futures = deque()
+            for pid, model, item_number in items:
+                if package.output == 'directory':
+                    future = executor.submit(export_item_worker, table, pid, model, item_number,
+                                             transform_mods, package.archive_path)
+                else:
+                    future = executor.submit(plan_item_worker, table, pid, model, item_number,
+                                             transform_mods)
+                futures.append((pid, future))
+                if len(futures) >= max(self.pipeline_window, workers):
+                    collect(*futures.popleft())
+            while futures:
+                collect(*futures.popleft())
+
+    # Exports items through a thread pipeline: FOXML path resolution -> FOXML extraction -> metadata transform
+    # -> datastream copy -> journal record, so parsing, XSLT and file copies of different items overlap.
+    # Zip packages are written on this thread in item order; directory packages are copied by the copy stage.
+    def export_items_pipelined(self, table, items, transform_mods, package, failures):
+        writer = package.writer()
+
+        def resolve(work):
+            with EM.timed(work['timings'], 'resolve'):
+                work['foxml'] = self.resolve_foxml(work['pid'])
+
+        def extract(work):
+            with EM.timed(work['timings'], 'foxml_parse'):
+                work['fw'] = self.read_foxml(work['pid'], work['foxml'])
+
+        def transform(work):
+            work['plan'] = self.plan_from_foxml(work.pop('fw'), work['foxml'], table, work['pid'], work['model'],
+                                                work['item_number'], transform_mods, work['timings'])
+
+        def copy(work):
+            self.write_item(writer, work['plan'])
+
+        stages = [EP.Stage('resolve', resolve, self.stage_workers.get('resolve', 1)),
+                  EP.Stage('extract', extract, self.stage_workers.get('extract', 1)),
+                  EP.Stage('transform', transform, self.stage_workers.get('transform', 1))]
+        if package.output == 'directory':
+            stages.append(EP.Stage('copy', copy, self.stage_workers.get('copy', 1)))
+        work_items = ({'pid': pid, 'model': model, 'item_number': item_number, 'timings': {}}
+                      for pid, model, item_number in items)
+        for work in EP.Pipeline(stages, self.pipeline_window).run(work_items):
+            pid = work['pid']
+            try:
+                if 'error' in work:
+                    raise work['error']
+                if package.output != 'directory':
+                    self.write_item(package.writer(), work['plan'])
+                self.finish_item(package, work['plan'])
+                print(work['plan']['item'])
+            except Exception as e:
+                self.fail_item(package, failures, pid, e)
+
+    # Plans items in a process pool and hands each full shard of the package to a worker of the same pool, so
+    # shards are written concurrently while later items are still being planned. Planning runs at most
+    # pipeline_window items ahead, and at most workers shards are written at once.
+    def export_sharded(self, table, items, transform_mods, package, workers):
+        failures = {}
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(self.worker_settings(),)) as executor:
+            shards = {}
+
+            def collect_shards(done):
+                for future in done:
+                    archive = shards.pop(future)
+                    written, errors = future.result()
+                    package.record(archive, written)
+                    for plan in written:
+                        self.metrics.item_done(plan)
+                    print(f"Wrote {archive} with {len(written)} items")
+                    for pid, error in errors:
+                        self.fail_item(package, failures, pid, error)
+
+            def submit(shard):
+                if shard is None:
+                    return
+                archive, plans = shard
+                shards[executor.submit(write_shard_worker, package.path(archive), package.output, plans)] = archive
+                if len(shards) >= workers:
+                    collect_shards(wait(list(shards), return_when=FIRST_COMPLETED)[0])
+
+            def collect(pid, future):
+                try:
+                    plan = self.worker_result(future)
+                except Exception as e:
+                    self.fail_item(package, failures, pid, e)
+                    return
+                submit(package.add(plan))
+
+            futures = deque()
+            for pid, model, item_number in items:
+                futures.append((pid, executor.submit(plan_item_worker, table, pid, model, item_number,
+                                                     transform_mods)))
+                if len(futures) >= max(self.pipeline_window, workers):
+                    collect(*futures.popleft())
+            while futures:
+                collect(*futures.popleft())
+            submit(package.cut())
+            collect_shards(as_completed(list(shards)))
+        return failures
+
+    # Records a written item in the journal and the run metrics.
+    def finish_item(self, package, plan):
+        with EM.timed(plan.setdefault('timings', {}), 'journal'):
+            package.record(plan)
+        self.metrics.item_done(plan)
+
+    def fail_item(self, package, failures, pid, error):
+        failures[pid] = repr(error)
+        package.fail(pid, repr(error))
+        self.metrics.item_failed(pid, error)
+        if isinstance(error, SW.FixityError):
+            raise error
+
+    # Gets the plan a pool worker returned, keeping the XSLT cache counts it reported.
+    def worker_result(self, future):
+        plan = future.result()
+        process, hits, misses = plan.pop('worker_xslt')
+        self.worker_xslt[process] = (hits, misses)
+        return plan
+
+    # XSLT cache counts of this process and of every pool worker that reported.
+    def xslt_stats(self):
+        stats = XR.registry.stats()
+        return (stats['hits'] + sum(hits for hits, misses in self.worker_xslt.values()),
+                stats['misses'] + sum(misses for hits, misses in self.worker_xslt.values()))
+
+    def report(self, count, failures):
+        print(f"Processed {count - len(failures)} entries in {round(time.time() - self.start, 2)} seconds")
+        hits, misses = self.xslt_stats()
+        print(f"XSLT cache: {hits} hits, {misses} misses")
+        if self.transform_cache is not None:
+            self.transform_cache.flush()
+            stats = self.transform_cache.stats()
+            print(f"Transform result cache: {stats['hits']} hits, {stats['misses']} misses")
+        self.metrics.report()
+        self.metrics.close()
+        for pid, error in failures.items():
+            print(f"Failed {pid}: {error}")
+
+    # Settings copied into pool workers so they mirror this processor's configuration.
+    def worker_settings(self):
+        return {'objectStore': self.objectStore,
+                'datastreamStore': self.datastreamStore,
+                'mods_xsl': self.mods_xsl,
+                'export_dir': self.export_dir,
+                'materialize': self.materialize,
+                'hash_pattern': self.hash_pattern,
+                'transform_cache_path': self.transform_cache_path,
+                'transform_cache_size': self.transform_cache_size,
+                'fixity': self.fixity,
+                'verify_links': self.verify_links}
+
+    # Works out everything needed to write a SAF item: metadata files, datastreams to copy and any book.
+    # Datastream sources are checked here so a missing file fails the item before anything is written.
+    def plan_item(self, table, pid, model, item_number, transform_mods):
+        timings = {}
+        with EM.timed(timings, 'resolve'):
+            foxml = self.resolve_foxml(pid)
+        with EM.timed(timings, 'foxml_parse'):
+            fw = self.read_foxml(pid, foxml)
+        return self.plan_from_foxml(fw, foxml, table, pid, model, item_number, transform_mods, timings)
+
+    def resolve_foxml(self, pid):
+        return f"{self.objectStore}/{self.ca.dereference(pid)}"
+
+    def read_foxml(self, pid, foxml):
+        try:
+            return FW.FWorker(foxml)
+        except Exception as e:
+            raise LookupError(f"No record found for {pid}") from e
+
+    def plan_from_foxml(self, fw, foxml, table, pid, model, item_number, transform_mods, timings=None):
+        timings = {} if timings is None else timings
+        files_info = fw.get_file_data()
+        foxml_mtime = Path(foxml).stat().st_mtime_ns
+        metadata = {}
+        with EM.timed(timings, 'transform'):
             if transform_mods == 'y' and 'MODS' in files_info:
                 mods_path = f"{self.datastreamStore}/{self.ca.dereference(files_info['MODS']['filename'])}"
                 metadata = self.apply_transform(mods_path, pid)
@@ -96,107 +437,128 @@ class CairnProcessor:
                     metadata = self.apply_transform(mods_string, pid)
 
             if 'dublin_core' not in metadata:
-                dublin_core = fw.get_modified_dc()
-            all_files = fw.get_file_data()
-            for entry, file_data in all_files.items():
-                if model in self.stream_map and entry in self.stream_map[model]:
-                    filename = f"{pid.replace(':', '_')}_{entry}{self.mimemap[file_data['mimetype']]}"
-                    copy_streams[
-                        file_data[
-                            'filename']] = filename
-            if model == 'islandora:bookCModel':
-                book_info = self.build_book(table, pid)
-            path = f"{archive_path}/item_{item_number}"
-            # Build directory
-            Path(path).mkdir(parents=True, exist_ok=True)
-            with open(f'{path}/dublin_core.xml', 'w') as f:
-                f.write(metadata['dublin_core'])
-            if 'thesis' in metadata:
-                with open(f'{path}/metadata_thesis.xml', 'w') as f:
-                    f.write(metadata['thesis'])
-            if 'oaire' in metadata:
-                with open(f'{path}/metadata_oaire.xml', 'w') as f:
-                    f.write(metadata['oaire'])
-            with open(f'{path}/contents', 'w') as f:
-                for source, destination in copy_streams.items():
-                    stream_to_copy = self.ca.dereference(source)
-                    shutil.copy(f"{self.datastreamStore}/{stream_to_copy}", f"{path}/{destination}")
-                    f.write(f"{destination}\n")
-                if book_info:
-                    destination = Path(book_info['file']).name
-                    shutil.copy(book_info['file'], f"{path}/{destination}")
-                    f.write(f"{destination}\n")
-            print(f"item_{item_number}")
-            current_number += 1
-        print(f"Zipping files into {archive}.zip")
-        shutil.make_archive(f"{self.export_dir}/{archive}", 'zip', f"{self.export_dir}/{archive}")
-        shutil.rmtree(f"{self.export_dir}/{archive}")
-        print(f"Processed {int(current_number)} entries in {round(time.time() - self.start, 2)} seconds")
+                metadata['dublin_core'] = fw.get_modified_dc()
+        streams = []
+        for entry, file_data in files_info.items():
+            if model in self.stream_map and entry in self.stream_map[model]:
+                filename = f"{pid.replace(':', '_')}_{entry}{self.mimemap[file_data['mimetype']]}"
+                streams.append(self.stream_source(file_data, filename))
+        books = []
+        if model == 'islandora:bookCModel':
+            with EM.timed(timings, 'db_query'):
+                pages = self.ca.get_pages(table, pid)
+            with EM.timed(timings, 'book_plan'):
+                books.append(self.plan_book(table, pid, pages))
+        return {'pid': pid,
+                'item': f"item_{item_number}",
+                'metadata': self.metadata_files(metadata),
+                'streams': streams,
+                'books': books,
+                'last_modified': fw.properties.get('lastModifiedDate'),
+                'foxml_mtime': foxml_mtime,
+                'timings': timings}
+
+    # Resolves a datastream to its file in the datastreamStore.
+    # Returns (source, destination, fixity), where fixity is the FOXML (digest type, digest) to check while
+    # copying, or None when fixity checking is off.
+    def stream_source(self, file_data, destination):
+        location = file_data['filename']
+        source = f"{self.datastreamStore}/{self.ca.dereference(location)}"
+        if not Path(source).is_file():
+            raise FileNotFoundError(f"Missing datastream {location} at {source}")
+        fixity = (file_data.get('digest_type'), file_data.get('digest')) if self.fixity else None
+        return source, destination, fixity
+
+    def metadata_files(self, metadata):
+        files = {'dublin_core.xml': metadata['dublin_core']}
+        if 'thesis' in metadata:
+            files['metadata_thesis.xml'] = metadata['thesis']
+        if 'oaire' in metadata:
+            files['metadata_oaire.xml'] = metadata['oaire']
+        return files
+
+    # Writes a planned item into a SAF package, streaming each datastream and book zip in a single pass.
+    # The time taken is added to the plan's timings as 'zip' or 'copy', the datastream bytes as 'bytes', and
+    # (path, digest type, checksum, size) of each checked datastream as 'fixity'.
+    def write_item(self, writer, plan):
+        path = plan['item']
+        stage = 'zip' if isinstance(writer, SW.SafZipWriter) else 'copy'
+        size = 0
+        fixity = []
+        with EM.timed(plan.setdefault('timings', {}), stage):
+            writer.write_directory(path)
+            for filename, text in plan['metadata'].items():
+                writer.write_text(f"{path}/{filename}", text)
+            contents = []
+            for source, destination, expected in plan['streams']:
+                written, checksum = writer.write_file(f"{path}/{destination}", source, expected)
+                if checksum:
+                    fixity.append((f"{path}/{destination}", *checksum, written))
+                size += written
+                contents.append(destination)
+            for book in plan['books']:
+                size += self.write_book(writer, f"{path}/{book['name']}", book, fixity)
+                contents.append(book['name'])
+            writer.write_text(f"{path}/contents", ''.join(f"{destination}\n" for destination in contents))
+        plan['bytes'] = size
+        plan['fixity'] = fixity
+        return path
+
+    # Builds a single SAF item for a PID.
+    def export_item(self, writer, table, pid, model, item_number, transform_mods):
+        return self.write_item(writer, self.plan_item(table, pid, model, item_number, transform_mods))
 
     #  Function for NS Audio.  Metadata is drawn at collection level, Assets come from members.
 
-    def nscad_artists(self, collection_pid, start_num):
+    def nscad_artists(self, collection_pid, start_num, resume=False):
         archive = collection_pid.replace(':', '_')
         archive_path = f"{self.export_dir}/{archive}"
-        Path(archive_path).mkdir(parents=True, exist_ok=True)
         first_level = self.ca.get_subcollections('nscad', collection_pid)
         print(f"Processing {len(first_level)} members of collection")
-        current_number = start_num
-        for pid in first_level:
-            metadata = {}
-            try:
+        journal = EJ.ExportJournal(self.ca.conn)
+        if not resume:
+            journal.reset(collection_pid)
+        numbers = journal.assign(collection_pid, first_level)
+        completed = journal.completed(collection_pid)
+        with EJ.CheckpointedPackage(journal, collection_pid, 'directory', archive_path, self.materialize,
+                                    verify_links=self.verify_links) as package:
+            for pid in first_level:
+                if pid in completed:
+                    continue
+                metadata = {}
                 fw = self.get_foxml_from_pid(pid)
-            except:
-                print(f"No record found for {pid}")
-                continue
-            dublin_core = None
-            files_info = fw.get_file_data()
-            if 'MODS' in files_info:
-                mods_path = f"{self.datastreamStore}/{self.ca.dereference(files_info['MODS']['filename'])}"
-                metadata = self.apply_transform(mods_path, pid)
-            else:
-                mods_string = fw.get_inline_mods()
-                if mods_string:
-                    metadata = self.apply_transform(mods_string, pid)
-            current_number += 1
-            item_number = str(current_number).zfill(4)
-            copy_streams = {}
-            second_level = self.ca.get_collection_recursive_pid_model_map('nscad', pid)
-            for member_pid, model in second_level.items():
-                book_info = {}
-                fworker = self.get_foxml_from_pid(member_pid)
-                if model == 'islandora:bookCModel':
-                    book_info = self.build_book('nscad', member_pid)
+                if fw is None:
+                    print(f"No record found for {pid}")
+                    package.fail(pid, 'No record found')
+                    continue
+                files_info = fw.get_file_data()
+                if 'MODS' in files_info:
+                    mods_path = f"{self.datastreamStore}/{self.ca.dereference(files_info['MODS']['filename'])}"
+                    metadata = self.apply_transform(mods_path, pid)
                 else:
-                    file_data = fworker.get_file_data()
+                    mods_string = fw.get_inline_mods()
+                    if mods_string:
+                        metadata = self.apply_transform(mods_string, pid)
+                item_number = str(start_num + numbers[pid]).zfill(4)
+                streams = []
+                books = []
+                second_level = self.ca.get_collection_recursive_pid_model_map('nscad', pid)
+                for member_pid, model in second_level.items():
+                    if model == 'islandora:bookCModel':
+                        books.append(self.plan_book('nscad', member_pid))
+                        continue
+                    file_data = self.get_foxml_from_pid(member_pid).get_file_data()
                     if 'OBJ' in file_data:
-                        copy_streams[
-                            file_data['OBJ'][
-                                'filename']] = f"{member_pid.replace(':', '_')}_OBJ{self.mimemap[file_data['OBJ']['mimetype']]}"
-                path = f"{archive_path}/item_{item_number}"
-                # Build directory
-                Path(path).mkdir(parents=True, exist_ok=True)
-                with open(f'{path}/dublin_core.xml', 'w') as f:
-                    f.write(metadata['dublin_core'])
-                if 'thesis' in metadata:
-                    with open(f'{path}/metadata_thesis.xml', 'w') as f:
-                        f.write(metadata['thesis'])
-                if 'oaire' in metadata:
-                    with open(f'{path}/metadata_oaire.xml', 'w') as f:
-                        f.write(metadata['oaire'])
-                with open(f'{path}/contents', 'w') as f:
-                    for source, destination in copy_streams.items():
-                        stream_to_copy = self.ca.dereference(source)
-                        shutil.copy(f"{self.datastreamStore}/{stream_to_copy}", f"{path}/{destination}")
-                        f.write(f"{destination}\n")
-                    if book_info:
-                        destination = Path(book_info['file']).name
-                        shutil.move(book_info['file'], f"{path}/{destination}")
-                        f.write(f"{destination}\n")
-
-            print(f"item_{item_number}")
-        current_number += 1
-        return current_number
+                        destination = f"{member_pid.replace(':', '_')}_OBJ{self.mimemap[file_data['OBJ']['mimetype']]}"
+                        streams.append(self.stream_source(file_data['OBJ'], destination))
+                plan = {'pid': pid,
+                        'item': f"item_{item_number}",
+                        'metadata': self.metadata_files(metadata),
+                        'streams': streams,
+                        'books': books}
+                print(self.write_item(package.writer(), plan))
+                package.record(plan)
+        return start_num + max(numbers.values(), default=0) + 1
 
     def build_nscad_audio_collection(self, collection):
         subcollections = self.ca.get_subcollections('nscad', collection)
@@ -208,28 +570,25 @@ class CairnProcessor:
         current_number = 0
         archive = collection.replace(':', '_')
         archive_path = f"{self.export_dir}/{archive}"
-        Path(archive_path).mkdir(parents=True, exist_ok=True)
-        for book_pid in book_pids:
-            current_number += 1
-            item_number = str(current_number).zfill(4)
-            book = self.build_book(table, book_pid)
-            path = f"{archive_path}/item_{item_number}"
-            Path(path).mkdir(parents=True, exist_ok=True)
-            zip_file = Path(book['file']).name
-            shutil.move(book['file'], f"{path}/{zip_file}")
-            with open(f'{path}/dublin_core.xml', 'w') as f:
-                f.write(book['dc'])
-            with open(f'{path}/contents', 'w') as f:
-                f.write(zip_file)
-
-
+        fixity = []
+        with SW.SafDirectoryWriter(archive_path, self.materialize, self.verify_links) as writer:
+            for book_pid in book_pids:
+                current_number += 1
+                item_number = str(current_number).zfill(4)
+                book = self.plan_book(table, book_pid)
+                plan = {'pid': book_pid,
+                        'item': f"item_{item_number}",
+                        'metadata': {'dublin_core.xml': book['dc']},
+                        'streams': [],
+                        'books': [book]}
+                self.write_item(writer, plan)
+                fixity.extend(plan['fixity'])
+        SW.write_fixity_manifest(f"{archive_path}.fixity.tsv", fixity)
 
-
-    def build_book(self, table, book_pid):
+    # Collects book metadata and the page datastreams that make up its zip, looking the pages up if not given.
+    def plan_book(self, table, book_pid, pages=None):
         archive = book_pid.replace(':', '_')
-        archive_path = f"{self.export_dir}/{archive}"
-        Path(archive_path).mkdir(parents=True, exist_ok=True)
-        pages = self.ca.get_pages(table, book_pid)
+        pages = self.ca.get_pages(table, book_pid) if pages is None else pages
         fw = self.get_foxml_from_pid(book_pid)
         files_info = fw.get_file_data()
         if 'MODS' in files_info:
@@ -237,23 +596,34 @@ class CairnProcessor:
         else:
             mods = fw.get_inline_mods()
         metadata = self.apply_transform(mods, book_pid)
-        path = f"{archive_path}/book_{book_pid.replace(':', '_')}"
-        Path(path).mkdir(parents=True, exist_ok=True)
+        streams = []
         for pid in pages:
             pfw = self.get_foxml_from_pid(pid)
             file_data = pfw.get_file_data()
             if 'OBJ' in file_data:
-                source = f"{self.datastreamStore}/{self.ca.dereference(file_data['OBJ']['filename'])}"
                 destination = f"{pid.replace(':', '_')}_OBJ{self.mimemap[file_data['OBJ']['mimetype']]}"
-                shutil.copy(source, f"{path}/{destination}")
-        print(f"Zipping files into {archive}.zip")
-        shutil.make_archive(f"{self.export_dir}/{archive}", 'zip', f"{self.export_dir}/{archive}")
-        shutil.rmtree(f"{self.export_dir}/{archive}")
+                streams.append(self.stream_source(file_data['OBJ'], destination))
         return {
+            'pid': book_pid,
             'dc': metadata['dublin_core'],
-            'file': f"{self.export_dir}/{archive}.zip"
+            'name': f"{archive}.zip",
+            'folder': f"book_{archive}",
+            'streams': streams
         }
 
+    # Streams a planned book into a zip nested inside the package, adding checked pages to fixity.
+    def write_book(self, writer, arcname, book, fixity=None):
+        print(f"Zipping files into {book['name']}")
+        size = 0
+        with writer.nested(arcname) as book_zip:
+            book_zip.write_directory(book['folder'])
+            for source, destination, expected in book['streams']:
+                written, checksum = book_zip.write_file(f"{book['folder']}/{destination}", source, expected)
+                if checksum and fixity is not None:
+                    fixity.append((f"{arcname}/{book['folder']}/{destination}", *checksum, written))
+                size += written
+        return size
+
     def get_nscc_ocr(self):
         collections = self.ca.get_subcollections('nscc', 'nscc:booktest')
         for collection in collections:
@@ -266,53 +636,72 @@ class CairnProcessor:
                 fw = self.get_foxml_from_pid(yearbook)
                 yearbook_title = fw.get_properties()['label'].strip().replace(" ", "_")
                 yearbook_path = f"{collection_path}/{yearbook_title}"
-                Path(yearbook_path).mkdir(parents=True, exist_ok=True)
                 pages = self.ca.get_pages('nscc', yearbook)
                 print(f"Processing {len(pages)} pages for {yearbook_title}")
-                for page in pages:
-                    fw = self.get_foxml_from_pid(page)
-                    file_data = fw.get_file_data()
-                    rels = fw.get_rels_ext_values()
-                    page_num = rels['isPageNumber']
-                    if 'OCR' in file_data:
-                        source = f"{self.datastreamStore}/{self.ca.dereference(file_data['OCR']['filename'])}"
-                        destination = f"{yearbook_path}/{yearbook_title}_{page_num}{self.mimemap[file_data['OCR']['mimetype']]}"
-                        try:
-                            shutil.copy(source, destination)
-                        except FileNotFoundError as e:
-                            print(f"File not found for page: {page_num}")
                 print(f"Zipping files into {yearbook_title}.zip")
-                shutil.make_archive(yearbook_path, 'zip', yearbook_path)
-                shutil.rmtree(yearbook_path)
+                with SW.SafZipWriter(f"{yearbook_path}.zip") as writer:
+                    for page in pages:
+                        fw = self.get_foxml_from_pid(page)
+                        file_data = fw.get_file_data()
+                        rels = fw.get_rels_ext_values()
+                        page_num = rels['isPageNumber']
+                        if 'OCR' in file_data:
+                            source = f"{self.datastreamStore}/{self.ca.dereference(file_data['OCR']['filename'])}"
+                            destination = f"{yearbook_title}_{page_num}{self.mimemap[file_data['OCR']['mimetype']]}"
+                            try:
+                                writer.write_file(destination, source)
+                            except FileNotFoundError as e:
+                                print(f"File not found for page: {page_num}")
 
     def save_all_datastreams(self, namespace, datastream):
         pids = self.ca.get_pids_from_objectstore(namespace)
         collection_path = f"{self.export_dir}/{namespace}_{datastream}"
-        Path(collection_path).mkdir(parents=True, exist_ok=True)
-        for pid in pids:
-            fw = self.get_foxml_from_pid(pid)
-            datastreams = fw.get_file_data()
-            if datastream in datastreams:
-                label = fw.get_properties()['label'].strip().replace(" ", "_")
-                source = f"{self.datastreamStore}/{self.ca.dereference(datastreams[datastream]['filename'])}"
-                destination = f"{collection_path}/{label}_{pid}_{datastream}{self.mimemap[datastreams[datastream]['mimetype']]}"
-                try:
-                    shutil.copy(source, destination)
-                except FileNotFoundError as e:
-                    print(f"File not found for: {pid}")
+        Path(self.export_dir).mkdir(parents=True, exist_ok=True)
         print(f"Zipping files into {namespace}_{datastream}.zip")
-        shutil.make_archive(collection_path, 'zip', collection_path)
-        shutil.rmtree(collection_path)
+        fixity = []
+        with SW.SafZipWriter(f"{collection_path}.zip") as writer:
+            for pid in pids:
+                fw = self.get_foxml_from_pid(pid)
+                datastreams = fw.get_file_data()
+                if datastream in datastreams:
+                    label = fw.get_properties()['label'].strip().replace(" ", "_")
+                    destination = f"{label}_{pid}_{datastream}{self.mimemap[datastreams[datastream]['mimetype']]}"
+                    try:
+                        source, destination, expected = self.stream_source(datastreams[datastream], destination)
+                        written, checksum = writer.write_file(destination, source, expected)
+                        if checksum:
+                            fixity.append((destination, *checksum, written))
+                    except FileNotFoundError as e:
+                        print(f"File not found for: {pid}")
+        SW.write_fixity_manifest(f"{collection_path}.zip.fixity.tsv", fixity)
 
+    # Transforms MODS, given as a file path or an XML string, into DSpace metadata files for pid.
+    # Results are cached on disk by MODS content, stylesheet and PID, so unchanged records skip the XSLT.
     def apply_transform(self, mods, pid):
-        if Path(mods).exists():
-            dom = ET.parse(mods)
+        if mods.lstrip().startswith('<'):
+            data, base_url = mods.encode('utf-8'), None
         else:
-            dom = ET.fromstring(mods)
+            data, base_url = Path(mods).read_bytes(), mods
+        cache = self.get_transform_cache()
+        if cache is None:
+            return self.transform_mods(data, base_url, pid)
+        mods_hash = hashlib.sha1(data).hexdigest()
+        xsl_hash = XR.registry.fingerprint(self.mods_xsl)
+        result = cache.get(mods_hash, xsl_hash, pid)
+        if result is None:
+            result = self.transform_mods(data, base_url, pid)
+            cache.put(mods_hash, xsl_hash, pid, result)
+        return result
+
+    def get_transform_cache(self):
+        if self.transform_cache is None and self.transform_cache_path:
+            self.transform_cache = TC.TransformCache(self.transform_cache_path, self.transform_cache_size)
+        return self.transform_cache
+
+    def transform_mods(self, data, base_url, pid):
+        dom = ET.fromstring(data, base_url=base_url)
         return_files = {}
-        xslt = ET.parse(self.mods_xsl)
-        transform = ET.XSLT(xslt)
-        dc = transform(dom)
+        dc = XR.registry.apply(self.mods_xsl, dom)
         root = ET.Element("dublin_core")
         ET.SubElement(root, "dcvalue", element="identifier", qualifier="other").text = pid
         thesis_root = ET.Element("dublin_core")
@@ -349,15 +738,84 @@ class CairnProcessor:
             return_files['oaire'] = ET.tostring(oaire_root, encoding='unicode')
         return return_files
 
-    def batch_processor(self, table, collections):
+    # Dry runs the export of collections, printing and returning one plan per collection.
+    # metrics_path is the metrics file of an earlier export, used to estimate runtimes.
+    def plan_collections(self, table, collections, workers=None, metrics_path=None):
+        planner = EX.ExportPlanner(self, workers)
+        plans = []
+        for collection in collections:
+            plan = planner.plan(table, collection, metrics_path)
+            planner.report(plan)
+            plans.append(plan)
+        return plans
+
+    def batch_processor(self, table, collections, dry_run=False):
+        if dry_run:
+            return self.plan_collections(table, collections, metrics_path=self.metrics_path)
         for collection in collections:
             self.process_collection(table, collection, 'y')
 
 
-collections = ['nscad:4701', 'nscad,4693', 'nscad:5693', 'nscad:5639', 'nscad:4541']
-CP = CairnProcessor()
-#CP.batch_processor('nscad', collections)
-# CP.build_nscad_audio_collection('nscad:workingfolder')
-# CP.build_book_collection('nscad', 'nscad:4450')
-# CP.process_collection('nscad', 'nscad:4693', 'Y')
-CP.nscad_artists("nscad:4701", 0)
\ No newline at end of file
+
+# Per-process CairnProcessor used by pool workers.
+worker_processor = None
+
+
+def init_worker(settings):
+    global worker_processor
+    worker_processor = CairnProcessor()
+    for name, value in settings.items():
+        setattr(worker_processor, name, value)
+    worker_processor.ca.use_hash_pattern(worker_processor.hash_pattern)
+    # Workers resolve the paths of the items they plan, so they load and save resolved paths as the parent does,
+    # saving when the pool shuts them down.
+    worker_processor.ca.preload_resolved_paths()
+    util.Finalize(None, worker_processor.ca.save_resolved_paths, exitpriority=10)
+
+
+def plan_item_worker(*args):
+    return with_worker_stats(worker_processor.plan_item(*args))
+
+
+# Writes planned items into one shard, returning the written plans and (pid, error) of items that failed.
+# A fixity mismatch stops the shard, as it stops the export; a failed zip shard is left as .partial and none of
+# its items count as written.
+def write_shard_worker(path, output, plans):
+    written = []
+    errors = []
+    with SW.open_writer(output, path, worker_processor.materialize, worker_processor.verify_links) as writer:
+        for plan in plans:
+            try:
+                worker_processor.write_item(writer, plan)
+                written.append(plan)
+            except Exception as e:
+                errors.append((plan['pid'], e))
+                if isinstance(e, SW.FixityError):
+                    break
+    if writer.failed:
+        written = []
+    return written, errors
+
+
+def export_item_worker(table, pid, model, item_number, transform_mods, archive_path):
+    writer = SW.SafDirectoryWriter(archive_path, worker_processor.materialize, worker_processor.verify_links)
+    plan = worker_processor.plan_item(table, pid, model, item_number, transform_mods)
+    worker_processor.write_item(writer, plan)
+    return with_worker_stats(plan)
+
+
+# Adds this worker's cumulative XSLT cache counts to a plan, for the parent to report.
+def with_worker_stats(plan):
+    plan['worker_xslt'] = (os.getpid(), XR.registry.hits, XR.registry.misses)
+    return plan
+
+
+if __name__ == '__main__':
+    # Kept for existing scripts; the same as CairnCli.py export collection.
+    import CairnCli
+    CairnCli.main(['export', 'collection', *sys.argv[1:]])
+    # collections = ['nscad:4701', 'nscad,4693', 'nscad:5693', 'nscad:5639', 'nscad:4541']
+    # CP.batch_processor('nscad', collections)
+    # CP.build_nscad_audio_collection('nscad:workingfolder')
+    # CP.build_book_collection('nscad', 'nscad:4450')
+    # CP.nscad_artists("nscad:4701", 0)
@@ -1,19 +1,21 @@
 #!/usr/bin/env python3
 
-import collections
 import csv
-import hashlib
 import sqlite3
-import urllib
-import urllib.parse
+import time
 from pathlib import Path
-from urllib.parse import unquote
 import re
 
 import lxml.etree as ET
-import requests
 
 import FoxmlWorker as FW
+import ModsStore as MS
+import PathResolver as PR
+import PidIndex as PI
+import RelationshipGraph as RG
+import RelsExtHarvester as RH
+import StoreListing as SL
+import XsltRegistry as XR
 
 
 class CairnUtilities:
@@ -25,6 +27,11 @@ class CairnUtilities:
         self.fields = ['PID', 'model', 'RELS_EXT_isMemberOfCollection_uri_ms', 'RELS_EXT_isPageOf_uri_ms']
         self.objectStore = '/usr/local/fedora/data/objectStore/'
         self.datastreamStore = '/usr/local/fedora/data/datastreamStore/'
+        self.pid_index = None
+        self.indexed_columns = ['collection_pid', 'page_of', 'content_model']
+        self.graphs = {}
+        self.relations = {}
+        self.resolver = PR.resolver
         self.rels_map = {'isMemberOfCollection': 'collection_pid',
                          'isMemberOf': 'collection_pid',
                          'hasModel': 'content_model',
@@ -36,27 +43,22 @@ class CairnUtilities:
     # Converts MODS to marc21
     def mods_to_marc21(self, mods_xml):
         dom = ET.parse(mods_xml)
-        xslt = ET.parse(self.marcxml)
-        transform = ET.XSLT(xslt)
-        newdom = transform(dom)
+        newdom = XR.registry.apply(self.marcxml, dom)
         return ET.tostring(newdom)
 
     # Converts MODS to DC
     def mods_to_dc(self, mods_xml):
         dom = ET.parse(mods_xml)
-        xslt = ET.parse(self.mods_xsl)
-        transform = ET.XSLT(xslt)
-        newdom = transform(dom)
+        newdom = XR.registry.apply(self.mods_xsl, dom)
         return ET.tostring(newdom)
 
     # Returns marc21 from PID - hardcoded for nscc
     def get_marc_from_pid(self, pid):
+        import requests
         url = f'https://nscc.cairnrepo.org/islandora/object/{pid}/datastream/MODS/download'
         mods_xml = requests.get(url).content
         dom = ET.fromstring(mods_xml)
-        xslt = ET.parse(self.marcxml)
-        transform = ET.XSLT(xslt)
-        newdom = transform(dom)
+        newdom = XR.registry.apply(self.marcxml, dom)
         filename = f"MARC21/{pid.replace(':', '_')}.xml"
         with open(filename, 'wb') as f:
             newdom.write(f, encoding='utf-8')
@@ -73,38 +75,40 @@ class CairnUtilities:
 
     # Creates database table with RELS-EXT values returned from Workbench harvest
     def process_institution(self, institution, csv_file):
-        cursor = self.conn.cursor()
-        cursor.execute(f"""
-            CREATE TABLE if not exists {institution}(
-            pid TEXT PRIMARY KEY,
-            content_model TEXT,
-            collection_pid TEXT,
-            page_of TEXT,
-            sequence TEXT,
-            constituent_of TEXT
-            )""")
-        self.conn.commit()
         with open(csv_file, newline='') as csvfile:
             reader = csv.DictReader(csvfile)
-            for row in reader:
-                collection = row['RELS_EXT_isMemberOfCollection_uri_ms'].replace("info:fedora/", '')
-                page_of = row['RELS_EXT_isPageOf_uri_ms'].replace("info:fedora/", '')
-                if not page_of:
-                    page_of = ' '
-                constituent_of = row['RELS_EXT_isConstituentOf_uri_ms'].replace("info:fedora/", '')
-                if not page_of:
-                    constituent_of = ' '
-                try:
-                    command = f"INSERT OR REPLACE INTO  {institution} VALUES('{row['PID']}', '{row['model']}', '{collection}','{page_of}', '{row['sequence']}','{constituent_of}')"
-                    cursor.execute(command)
-                except sqlite3.Error:
-                    print(row['PID'])
-        self.conn.commit()
+            rows = (self.workbench_row(row) for row in reader)
+            self.bulk_load_institution(institution, rows)
+
+    # Maps a Workbench harvest row onto the institution table columns
+    def workbench_row(self, row):
+        collection = row['RELS_EXT_isMemberOfCollection_uri_ms'].replace("info:fedora/", '')
+        page_of = row['RELS_EXT_isPageOf_uri_ms'].replace("info:fedora/", '')
+        if not page_of:
+            page_of = ' '
+        constituent_of = row['RELS_EXT_isConstituentOf_uri_ms'].replace("info:fedora/", '')
+        if not constituent_of:
+            constituent_of = ' '
+        return row['PID'], row['model'], collection, page_of, row['sequence'], constituent_of
 
     # Processes CSV returned from direct objectStore harvest
     def process_clean_institution(self, institution, csv_file):
-        cursor = self.conn.cursor()
-        cursor.execute(f"""
+        with open(csv_file, newline='') as csvfile:
+            reader = csv.DictReader(csvfile)
+            rows = (self.clean_row(row) for row in reader)
+            self.bulk_load_institution(institution, rows)
+
+    # Maps an objectStore harvest row onto the institution table columns
+    def clean_row(self, row):
+        return (row['pid'],
+                row['content_model'],
+                row['collection_pid'],
+                row['page_of'] or ' ',
+                row['sequence'],
+                row['constituent_of'] or ' ')
+
+    def create_institution_table(self, institution):
+        self.conn.execute(f"""
             CREATE TABLE if not exists {institution}(
             pid TEXT PRIMARY KEY,
             content_model TEXT,
@@ -114,93 +118,75 @@ class CairnUtilities:
             constituent_of TEXT
             )""")
         self.conn.commit()
-        with open(csv_file, newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                collection = row['collection_pid']
-                page_of = row['page_of']
-                if not page_of:
-                    page_of = ' '
-                constituent_of = row['constituent_of']
-                if not constituent_of:
-                    constituent_of = ' '
-                try:
-                    command = f"INSERT OR REPLACE INTO  {institution} VALUES('{row['pid']}', '{row['content_model']}', '{collection}','{page_of}', '{row['sequence']}','{constituent_of}', '')"
-                    cursor.execute(command)
-                except sqlite3.Error:
-                    print(command)
-                    print(row['pid'])
+
+    # Loads rows into institution table with bound parameters in a single transaction.
+    # Secondary indexes are dropped for the load and rebuilt afterwards.
+    def bulk_load_institution(self, institution, rows):
+        start = time.time()
+        self.graphs.pop(institution, None)
+        self.create_institution_table(institution)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=OFF")
+        for column in self.indexed_columns:
+            self.conn.execute(f"DROP INDEX if exists {institution}_{column}")
+        try:
+            with self.conn:
+                cursor = self.conn.executemany(f"INSERT OR REPLACE INTO {institution} VALUES(?, ?, ?, ?, ?, ?)", rows)
+                count = cursor.rowcount
+        finally:
+            self.conn.execute("PRAGMA synchronous=FULL")
+            self.create_institution_indexes(institution)
+        elapsed = time.time() - start
+        print(f"Loaded {count} rows into {institution} in {round(elapsed, 2)} seconds "
+              f"({int(count / elapsed) if elapsed else count} rows/sec)")
+        return count
+
+    def create_institution_indexes(self, institution):
+        for column in self.indexed_columns:
+            self.conn.execute(f"CREATE INDEX if not exists {institution}_{column} ON {institution}({column})")
         self.conn.commit()
 
     # Identifies object and datastream location within Fedora objectStores and datastreamStore.
+    # Gets a FOXML or datastream path relative to its store, e.g. 'info:fedora/pid' -> 'ab/info%3Afedora%2Fpid'.
     def dereference(self, identifier: str) -> str:
-        # Replace '+' with '/' in the identifier
-        slashed = identifier.replace('+', '/')
-        full = f"info:fedora/{slashed}"
-
-        # Generate the MD5 hash of the full string
-        hash_value = hashlib.md5(full.encode('utf-8')).hexdigest()
-
-        # Pattern to fill with hash (similar to the `##` placeholder)
-        subbed = "##"
-
-        # Replace the '#' characters in `subbed` with the corresponding characters from `hash_value`
-        hash_offset = 0
-        pattern_offset = 0
-        result = list(subbed)
-
-        while pattern_offset < len(result) and hash_offset < len(hash_value):
-            if result[pattern_offset] == '#':
-                result[pattern_offset] = hash_value[hash_offset]
-                hash_offset += 1
-            pattern_offset += 1
-
-        subbed = ''.join(result)
-        # URL encode the full string, replacing '_' with '%5F'
-        encoded = urllib.parse.quote(full, safe='').replace('_', '%5F')
-        return f"{subbed}/{encoded}"
+        return self.resolver.resolve(identifier)
+
+    # Switches to a Fedora hash pattern other than the default '##', such as '##/##'.
+    def use_hash_pattern(self, pattern):
+        if pattern != self.resolver.pattern:
+            self.resolver = PR.PathResolver(pattern)
+            self.pid_index = None
+
+    # Gets in-memory relationship graph for an institution table, loading it on first use.
+    def get_graph(self, table):
+        if table not in self.graphs:
+            self.graphs[table] = RG.RelationshipGraph(self.conn, table)
+        return self.graphs[table]
+
+    # Gets indexed queries over an institution table, used instead of the graph when it is not loaded.
+    def get_relations(self, table):
+        if table not in self.relations:
+            self.relations[table] = RG.TableRelations(self.conn, table)
+        return self.relations[table]
 
     def get_pages(self, table, book_pid):
-        cursor = self.conn.cursor()
-        command = f"SELECT PID from {table} where page_of = '{book_pid}'"
-        pids = []
-        for row in cursor.execute(command):
-            pids.append(row[0])
-        return pids
+        if table not in self.graphs:
+            return self.get_relations(table).get_pages(book_pid)
+        return self.get_graph(table).get_pages(book_pid)
 
     def get_books(self, table, collection):
-        cursor = self.conn.cursor()
-        command = f"SELECT PID, CONTENT_MODEL from {table} where collection_pid = '{collection}' AND CONTENT_MODEL = 'islandora:bookCModel' "
-        pids = []
-        for row in cursor.execute(command):
-            pids.append(row[0])
-        return pids
+        return self.get_graph(table).get_books(collection)
 
     # Get all collection pids within namespace
     def get_collection_pids(self, table, collection):
-        cursor = self.conn.cursor()
-        command = f"SELECT PID from {table} where collection_pid = '{collection}'"
-        pids = []
-        for row in cursor.execute(command):
-            pids.append(row['pid'])
-        return pids
+        return self.get_graph(table).get_collection_pids(collection)
 
     # Get all content models from map
     def get_collection_pid_model_map(self, table, collection):
-        cursor = self.conn.cursor()
-        command = f"SELECT PID, CONTENT_MODEL from {table} where collection_pid = '{collection}'"
-        map = {}
-        for row in cursor.execute(command):
-            map[row[0]] = row[1]
-        return map
+        return self.get_graph(table).get_collection_pid_model_map(collection)
 
     def get_subcollections(self, table, collection):
-        cursor = self.conn.cursor()
-        command = f"SELECT PID, CONTENT_MODEL from {table} where collection_pid = '{collection}' AND CONTENT_MODEL = 'islandora:collectionCModel' "
-        pids = []
-        for row in cursor.execute(command):
-            pids.append(row[0])
-        return pids
+        return self.get_graph(table).get_subcollections(collection)
 
     # Gets collection hierarchy by namespace.
     def get_collection_details(self, table):
@@ -212,136 +198,99 @@ class CairnUtilities:
         return results
 
     # Gets filestores for NSCC - No longer needed.
+    # Writes the objectStore and datastreamStore listing lines of a collection's members to fedora_stores.
     def get_stores(self, collection_pid):
-        members = self.get_collection_pids('nscc', collection_pid)
-        encoded_members = []
-        for member in members:
-            encoded_members.append(urllib.parse.quote(member))
+        members = set(self.get_graph('nscc').iter_collection_pids(collection_pid))
         files = {'object': 'inputs/nscc_object.txt', 'datastream': 'inputs/nscc_datastream.txt'}
         for type, filename in files.items():
-            file = open(filename)
-            filtered_lines = []
-            while True:
-                line = file.readline()
-                if any(x in line for x in encoded_members):
-                    filtered_lines.append(line)
-                if not line:
-                    with open(f'fedora_stores/{collection_pid.replace(":", "_")}_{type}', 'w') as f:
-                        for line in filtered_lines:
-                            f.write(line)
-                    break
-
-    # Get MODS from NSCC inpupts
+            SL.filter_listing(filename, members, f'fedora_stores/{collection_pid.replace(":", "_")}_{type}')
+
+    # Writes the datastreamStore listing line of the latest MODS version of every NSCC object, in PID order.
     def get_all_mods(self):
-        all_mods = {}
-        file = open('inputs/nscc_datastream.txt')
-        while True:
-            line = file.readline()
-            if 'MODS' in line:
-                parts = line.split('%2F')
-                pid = parts[1]
-                version = line[-1]
-                if pid in all_mods:
-                    last_version = all_mods[pid][-1]
-                    if version > last_version:
-                        all_mods[pid] = line
-                else:
-                    all_mods[pid] = line
-            if not line:
-                od = collections.OrderedDict(sorted(all_mods.items()))
-                with open(f'assets/nscc_mods', 'w') as f:
-                    for pid, line in od.items():
-                        f.write(line)
-                break
-
-    # Gets PIDS, filtered by namespace directly from objectStore
+        all_mods = SL.latest_versions('inputs/nscc_datastream.txt', 'MODS')
+        with open('assets/nscc_mods', 'w') as f:
+            for pid in sorted(all_mods):
+                line = all_mods[pid]
+                f.write(line if line.endswith('\n') else f"{line}\n")
+
+    # Gets objectStore PID index, building it on first use.
+    def get_pid_index(self):
+        if self.pid_index is None:
+            self.pid_index = PI.PidIndex(self.objectStore, hash_pattern=self.resolver.pattern)
+            self.resolver.preload(self.pid_index)
+        return self.pid_index
+
+    # Gets PIDS, filtered by namespace, from the objectStore index
     def get_pids_from_objectstore(self, namespace=''):
-        wildcard = '*/*'
-        if namespace:
-            wildcard = f'*/*{namespace}*'
-        pids = []
-        for p in Path(self.objectStore).rglob(wildcard):
-            pid = unquote(p.name).replace('info:fedora/', '')
-            pids.append(pid)
-        return pids
+        return self.get_pid_index().get_pids(namespace)
+
+    # Yields PIDS, filtered by namespace, from a cursor over the objectStore index
+    def iter_pids_from_objectstore(self, namespace=''):
+        return self.get_pid_index().iter_pids(namespace)
 
     # Gets all namespaces in objectStore
     def get_namespaces(self):
-        namespaces = []
-        for pid in self.get_pids_from_objectstore():
-            namespace = pid.split(':')[0]
-            if namespace not in namespaces:
-                namespaces.append(namespace)
-        return namespaces
-
-    # Gets RELS-EXT relationships from objectStore
-    def build_record_from_pids(self, namespace, output_file):
-        pids = self.get_pids_from_objectstore(namespace)
-        headers = ['pid',
-                   'content_model',
-                   'collection_pid',
-                   'page_of',
-                   'sequence',
-                   'constituent_of']
-
-        with open(output_file, 'w', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=headers)
-            writer.writeheader()
-            for pid in pids:
-                foxml_file = self.dereference(pid)
-                foxml = f"{self.objectStore}/{foxml_file}"
-                fw = FW.FWorker(foxml)
-                if fw.get_state() != 'Active':
-                    continue
-                relations = fw.get_rels_ext_values()
-                row = {}
-                row['pid'] = pid
-                for relation, value in relations.items():
-                    if relation in self.rels_map:
-                        row[self.rels_map[relation]] = value
-                writer.writerow(row)
-
-    # Adds all MODS records from datastreamStore to database
+        return self.get_pid_index().get_namespaces()
+
+    # Gets RELS-EXT relationships of active objects from the objectStore, harvested in parallel shards.
+    # Writes them to output_file, and loads them straight into the institution table when one is given.
+    def build_record_from_pids(self, namespace, output_file=None, institution=None, workers=None, shard_size=5000):
+        pids = self.iter_pids_from_objectstore(namespace)
+        harvester = RH.RelsExtHarvester(self.objectStore, self.rels_map, workers, shard_size, self.resolver)
+        counts = harvester.run(pids, output_file, institution, self.bulk_load_institution)
+        self.save_resolved_paths()
+        return counts
+
+    # Fills the resolver's cache with the paths saved by earlier runs. Only the first call, which opens the PID
+    # index, reads them, so call it before resolving anything.
+    def preload_resolved_paths(self):
+        self.get_pid_index()
+
+    # Saves the resolver's cached paths into the PID index, for preload_resolved_paths in later runs.
+    def save_resolved_paths(self):
+        self.resolver.persist(self.get_pid_index())
+
+    # Adds the MODS of every active object in a namespace to the compressed MODS store.
     def add_mods_to_database(self, namespace):
-        cursor = self.conn.cursor()
-        pids = self.get_pids_from_objectstore(namespace)
-        for pid in pids:
-            foxml_file = self.dereference(pid)
-            foxml = f"{self.objectStore}/{foxml_file}"
-            fw = FW.FWorker(foxml)
+        start = time.time()
+        counts = MS.ModsStore(self.conn).ingest(namespace, self.read_namespace_mods(namespace))
+        seconds = time.time() - start
+        print(f"Stored {counts['records']} MODS records ({counts['added']} new distinct, "
+              f"{counts['bytes'] / 1024 ** 2:.1f} MB compressed to {counts['stored'] / 1024 ** 2:.1f} MB) "
+              f"in {round(seconds, 2)} seconds")
+        return counts
+
+    # Yields (pid, MODS bytes) for active objects in a namespace, from the managed datastream or inline XML.
+    # PIDs are read into a list first: ModsStore.ingest writes to cairn.db while this runs, and an open read
+    # cursor on the index would block its transaction outside WAL mode.
+    def read_namespace_mods(self, namespace):
+        for pid in self.get_pids_from_objectstore(namespace):
+            fw = FW.FWorker(f"{self.objectStore}/{self.dereference(pid)}")
             if fw.get_state() != 'Active':
                 continue
-            mapping = fw.get_file_data()
-            mods_info = mapping.get('MODS')
+            mods_info = fw.get_file_data().get('MODS')
             if mods_info:
                 mods_path = f"{self.datastreamStore}/{self.dereference(mods_info['filename'])}"
-                mods_xml = Path(mods_path).read_text()
+                yield pid, Path(mods_path).read_bytes()
             else:
                 mods_xml = fw.get_inline_mods()
-            if mods_xml:
-                mods_xml = mods_xml.replace("'", "''")
-                command = f"""UPDATE {namespace} set mods = '{mods_xml}' where pid = '{pid}"""
-                cursor.execute(command)
-        self.conn.commit()
+                if mods_xml:
+                    yield pid, mods_xml.encode('utf-8')
+
+    # Yields (pid, MODS) stored for a namespace.
+    def iter_mods(self, namespace):
+        return MS.ModsStore(self.conn).iter_records(namespace)
 
     def get_collection_recursive_pid_model_map(self, table, collection_pid):
-        descendants = {}
-        cursor = self.conn.cursor()
-        command = f"select PID, CONTENT_MODEL from {table} where COLLECTION_PID = '{collection_pid}'"
-        child_collections = []
-        for row in cursor.execute(command):
-            if row['content_model'] == 'islandora:collectionCModel':
-                child_collections.append(row['PID'])
-            else:
-                descendants[row['PID']] = row['content_model']
-        while child_collections:
-            command = f"select PID, CONTENT_MODEL from {table} where COLLECTION_PID = '{child_collections.pop(0)}'"
-            for row in cursor.execute(command):
-                if row['content_model'] == 'islandora:collectionCModel':
-                    child_collections.append(row['PID'])
-                else:
-                    descendants[row['PID']] = row['content_model']
-        return descendants
+        return self.get_graph(table).get_collection_recursive_pid_model_map(collection_pid)
+
+    # Yields (pid, model) for every non-collection descendant of a collection without building a map.
+    # Unless the table's graph is already loaded, this walks the collection_pid index instead of loading it.
+    # metrics times the table queries of a walk that does not use the graph (see TableRelations).
+    def iter_collection_members(self, table, collection_pid, metrics=None):
+        if table not in self.graphs:
+            return self.get_relations(table).iter_collection_members(collection_pid, metrics)
+        return self.get_graph(table).iter_collection_members(collection_pid)
 
     def make_moncton_filename(self, xml_content):
         import xml.etree.ElementTree as ET
@@ -0,0 +1,335 @@
+import hashlib
+import os
+import sqlite3
+import time
+from contextlib import nullcontext
+from itertools import islice
+
+import SafWriter as SW
+
+# PIDs looked up and numbered per journal query when numbering a stream of members.
+NUMBER_BATCH = 500
+# Items per zip part when no checkpoint interval is given, so a crashed zip export loses at most this many.
+ZIP_CHECKPOINT = 500
+
+
+# Run journal for collection exports, keyed by collection and PID.
+# Records each item's number, status and output hash so an interrupted export can resume where it stopped
+# with the same item numbering.
+class ExportJournal:
+    def __init__(self, conn):
+        self.conn = conn
+        self.conn.execute("""
+            CREATE TABLE if not exists export_journal(
+            collection TEXT,
+            pid TEXT,
+            item_number INTEGER,
+            status TEXT,
+            output_hash TEXT,
+            archive TEXT,
+            error TEXT,
+            updated REAL,
+            last_modified TEXT,
+            foxml_mtime INTEGER,
+            PRIMARY KEY (collection, pid)
+            )""")
+        self.counts = {'items': 0, 'skipped': 0}
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(export_journal)")]
+        if 'last_modified' not in columns:
+            self.conn.execute("ALTER TABLE export_journal ADD COLUMN last_modified TEXT")
+            self.conn.execute("ALTER TABLE export_journal ADD COLUMN foxml_mtime INTEGER")
+        self.conn.commit()
+
+    # Returns stable item numbers for PIDs, keeping numbers from earlier runs and appending new PIDs.
+    def assign(self, collection, pids):
+        numbers = dict(self.conn.execute("SELECT pid, item_number FROM export_journal WHERE collection = ?",
+                                         (collection,)))
+        next_number = max(numbers.values(), default=0) + 1
+        new_rows = []
+        for pid in pids:
+            if pid not in numbers:
+                numbers[pid] = next_number
+                new_rows.append((collection, pid, next_number, 'pending', time.time()))
+                next_number += 1
+        with self.conn:
+            self.conn.executemany("INSERT INTO export_journal (collection, pid, item_number, status, updated) "
+                                  "VALUES(?, ?, ?, ?, ?)", new_rows)
+        return numbers
+
+    # Numbers a stream of (pid, model) members as it is read, yielding (pid, model, item_number) for members not
+    # completed by an earlier run. Numbers are looked up and new ones appended a batch at a time, so memory stays
+    # constant however large the collection is; self.counts holds the members yielded and skipped so far.
+    # The lookups use a connection of their own, so the stream can be consumed on another thread. Given
+    # ExportMetrics, each lookup and insert is timed as a db_query stage.
+    def number(self, collection, members, metrics=None):
+        self.counts = {'items': 0, 'skipped': 0}
+        return self.numbered(self.connect(), collection, members, metrics)
+
+    def numbered(self, conn, collection, members, metrics=None):
+        timer = (lambda: metrics.timer('db_query')) if metrics else nullcontext
+        try:
+            with timer():
+                next_number = conn.execute("SELECT COALESCE(MAX(item_number), 0) FROM export_journal "
+                                           "WHERE collection = ?", (collection,)).fetchone()[0] + 1
+            members = iter(members)
+            while True:
+                batch = list(islice(members, NUMBER_BATCH))
+                if not batch:
+                    break
+                with timer():
+                    rows = conn.execute(f"SELECT pid, item_number, status FROM export_journal WHERE collection = ? "
+                                        f"AND pid IN ({', '.join('?' * len(batch))})",
+                                        [collection] + [pid for pid, model in batch]).fetchall()
+                known = {pid: (item_number, status) for pid, item_number, status in rows}
+                new_rows = []
+                numbered = []
+                for pid, model in batch:
+                    entry = known.get(pid)
+                    if entry is None:
+                        entry = known[pid] = (next_number, 'pending')
+                        new_rows.append((collection, pid, next_number, 'pending', time.time()))
+                        next_number += 1
+                    if entry[1] == 'done':
+                        self.counts['skipped'] += 1
+                    else:
+                        numbered.append((pid, model, entry[0]))
+                with timer(), conn:
+                    conn.executemany("INSERT INTO export_journal (collection, pid, item_number, status, updated) "
+                                     "VALUES(?, ?, ?, ?, ?)", new_rows)
+                self.counts['items'] += len(numbered)
+                yield from numbered
+        finally:
+            if conn is not self.conn:
+                conn.close()
+
+    # Opens another connection to the journal's database, or reuses this one for an in-memory database.
+    def connect(self):
+        path = self.conn.execute("PRAGMA database_list").fetchone()[2]
+        if not path:
+            return self.conn
+        return sqlite3.connect(path, timeout=30, check_same_thread=False)
+
+    # Gets PIDs already exported for a collection.
+    def completed(self, collection):
+        rows = self.conn.execute("SELECT pid FROM export_journal WHERE collection = ? AND status = 'done'",
+                                 (collection,))
+        return {row[0] for row in rows}
+
+    # Marks every item of a collection pending again, keeping its number.
+    def reset(self, collection):
+        with self.conn:
+            self.conn.execute("UPDATE export_journal SET status = 'pending', archive = NULL, error = NULL "
+                              "WHERE collection = ?", (collection,))
+
+    # Marks items done; entries are (pid, output hash, lastModifiedDate, FOXML mtime).
+    def mark_done(self, collection, entries, archive):
+        now = time.time()
+        with self.conn:
+            self.conn.executemany("UPDATE export_journal SET status = 'done', output_hash = ?, archive = ?, "
+                                  "error = NULL, updated = ?, last_modified = ?, foxml_mtime = ? "
+                                  "WHERE collection = ? AND pid = ?",
+                                  [(output_hash, archive, now, last_modified, foxml_mtime, collection, pid)
+                                   for pid, output_hash, last_modified, foxml_mtime in entries])
+
+    # Gets modification stamps of exported items: pid -> (lastModifiedDate, FOXML mtime).
+    def stamps(self, collection):
+        rows = self.conn.execute("SELECT pid, last_modified, foxml_mtime FROM export_journal "
+                                 "WHERE collection = ? AND status = 'done'", (collection,))
+        return {pid: (last_modified, foxml_mtime) for pid, last_modified, foxml_mtime in rows}
+
+    # Updates FOXML mtimes of items whose file was touched without a change to the object.
+    def touch(self, collection, mtimes):
+        with self.conn:
+            self.conn.executemany("UPDATE export_journal SET foxml_mtime = ? WHERE collection = ? AND pid = ?",
+                                  [(mtime, collection, pid) for pid, mtime in mtimes.items()])
+
+    def mark_deleted(self, collection, pids):
+        with self.conn:
+            self.conn.executemany("UPDATE export_journal SET status = 'deleted', updated = ? "
+                                  "WHERE collection = ? AND pid = ?",
+                                  [(time.time(), collection, pid) for pid in pids])
+
+    def mark_failed(self, collection, pid, error):
+        with self.conn:
+            self.conn.execute("UPDATE export_journal SET status = 'failed', error = ?, updated = ? "
+                              "WHERE collection = ? AND pid = ?", (error, time.time(), collection, pid))
+
+    # Gets archive names holding completed items.
+    def archives(self, collection):
+        rows = self.conn.execute("SELECT DISTINCT archive FROM export_journal WHERE collection = ? AND status = 'done'",
+                                 (collection,))
+        return {row[0] for row in rows}
+
+
+# Hashes what an item writes: metadata text, plus name and size of each datastream and book.
+def plan_hash(plan):
+    digest = hashlib.sha1()
+    for filename, text in sorted(plan['metadata'].items()):
+        digest.update(f"{filename}\0{text}\0".encode('utf-8'))
+    for source, destination, fixity in plan['streams']:
+        digest.update(f"{destination}\0{os.path.getsize(source)}\0".encode('utf-8'))
+    for book in plan['books']:
+        digest.update(f"{book['name']}\0{book['dc']}\0".encode('utf-8'))
+        for source, destination, fixity in book['streams']:
+            digest.update(f"{destination}\0{os.path.getsize(source)}\0".encode('utf-8'))
+    return digest.hexdigest()
+
+
+# Gets the bytes an item writes: metadata text plus its datastreams and the pages of its books.
+def plan_size(plan):
+    size = sum(len(text.encode('utf-8')) for text in plan['metadata'].values())
+    size += sum(os.path.getsize(source) for source, destination, fixity in plan['streams'])
+    for book in plan['books']:
+        size += sum(os.path.getsize(source) for source, destination, fixity in book['streams'])
+    return size
+
+
+# Package that records items in the journal once they are durable.
+# Directory items are durable as soon as they are written. Zip items are durable only when their archive
+# is closed, so a checkpoint interval splits zip output into parts of that many items, bounding the work a
+# crash can lose. Parts never overwrite an archive that holds completed items.
+# Datastream checksums of recorded items go into a fixity manifest beside the package, <archive>.fixity.tsv,
+# one "digest type, checksum, size, path" line per datastream. A directory package's manifest is appended to
+# by every run, so later lines for a path supersede earlier ones.
+class CheckpointedPackage:
+    def __init__(self, journal, collection, output, archive_path, strategy='copy', checkpoint=0, verify_links=False):
+        self.journal = journal
+        self.collection = collection
+        self.output = output
+        self.archive_path = archive_path
+        self.strategy = strategy
+        self.checkpoint = checkpoint
+        self.verify_links = verify_links
+        self.current = None
+        self.archive = None
+        self.pending = []
+        self.manifest = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Gets writer for the current part, opening a new one if needed.
+    def writer(self):
+        if self.current is None:
+            if self.output == 'directory':
+                self.archive = os.path.basename(self.archive_path)
+                self.current = SW.SafDirectoryWriter(self.archive_path, self.strategy, self.verify_links)
+            else:
+                self.archive = self.next_archive()
+                self.current = SW.SafZipWriter(f"{os.path.dirname(self.archive_path)}/{self.archive}")
+        return self.current
+
+    def next_archive(self):
+        used = self.journal.archives(self.collection)
+        base = os.path.basename(self.archive_path)
+        if f"{base}.zip" not in used:
+            return f"{base}.zip"
+        part = 2
+        while f"{base}_part{part:03d}.zip" in used:
+            part += 1
+        return f"{base}_part{part:03d}.zip"
+
+    # Records a written item.
+    def record(self, plan):
+        if self.current is None:
+            self.writer()
+        self.pending.append((plan['pid'], plan_hash(plan), plan.get('last_modified'), plan.get('foxml_mtime')))
+        self.manifest.extend(plan.get('fixity', ()))
+        if self.output == 'directory':
+            self.flush()
+        elif self.checkpoint and len(self.pending) >= self.checkpoint:
+            self.close()
+
+    def fail(self, pid, error):
+        self.journal.mark_failed(self.collection, pid, error)
+
+    def flush(self):
+        if self.manifest:
+            self.write_manifest()
+        if self.pending:
+            self.journal.mark_done(self.collection, self.pending, self.archive)
+            self.pending = []
+
+    def write_manifest(self):
+        SW.write_fixity_manifest(f"{os.path.dirname(self.archive_path)}/{self.archive}.fixity.tsv", self.manifest,
+                                 'a' if self.output == 'directory' else 'w')
+        self.manifest = []
+
+    # Closes the current part and records its items, unless a fixity failure left it as a .partial archive.
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            failed = self.current.failed
+            self.current = None
+            if failed:
+                self.pending = []
+                self.manifest = []
+        self.flush()
+
+
+# Package split into shards of at most max_items items and max_bytes bytes (0 for no limit), each a
+# self-contained SAF archive named <archive>_shard001.zip, <archive>_shard002.zip, ... (directories without .zip).
+# Planned items are added in item order and a shard is cut as soon as the next item would overflow it, so every
+# shard holds a contiguous run of item numbers; an item larger than max_bytes gets a shard of its own.
+# Shards are written elsewhere (see CairnProcessor.export_sharded) and recorded here whole, with one fixity
+# manifest per shard. Shard names holding completed items are never reused, so resumed runs add new shards.
+class ShardedPackage:
+    def __init__(self, journal, collection, output, archive_path, max_items=0, max_bytes=0):
+        self.journal = journal
+        self.collection = collection
+        self.output = output
+        self.archive_path = archive_path
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.used = journal.archives(collection)
+        self.shards = 0
+        self.plans = []
+        self.size = 0
+
+    # Adds a planned item, returning the (archive, plans) shard it closed, or None.
+    def add(self, plan):
+        size = plan_size(plan)
+        shard = None
+        if self.plans and ((self.max_items and len(self.plans) >= self.max_items)
+                           or (self.max_bytes and self.size + size > self.max_bytes)):
+            shard = self.cut()
+        self.plans.append(plan)
+        self.size += size
+        return shard
+
+    # Closes the current shard, returning (archive, plans), or None when it is empty.
+    def cut(self):
+        if not self.plans:
+            return None
+        shard = (self.next_archive(), self.plans)
+        self.plans = []
+        self.size = 0
+        return shard
+
+    def next_archive(self):
+        base = os.path.basename(self.archive_path)
+        suffix = '' if self.output == 'directory' else '.zip'
+        while True:
+            self.shards += 1
+            archive = f"{base}_shard{self.shards:03d}{suffix}"
+            if archive not in self.used:
+                return archive
+
+    # Gets the path to open a shard's writer on; SafWriter.open_writer adds .zip itself.
+    def path(self, archive):
+        name = archive[:-len('.zip')] if archive.endswith('.zip') else archive
+        return f"{os.path.dirname(self.archive_path)}/{name}"
+
+    # Records the items written into a shard and writes its fixity manifest, <archive>.fixity.tsv.
+    def record(self, archive, plans):
+        self.journal.mark_done(self.collection, [(plan['pid'], plan_hash(plan), plan.get('last_modified'),
+                                                  plan.get('foxml_mtime')) for plan in plans], archive)
+        fixity = [entry for plan in plans for entry in plan.get('fixity', ())]
+        if fixity:
+            SW.write_fixity_manifest(f"{os.path.dirname(self.archive_path)}/{archive}.fixity.tsv", fixity)
+
+    def fail(self, pid, error):
+        self.journal.mark_failed(self.collection, pid, error)
@@ -0,0 +1,149 @@
+import cProfile
+import io
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+# Order of stages in the summary table; other stages follow alphabetically.
+STAGE_ORDER = ('db_query', 'resolve', 'foxml_parse', 'transform', 'book_plan', 'copy', 'zip', 'journal')
+
+
+# Adds the time spent in the block to timings[stage].
+# Works on a plain dict so timings can be taken in pool workers and shipped back with the item's plan.
+@contextmanager
+def timed(timings, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+# Collects per-item and per-stage timings, byte and item counters and failures by reason for an export run.
+# Every item (and every run-level stage sample) is appended to an optional JSONL file as it completes, tagged with
+# an id for the run, as several runs may append to one file; report() prints a p50/p95/p99 summary per stage.
+class ExportMetrics:
+    def __init__(self, path=None):
+        self.samples = {}
+        self.counters = Counter()
+        self.failures = Counter()
+        self.lock = threading.Lock()
+        self.file = open(path, 'a') if path else None
+        self.run = uuid.uuid4().hex[:12]
+
+    # Appends a record to the JSONL file. Run-level stages may be timed on pipeline threads, so writes are locked.
+    def emit(self, record):
+        if self.file:
+            record['run'] = self.run
+            with self.lock:
+                self.file.write(json.dumps(record) + '\n')
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    # Times a run-level stage such as a database query.
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.add(stage, seconds)
+            self.emit({'stage': stage, 'seconds': round(seconds, 6), 'time': time.time()})
+
+    def item_done(self, plan):
+        timings = plan.get('timings', {})
+        for stage, seconds in timings.items():
+            self.add(stage, seconds)
+        self.counters['items'] += 1
+        self.counters['bytes'] += plan.get('bytes', 0)
+        self.counters['streams'] += len(plan['streams'])
+        self.counters['books'] += len(plan['books'])
+        self.emit({'pid': plan['pid'],
+                   'item': plan['item'],
+                   'status': 'done',
+                   'bytes': plan.get('bytes', 0),
+                   'streams': len(plan['streams']),
+                   'timings': {stage: round(seconds, 6) for stage, seconds in timings.items()},
+                   'time': time.time()})
+
+    def item_failed(self, pid, error):
+        reason = type(error).__name__
+        self.counters['failed'] += 1
+        self.failures[reason] += 1
+        self.emit({'pid': pid, 'status': 'failed', 'reason': reason, 'error': str(error), 'time': time.time()})
+
+    # Gets count, total and p50/p95/p99/max seconds per stage.
+    def summary(self):
+        stages = sorted(self.samples, key=lambda stage: (STAGE_ORDER.index(stage) if stage in STAGE_ORDER
+                                                         else len(STAGE_ORDER), stage))
+        summary = {}
+        for stage in stages:
+            ordered = sorted(self.samples[stage])
+            summary[stage] = {'count': len(ordered),
+                              'total': sum(ordered),
+                              'p50': percentile(ordered, 0.50),
+                              'p95': percentile(ordered, 0.95),
+                              'p99': percentile(ordered, 0.99),
+                              'max': ordered[-1]}
+        return summary
+
+    def report(self):
+        summary = self.summary()
+        print(f"{'stage':<14}{'count':>8}{'total s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for stage, row in summary.items():
+            print(f"{stage:<14}{row['count']:>8}{row['total']:>10.2f}{row['p50'] * 1000:>10.1f}"
+                  f"{row['p95'] * 1000:>10.1f}{row['p99'] * 1000:>10.1f}{row['max'] * 1000:>10.1f}")
+        print(f"Items: {self.counters['items']}, datastreams: {self.counters['streams']}, "
+              f"books: {self.counters['books']}, bytes written: {self.counters['bytes']}")
+        for reason, count in self.failures.most_common():
+            print(f"Failures ({reason}): {count}")
+        self.emit({'summary': summary, 'counters': dict(self.counters), 'failures': dict(self.failures)})
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+# Profiles the block with cProfile, and optionally tracemalloc, printing the top entries and saving the
+# cProfile stats to path (readable with pstats or snakeviz) when given.
+# cProfile follows only the calling thread; tracemalloc covers the whole process.
+@contextmanager
+def profiled(label, path=None, memory=False, limit=25):
+    profile = cProfile.Profile()
+    if memory:
+        tracemalloc.start(25)
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        output = io.StringIO()
+        stats = pstats.Stats(profile, stream=output).sort_stats('cumulative')
+        stats.print_stats(limit)
+        print(f"Profile of {label}")
+        print(output.getvalue())
+        if path:
+            stats.dump_stats(path)
+            print(f"Profile saved to {path}")
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"Memory: {current / 1024 ** 2:.1f} MB current, {peak / 1024 ** 2:.1f} MB peak")
+            for stat in snapshot.statistics('lineno')[:limit]:
+                print(stat)
@@ -0,0 +1,107 @@
+import queue
+import threading
+
+# Marks the end of a stage's input.
+DONE = object()
+
+
+# One step of a pipeline: a function that updates a work dict in place, run by a number of threads.
+class Stage:
+    def __init__(self, name, function, workers=1):
+        self.name = name
+        self.function = function
+        self.workers = max(1, workers)
+
+
+# Runs work items through a chain of thread stages connected by bounded queues.
+# Each item is a dict passed from stage to stage; a stage that raises records the error on the item, and
+# later stages pass it through untouched. Results are yielded to the caller in input order, so the final
+# step (for example writing into a zip) runs on the calling thread without reordering.
+# At most `window` items are in flight at once, which bounds memory however uneven the stages are:
+# a slow stage blocks its upstream queue, and a slow item holds back new input instead of letting
+# finished items pile up behind it.
+class Pipeline:
+    def __init__(self, stages, window=32, capacity=4):
+        self.stages = stages
+        self.window = max(1, window)
+        self.capacity = max(1, capacity)
+
+    def run(self, items):
+        queues = [queue.Queue(self.capacity) for _ in range(len(self.stages) + 1)]
+        slots = threading.Semaphore(self.window)
+        cancelled = threading.Event()
+        feed_errors = []
+        threads = [threading.Thread(target=self.feed, args=(items, queues[0], slots, cancelled, feed_errors),
+                                    daemon=True)]
+        for position, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            lock = threading.Lock()
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(target=self.work,
+                                                args=(stage, queues[position], queues[position + 1],
+                                                      remaining, lock, cancelled),
+                                                name=stage.name, daemon=True))
+        for thread in threads:
+            thread.start()
+        results = queues[-1]
+        pending = {}
+        next_index = 0
+        entry = None
+        try:
+            while True:
+                entry = results.get()
+                if entry is DONE:
+                    break
+                index, work = entry
+                pending[index] = work
+                while next_index in pending:
+                    work = pending.pop(next_index)
+                    next_index += 1
+                    slots.release()
+                    yield work
+            if feed_errors:
+                raise feed_errors[0]
+        finally:
+            # Stop feeding and drain whatever is still in flight so every thread exits.
+            cancelled.set()
+            slots.release(len(pending) + 1)
+            while entry is not DONE:
+                entry = results.get()
+                slots.release()
+            for thread in threads:
+                thread.join()
+
+    # Feeds items into the first stage. An error raised by the items iterator ends the input and is raised
+    # to the caller once the items before it have been yielded.
+    def feed(self, items, outbox, slots, cancelled, errors):
+        try:
+            for index, work in enumerate(items):
+                slots.acquire()
+                if cancelled.is_set():
+                    break
+                outbox.put((index, work))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            outbox.put(DONE)
+
+    # Runs one thread of a stage. The last thread of a stage to finish passes the end marker on.
+    def work(self, stage, inbox, outbox, remaining, lock, cancelled):
+        while True:
+            entry = inbox.get()
+            if entry is DONE:
+                inbox.put(DONE)
+                break
+            index, work = entry
+            if 'error' not in work and not cancelled.is_set():
+                try:
+                    stage.function(work)
+                except Exception as e:
+                    work['error'] = e
+                    work['failed_stage'] = stage.name
+            outbox.put((index, work))
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            outbox.put(DONE)
@@ -0,0 +1,182 @@
+import json
+import os
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+
+import FoxmlWorker as FW
+import PathResolver as PR
+import RelationshipGraph as RG
+
+# Objects surveyed per worker task.
+SURVEY_BATCH = 200
+
+
+# Dry run of a collection export: walks the collection graph as process_collection does, then reads each
+# object's FOXML and stats the datastreams the export would copy, in worker processes, without writing anything.
+# The plan counts items, books and pages, bytes per MIME type, missing objects and datastreams (which would fail
+# with "No record found" or FileNotFoundError) and MIME types missing from mimemap (which would fail with
+# KeyError). Given the metrics file of an earlier export, it also estimates the runtime.
+class ExportPlanner:
+    def __init__(self, processor, workers=None):
+        self.processor = processor
+        self.workers = workers or os.cpu_count()
+        self.settings = {'objectStore': processor.objectStore,
+                         'datastreamStore': processor.datastreamStore,
+                         'hash_pattern': processor.ca.resolver.pattern,
+                         'mimemap': processor.mimemap}
+
+    # Yields (pid, datastream IDs to copy, whether the object is an item) for every object the export reads.
+    # Book pages are surveyed for their OBJ, as plan_book copies it into the book zip.
+    def objects(self, table, collection):
+        stream_map = self.processor.stream_map
+        for pid, model in self.processor.ca.iter_collection_members(table, collection):
+            self.counts['items'] += 1
+            self.models[model] += 1
+            yield pid, stream_map.get(model, []), True
+            if model == RG.BOOK_MODEL:
+                self.counts['books'] += 1
+                for page in self.processor.ca.get_pages(table, pid):
+                    self.counts['pages'] += 1
+                    yield page, ['OBJ'], False
+
+    def plan(self, table, collection, metrics_path=None):
+        self.counts = Counter()
+        self.models = Counter()
+        mimetypes = {}
+        unknown = Counter()
+        missing_objects = []
+        missing_datastreams = []
+        objects = self.objects(table, collection)
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            running = set()
+            finished = []
+            while True:
+                batch = list(islice(objects, SURVEY_BATCH))
+                if batch:
+                    running.add(executor.submit(survey_objects, self.settings, batch))
+                if running and (not batch or len(running) >= self.workers * 2):
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    finished.extend(done)
+                if not batch and not running:
+                    break
+            for future in finished:
+                survey = future.result()
+                self.counts.update(survey['counts'])
+                for mimetype, (count, size) in survey['mimetypes'].items():
+                    totals = mimetypes.setdefault(mimetype, [0, 0])
+                    totals[0] += count
+                    totals[1] += size
+                unknown.update(survey['unknown'])
+                missing_objects.extend(survey['missing_objects'])
+                missing_datastreams.extend(survey['missing_datastreams'])
+        plan = {'collection': collection,
+                'items': self.counts['items'],
+                'books': self.counts['books'],
+                'pages': self.counts['pages'],
+                'models': dict(self.models),
+                'datastreams': self.counts['datastreams'],
+                'bytes': sum(size for count, size in mimetypes.values()),
+                'foxml_bytes': self.counts['foxml_bytes'],
+                'mimetypes': {mimetype: {'count': count, 'bytes': size}
+                              for mimetype, (count, size) in sorted(mimetypes.items())},
+                'unknown_mimetypes': dict(unknown),
+                'missing_objects': sorted(missing_objects),
+                'missing_datastreams': sorted(missing_datastreams)}
+        model = throughput_model(metrics_path) if metrics_path else None
+        if model:
+            plan['estimated_seconds'] = round((plan['items'] * model['overhead'] + plan['bytes'] * model['per_byte'])
+                                              / model['concurrency'], 1)
+        return plan
+
+    def report(self, plan):
+        print(f"Collection {plan['collection']}: {plan['items']} items ({plan['books']} books, "
+              f"{plan['pages']} pages), {plan['datastreams']} datastreams, {plan['bytes'] / 1024 ** 3:.2f} GB")
+        print(f"{'MIME type':<60}{'count':>10}{'GB':>12}")
+        for mimetype, row in plan['mimetypes'].items():
+            print(f"{mimetype:<60}{row['count']:>10}{row['bytes'] / 1024 ** 3:>12.3f}")
+        for mimetype, count in plan['unknown_mimetypes'].items():
+            print(f"Unknown MIME type {mimetype}: {count} datastreams")
+        print(f"Missing objects: {len(plan['missing_objects'])}")
+        for pid in plan['missing_objects']:
+            print(f"  {pid}")
+        print(f"Missing datastreams: {len(plan['missing_datastreams'])}")
+        for pid, dsid in plan['missing_datastreams']:
+            print(f"  {pid} {dsid}")
+        if 'estimated_seconds' in plan:
+            seconds = plan['estimated_seconds']
+            print(f"Estimated runtime: {seconds:.0f} seconds ({seconds / 3600:.2f} hours)")
+
+
+# Reads FOXML and stats datastreams of (pid, datastream IDs, is item) entries.
+def survey_objects(settings, entries):
+    pattern = settings['hash_pattern']
+    resolver = PR.resolver if pattern == PR.resolver.pattern else PR.PathResolver(pattern)
+    mimemap = settings['mimemap']
+    counts = Counter()
+    mimetypes = {}
+    unknown = Counter()
+    missing_objects = []
+    missing_datastreams = []
+    for pid, dsids, item in entries:
+        foxml = f"{settings['objectStore']}/{resolver.resolve(pid)}"
+        try:
+            counts['foxml_bytes'] += os.stat(foxml).st_size
+            file_data = FW.FWorker(foxml).get_file_data()
+        except Exception:
+            missing_objects.append(pid)
+            continue
+        # Items also need their managed MODS for the metadata transform.
+        for dsid in (['MODS'] if item and 'MODS' in file_data else []) + list(dsids):
+            if dsid not in file_data:
+                continue
+            record = file_data[dsid]
+            source = f"{settings['datastreamStore']}/{resolver.resolve(record['filename'])}"
+            try:
+                size = os.stat(source).st_size
+            except OSError:
+                missing_datastreams.append((pid, dsid))
+                continue
+            if dsid == 'MODS' and dsid not in dsids:
+                continue
+            counts['datastreams'] += 1
+            totals = mimetypes.setdefault(record['mimetype'], [0, 0])
+            totals[0] += 1
+            totals[1] += size
+            if record['mimetype'] not in mimemap:
+                unknown[record['mimetype']] += 1
+    return {'counts': counts,
+            'mimetypes': mimetypes,
+            'unknown': unknown,
+            'missing_objects': missing_objects,
+            'missing_datastreams': missing_datastreams}
+
+
+# Fits per-item seconds = overhead + bytes * per_byte to the items of the latest export in a metrics file, and
+# measures how many items that export had in flight at once (busy seconds over wall-clock seconds).
+# Runs appended to the same file are told apart by their run id, so idle time between runs is not counted.
+# Returns None when the latest run holds fewer than two exported items.
+def throughput_model(metrics_path):
+    runs = {}
+    latest = None
+    with open(metrics_path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get('status') == 'done':
+                latest = record.get('run')
+                samples, times = runs.setdefault(latest, ([], []))
+                samples.append((record['bytes'], sum(record['timings'].values())))
+                times.append(record['time'])
+    samples, times = runs.get(latest, ([], []))
+    if len(samples) < 2:
+        return None
+    mean_bytes = sum(size for size, seconds in samples) / len(samples)
+    mean_seconds = sum(seconds for size, seconds in samples) / len(samples)
+    variance = sum((size - mean_bytes) ** 2 for size, seconds in samples)
+    covariance = sum((size - mean_bytes) * (seconds - mean_seconds) for size, seconds in samples)
+    per_byte = max(covariance / variance, 0.0) if variance else 0.0
+    overhead = max(mean_seconds - per_byte * mean_bytes, 0.0)
+    wall = max(times) - min(times)
+    busy = sum(seconds for size, seconds in samples)
+    concurrency = max(busy / wall, 1.0) if wall > 0 else 1.0
+    return {'overhead': overhead, 'per_byte': per_byte, 'concurrency': concurrency}
@@ -1,31 +1,25 @@
-from pathlib import Path
-from urllib.parse import unquote
 import FoxmlWorker
+import PidIndex as PI
 
 
 class FedoraDataWorker:
     def __init__(self):
         self.objectStore = '/usr/local/fedora/data/objectStore/'
         self.test = '/Users/MacIntosh/islandora_workbench'
+        self.pid_index = None
 
     def get_all_pids(self, namespace=''):
-        wildcard = '*/*'
-        if namespace:
-            wildcard = f'*/*{namespace}*'
-        all_pids = []
-        for p in Path(self.objectStore).rglob(wildcard):
-            pid = unquote(p.name).replace('info:fedora/', '')
-            all_pids.append(pid)
-        return all_pids
+        if self.pid_index is None:
+            self.pid_index = PI.PidIndex(self.objectStore)
+        return self.pid_index.get_pids(namespace)
 
     def get_namespaces(self):
-        namespaces = []
-        for pid in self.get_all_pids():
-            namespace = pid.split(':')[0]
-            if namespace not in namespaces:
-                namespaces.append(namespace)
-        return namespaces
+        if self.pid_index is None:
+            self.pid_index = PI.PidIndex(self.objectStore)
+        return self.pid_index.get_namespaces()
 
 
-FD = FedoraDataWorker()
-FD.get_all_pids()
+
+if __name__ == '__main__':
+    FD = FedoraDataWorker()
+    FD.get_all_pids()
@@ -1,12 +1,56 @@
+import copy
+from functools import cached_property
 from pathlib import Path
+from types import MappingProxyType
 
 import lxml.etree as ET
 
+import XsltRegistry as XR
+
+FOXML_NS = '{info:fedora/fedora-system:def/foxml#}'
+DIGITAL_OBJECT = f'{FOXML_NS}digitalObject'
+OBJECT_PROPERTIES = f'{FOXML_NS}objectProperties'
+PROPERTY = f'{FOXML_NS}property'
+DATASTREAM = f'{FOXML_NS}datastream'
+DATASTREAM_VERSION = f'{FOXML_NS}datastreamVersion'
+CONTENT_LOCATION = f'{FOXML_NS}contentLocation'
+CONTENT_DIGEST = f'{FOXML_NS}contentDigest'
+XML_CONTENT = f'{FOXML_NS}xmlContent'
+AUDIT_RECORD = '{info:fedora/fedora-system:def/audit#}record'
+RDF = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}RDF'
+RDF_RESOURCE = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}resource'
+
+# Elements reported by the streaming parser; audit records are included only so they can be discarded one at a time.
+EXTRACTED_TAGS = (DIGITAL_OBJECT, PROPERTY, DATASTREAM, DATASTREAM_VERSION, CONTENT_LOCATION, CONTENT_DIGEST,
+                  XML_CONTENT, AUDIT_RECORD)
+# Elements reported when reading only properties and relationships (see read_relationships).
+RELATIONSHIP_TAGS = (PROPERTY, DATASTREAM, XML_CONTENT, AUDIT_RECORD)
+
+# Inline datastreams whose XML is retained after extraction.
+RETAINED_XML = ('DC', 'RELS-EXT', 'MODS')
+
+
+# Compact record of the latest version of a datastream.
+class DatastreamRecord:
+    __slots__ = ('id', 'control_group', 'state', 'version', 'mimetype', 'filename', 'size', 'digest_type', 'digest')
+
+    def __init__(self, id, control_group=None, state=None):
+        self.id = id
+        self.control_group = control_group
+        self.state = state
+        self.version = None
+        self.mimetype = None
+        self.filename = None
+        self.size = None
+        self.digest_type = None
+        self.digest = None
+
+    def __repr__(self):
+        return f"DatastreamRecord({self.id!r}, {self.mimetype!r}, {self.filename!r})"
+
 
 class FWorker:
     def __init__(self, foxml_file):
-        self.tree = ET.parse(foxml_file)
-        self.root = self.tree.getroot()
         self.namespaces = {
             'foxml': 'info:fedora/fedora-system:def/foxml#',
             'oai_dc': 'http://www.openarchives.org/OAI/2.0/oai_dc/',
@@ -18,80 +62,94 @@ class FWorker:
             'mods': 'http://www.loc.gov/mods/v3'
         }
         self.mods_xsl = 'assets/mods_to_dc.xsl'
-        self.properties = self.get_properties()
+        self.pid = ''
+        self.properties = {}
+        self.streams = {}
+        self.xml_content = {}
+        self.extract(foxml_file)
+
+    # Reads the FOXML in a single streaming pass.
+    # Keeps object properties, the latest version of each datastream and the inline DC, RELS-EXT and MODS,
+    # clearing everything else (audit trails, inline binary content) as soon as it has been read.
+    def extract(self, foxml_file):
+        datastream = None
+        retain = False
+        for event, elem in ET.iterparse(foxml_file, events=('start', 'end'), tag=EXTRACTED_TAGS, huge_tree=True):
+            tag = elem.tag
+            if event == 'start':
+                if tag == DATASTREAM:
+                    datastream = DatastreamRecord(elem.get('ID'), elem.get('CONTROL_GROUP'), elem.get('STATE'))
+                    retain = datastream.id in RETAINED_XML
+                elif tag == DATASTREAM_VERSION:
+                    size = elem.get('SIZE')
+                    datastream.version = elem.get('ID')
+                    datastream.mimetype = elem.get('MIMETYPE')
+                    datastream.size = int(size) if size else None
+                    datastream.digest_type = None
+                    datastream.digest = None
+                elif tag == DIGITAL_OBJECT:
+                    self.pid = elem.get('PID')
+                continue
+
+            if tag == PROPERTY:
+                self.properties[elem.get('NAME').split('#')[1]] = elem.get('VALUE')
+            elif tag == CONTENT_LOCATION:
+                datastream.filename = elem.get('REF')
+            elif tag == CONTENT_DIGEST:
+                datastream.digest_type = elem.get('TYPE')
+                datastream.digest = elem.get('DIGEST')
+            elif tag == XML_CONTENT and retain:
+                self.xml_content[datastream.id] = detach(elem)
+            elif tag == DATASTREAM:
+                self.streams[datastream.id] = datastream
+                datastream = None
+                retain = False
+            elif tag == DIGITAL_OBJECT:
+                continue
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
 
     # Returns PID from foxml
     def get_pid(self):
-        return self.root.attrib['PID']
+        return self.pid
 
     # gets state
     def get_state(self):
         return self.properties['state']
 
     def get_properties(self):
-        values = {}
-        properties = self.root.findall('.//foxml:objectProperties/foxml:property', self.namespaces)
-        for property in properties:
-            name = property.attrib['NAME'].split('#')[1]
-            value = property.attrib['VALUE']
-            values[name] = value
-        return values
+        return self.property_view
 
     # Gets all datastream types from foxml.
     def get_datastreams(self):
-        ns = {'': 'info:fedora/fedora-system:def/foxml#'}
-        datastreams = self.root.findall('.//foxml:datastream', self.namespaces)
-        types = {}
-        for datastream in datastreams:
-            versions = datastream.findall('./foxml:datastreamVersion', self.namespaces)
-            mimetype = versions[-1].attrib['MIMETYPE']
-            types[datastream.attrib['ID']] = mimetype
-        return types
+        return self.datastream_types
+
+    # Gets records for every datastream, keyed by datastream ID.
+    def get_datastream_records(self):
+        return self.datastream_records
 
     # Gets names of current managed files from foxml.
     def get_file_data(self):
-        mapping = {}
-        streams = self.get_datastreams()
-        for stream, mimetype in streams.items():
-            location = self.root.xpath(
-                f'//foxml:datastream[@ID="{stream}"]/foxml:datastreamVersion/foxml:contentLocation',
-                namespaces=self.namespaces)
-            if location:
-                mapping[stream] = {'filename': location[-1].attrib['REF'], 'mimetype': mimetype}
-        return mapping
+        return self.file_data
 
     def get_dc(self):
-        dc_nodes = self.root.findall(
-            f'.//foxml:datastream[@ID="DC"]/foxml:datastreamVersion/foxml:xmlContent/oai_dc:dc',
-            namespaces=self.namespaces)
-        dc_node = dc_nodes[-1]
+        dc_node = self.xml_content['DC'].find('oai_dc:dc', namespaces=self.namespaces)
         return ET.tostring(dc_node, encoding='unicode')
 
     def get_dc_values(self):
-        dc_nodes = self.root.findall(f'.//foxml:datastream[@ID="DC"]/foxml:datastreamVersion/foxml:xmlContent',
-                                     namespaces=self.namespaces)
-        dc_values = []
-        dc_node = dc_nodes[-1]
-        for child in dc_node.iter():
-            if child.text is not None:
-                cleaned = child.text.replace('\n', '')
-                text = ' '.join(cleaned.split())
-                if text:
-                    tag = child.xpath('local-name()')
-                    dc_values.append({tag: text})
-        return dc_values
+        return self.dc_values
 
     # Converts embedded dublin core to dspace dublin core
     def get_modified_dc(self):
-        dc_nodes = self.root.findall(f'.//foxml:datastream[@ID="DC"]/foxml:datastreamVersion/foxml:xmlContent',
-                                     namespaces=self.namespaces)
-        dc_node = dc_nodes[-1]
-        return self.build_dspace_dc(dc_node)
+        return self.modified_dc
 
     # Builds dspace xml from extracted values/
     def build_dspace_dc(self, dc_node):
+        return self.dspace_dc_from_values(self.extract_dc_values(dc_node))
+
+    def dspace_dc_from_values(self, dc_values):
         root = ET.Element("dublin_core")
-        dc_values = self.get_dc_values()
         for candidate in dc_values:
             for key, value in candidate.items():
                 value = value.replace("\\,", '%%%')
@@ -101,47 +159,78 @@ class FWorker:
             ET.indent(root, space="\t", level=0)
         return ET.tostring(root, encoding='unicode')
 
+    # Collects non-empty text values from a DC node, keyed by local tag name.
+    def extract_dc_values(self, dc_node):
+        dc_values = []
+        if dc_node is None:
+            return tuple(dc_values)
+        if isinstance(dc_node, ET._ElementTree):
+            dc_node = dc_node.getroot()
+        for child in dc_node.iter(ET.Element):
+            if child.text is not None:
+                cleaned = child.text.replace('\n', '')
+                text = ' '.join(cleaned.split())
+                if text:
+                    tag = ET.QName(child).localname
+                    dc_values.append(MappingProxyType({tag: text}))
+        return tuple(dc_values)
+
+    @cached_property
+    def property_view(self):
+        return MappingProxyType(self.properties)
+
+    @cached_property
+    def datastream_records(self):
+        return MappingProxyType(self.streams)
+
+    @cached_property
+    def datastream_types(self):
+        return MappingProxyType({stream_id: record.mimetype for stream_id, record in self.streams.items()})
+
+    @cached_property
+    def file_data(self):
+        mapping = {}
+        for stream_id, record in self.streams.items():
+            if record.filename:
+                mapping[stream_id] = MappingProxyType({'filename': record.filename,
+                                                       'mimetype': record.mimetype,
+                                                       'digest_type': record.digest_type,
+                                                       'digest': record.digest})
+        return MappingProxyType(mapping)
+
+    @cached_property
+    def dc_values(self):
+        return self.extract_dc_values(self.xml_content.get('DC'))
+
+    @cached_property
+    def modified_dc(self):
+        return self.dspace_dc_from_values(self.dc_values)
+
+    @cached_property
+    def rels_ext_values(self):
+        return MappingProxyType(relationships(self.xml_content.get('RELS-EXT')))
+
     # Get MODS datastream
     def get_mods(self):
-        data = FW.get_file_data()
-        mods_address = data['MODS']['filename']
+        data = self.get_file_data()
+        return data['MODS']['filename']
 
     def transform_mods_to_dc(self):
         mods_xml = self.get_mods()
         dom = ET.parse(mods_xml)
-        xslt = ET.parse(self.mods_xsl)
-        transform = ET.XSLT(xslt)
-        dc_node = transform(dom)
+        dc_node = XR.registry.apply(self.mods_xsl, dom)
         return self.build_dspace_dc(dc_node)
 
     def get_rels_ext_values(self):
-        re_values = {}
-        re_nodes = self.root.findall(
-            f'.//foxml:datastream[@ID="RELS-EXT"]/foxml:datastreamVersion/foxml:xmlContent/rdf:RDF',
-            namespaces=self.namespaces)
-        re_node = re_nodes[-1]
-        for child in re_node.iter():
-            tag = child.xpath('local-name()')
-            if child.text is not None:
-                cleaned = child.text.replace('info:fedora/', '').replace('\n', '')
-                text = ' '.join(cleaned.split())
-                if text:
-                    re_values[tag] = text
-            resource = child.attrib.get('{http://www.w3.org/1999/02/22-rdf-syntax-ns#}resource')
-            if resource:
-                re_values[tag] = resource.replace('info:fedora/', '')
-        return re_values
+        return self.rels_ext_values
 
     def get_inline_mods(self):
         retval = ''
         try:
-            mods_datastream = self.root.findall(
-                ".//foxml:datastream[@ID='MODS']/foxml:datastreamVersion/foxml:xmlContent/mods:mods",
-                self.namespaces
-            )
-            if not mods_datastream:
+            content = self.xml_content.get('MODS')
+            if content is None:
                 return retval
-            mods_node = mods_datastream[-1]
+            mods_node = content.find('mods:mods', namespaces=self.namespaces)
             if mods_node is not None:
                 retval = ET.tostring(mods_node, encoding='unicode')
 
@@ -151,6 +240,72 @@ class FWorker:
         return retval
 
 
+# Copies retained xmlContent out of the tree being parsed. The copy declares every namespace in scope, including
+# those declared on the digitalObject but unused inside, so its children serialize as they do in the whole FOXML.
+def detach(elem):
+    content = ET.Element(elem.tag, elem.attrib, nsmap=elem.nsmap)
+    content.text = elem.text
+    content.extend(copy.deepcopy(child) for child in elem)
+    return content
+
+
+# Reads only the object properties, stopping as soon as they have been parsed.
+def read_properties(foxml_file):
+    properties = {}
+    with open(foxml_file, 'rb') as f:
+        for event, elem in ET.iterparse(f, events=('end',), tag=(PROPERTY, OBJECT_PROPERTIES)):
+            if elem.tag == OBJECT_PROPERTIES:
+                break
+            properties[elem.get('NAME').split('#')[1]] = elem.get('VALUE')
+    return properties
+
+
+# Reads RELS-EXT relationships, keyed by local name, from a RELS-EXT xmlContent element.
+def relationships(content):
+    re_values = {}
+    if content is None:
+        return re_values
+    re_node = content.find(RDF)
+    for child in re_node.iter(ET.Element):
+        tag = ET.QName(child).localname
+        if child.text is not None:
+            cleaned = child.text.replace('info:fedora/', '').replace('\n', '')
+            text = ' '.join(cleaned.split())
+            if text:
+                re_values[tag] = text
+        resource = child.attrib.get(RDF_RESOURCE)
+        if resource:
+            re_values[tag] = resource.replace('info:fedora/', '')
+    return re_values
+
+
+# Reads only the object properties and the relationships of the latest RELS-EXT version.
+# Parsing stops at the end of the RELS-EXT datastream, so the datastreams after it are never read. Elements before
+# it, audit records included, are discarded as they are read, as FWorker.extract does.
+def read_relationships(foxml_file):
+    properties = {}
+    content = None
+    in_rels = False
+    with open(foxml_file, 'rb') as f:
+        for event, elem in ET.iterparse(f, events=('start', 'end'), tag=RELATIONSHIP_TAGS,
+                                        huge_tree=True):
+            if event == 'start':
+                if elem.tag == DATASTREAM:
+                    in_rels = elem.get('ID') == 'RELS-EXT'
+                continue
+            if elem.tag == PROPERTY:
+                properties[elem.get('NAME').split('#')[1]] = elem.get('VALUE')
+            elif elem.tag == XML_CONTENT and in_rels:
+                content = elem
+                continue
+            elif elem.tag == DATASTREAM and in_rels:
+                break
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        return properties, relationships(content)
+
+
 if __name__ == '__main__':
     FW = FWorker('inputs/sample_foxml.xml')
     print(FW.get_file_data())
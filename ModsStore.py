@@ -0,0 +1,100 @@
+import hashlib
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BATCH_SIZE = 1000
+
+
+# Compressed, content-addressed store of MODS records.
+# Each distinct record is compressed once (zstd when the zstandard package is installed, zlib otherwise) and
+# stored under the SHA-1 of its bytes; PIDs point at a hash, so identical templated records are kept once.
+class ModsStore:
+    def __init__(self, conn, codec=None):
+        self.conn = conn
+        self.codec = codec or ('zstd' if zstandard else 'zlib')
+        if self.codec == 'zstd' and zstandard is None:
+            raise ValueError("The zstd codec needs the zstandard package")
+        self.conn.execute("""
+            CREATE TABLE if not exists mods_content(
+            hash TEXT PRIMARY KEY,
+            codec TEXT,
+            size INTEGER,
+            data BLOB
+            )""")
+        self.conn.execute("""
+            CREATE TABLE if not exists mods_records(
+            pid TEXT PRIMARY KEY,
+            namespace TEXT,
+            hash TEXT
+            )""")
+        self.conn.execute("CREATE INDEX if not exists mods_records_namespace ON mods_records(namespace)")
+        self.conn.commit()
+
+    def compress(self, data):
+        if self.codec == 'zstd':
+            return zstandard.ZstdCompressor(level=10).compress(data)
+        return zlib.compress(data, 9)
+
+    def decompress(self, codec, data):
+        if codec == 'zstd':
+            if zstandard is None:
+                raise ValueError("MODS stored with zstd needs the zstandard package to read")
+            return zstandard.ZstdDecompressor().decompress(data)
+        return zlib.decompress(data)
+
+    # Stores (pid, MODS) records for a namespace in one transaction, written in batches.
+    # Returns counts of records, distinct records added, and raw and compressed bytes added.
+    def ingest(self, namespace, records):
+        counts = {'records': 0, 'added': 0, 'bytes': 0, 'stored': 0}
+        seen = set()
+        contents = []
+        pointers = []
+        with self.conn:
+            for pid, mods in records:
+                if isinstance(mods, str):
+                    mods = mods.encode('utf-8')
+                digest = hashlib.sha1(mods).hexdigest()
+                counts['records'] += 1
+                pointers.append((pid, namespace, digest))
+                if digest not in seen:
+                    seen.add(digest)
+                    if not self.conn.execute("SELECT 1 FROM mods_content WHERE hash = ?", (digest,)).fetchone():
+                        data = self.compress(mods)
+                        contents.append((digest, self.codec, len(mods), data))
+                        counts['added'] += 1
+                        counts['bytes'] += len(mods)
+                        counts['stored'] += len(data)
+                if len(pointers) >= BATCH_SIZE:
+                    self.write(contents, pointers)
+            self.write(contents, pointers)
+        return counts
+
+    def write(self, contents, pointers):
+        self.conn.executemany("INSERT OR IGNORE INTO mods_content VALUES(?, ?, ?, ?)", contents)
+        self.conn.executemany("INSERT OR REPLACE INTO mods_records VALUES(?, ?, ?)", pointers)
+        contents.clear()
+        pointers.clear()
+
+    # Gets the MODS of a PID, or None if it has none.
+    def get(self, pid):
+        row = self.conn.execute("SELECT c.codec, c.data FROM mods_records r JOIN mods_content c ON c.hash = r.hash "
+                                "WHERE r.pid = ?", (pid,)).fetchone()
+        return self.decompress(row[0], row[1]).decode('utf-8') if row else None
+
+    # Yields (pid, MODS) for a namespace, decompressing one record at a time.
+    def iter_records(self, namespace):
+        cursor = self.conn.execute("SELECT r.pid, c.codec, c.data FROM mods_records r "
+                                   "JOIN mods_content c ON c.hash = r.hash WHERE r.namespace = ? ORDER BY r.pid",
+                                   (namespace,))
+        for pid, codec, data in cursor:
+            yield pid, self.decompress(codec, data).decode('utf-8')
+
+    def stats(self):
+        records, = self.conn.execute("SELECT COUNT(*) FROM mods_records").fetchone()
+        distinct, raw, stored = self.conn.execute("SELECT COUNT(*), SUM(size), SUM(LENGTH(data)) "
+                                                  "FROM mods_content").fetchone()
+        return {'records': records, 'distinct': distinct, 'bytes': raw or 0, 'stored': stored or 0}
@@ -0,0 +1,131 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from urllib.parse import quote
+
+DEFAULT_PATTERN = '##'
+# Percent-escapes for ASCII, matching quote(safe='') with '_' escaped as Fedora does.
+ESCAPES = {code: None if chr(code).isalnum() or chr(code) in '.-~' else f"%{code:02X}" for code in range(128)}
+ESCAPES = {code: escape for code, escape in ESCAPES.items() if escape}
+ENCODED_PREFIX = 'info%3Afedora%2F'
+# Identifiers made only of these characters need just ':', '/' and '_' escaped, which is done with replace.
+PLAIN_IDENTIFIER = re.compile(r'[A-Za-z0-9.~:/_-]*\Z').match
+
+
+# URL-encodes an identifier the way Fedora names its store files, e.g. 'ns:1/OBJ/OBJ.0' -> 'ns%3A1%2FOBJ%2FOBJ.0'.
+def encode(identifier):
+    if PLAIN_IDENTIFIER(identifier):
+        return identifier.replace('_', '%5F').replace(':', '%3A').replace('/', '%2F')
+    if identifier.isascii():
+        return identifier.translate(ESCAPES)
+    return quote(identifier, safe='').replace('_', '%5F')
+
+
+# Maps Fedora PIDs and datastream IDs (pid+DSID+version) to their paths in the objectStore/datastreamStore.
+# Follows Fedora 3's hash path algorithm: each '#' of the hash pattern takes the next hex digit of the MD5 of
+# "info:fedora/<id>", and the file name is the URL-encoded id. The pattern ('##', '##/##', ...) is split into
+# slices once, results are kept in an LRU cache, and resolve_many resolves a batch in one tight loop.
+class PathResolver:
+    def __init__(self, pattern=DEFAULT_PATTERN, cache_size=1 << 16):
+        if pattern.count('#') > 32:
+            raise ValueError(f"Hash pattern {pattern} uses more than the 32 digits of an MD5")
+        self.pattern = pattern
+        self.pieces = self.compile(pattern)
+        # Patterns that are a single run of '#' are a plain prefix of the digest.
+        self.width = self.pieces[0].stop if len(self.pieces) == 1 and isinstance(self.pieces[0], slice) else 0
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # Splits a pattern into literal strings and slices of the hex digest.
+    def compile(self, pattern):
+        pieces = []
+        offset = 0
+        position = 0
+        while position < len(pattern):
+            end = position
+            if pattern[position] == '#':
+                while end < len(pattern) and pattern[end] == '#':
+                    end += 1
+                pieces.append(slice(offset, offset + end - position))
+                offset += end - position
+            else:
+                while end < len(pattern) and pattern[end] != '#':
+                    end += 1
+                pieces.append(pattern[position:end])
+            position = end
+        return pieces
+
+    def compute(self, identifier):
+        slashed = identifier.replace('+', '/')
+        digest = hashlib.md5(f"info:fedora/{slashed}".encode('utf-8')).hexdigest()
+        if self.width:
+            directory = digest[:self.width]
+        else:
+            directory = ''.join(digest[piece] if isinstance(piece, slice) else piece for piece in self.pieces)
+        return f"{directory}/{ENCODED_PREFIX}{encode(slashed)}"
+
+    # Returns the path of an identifier relative to its store.
+    def resolve(self, identifier):
+        with self.lock:
+            path = self.cache.get(identifier)
+            if path is not None:
+                self.cache.move_to_end(identifier)
+                self.hits += 1
+                return path
+        path = self.compute(identifier)
+        self.store({identifier: path})
+        return path
+
+    # Resolves many identifiers at once, returning {identifier: path}. Duplicates are resolved once.
+    def resolve_many(self, identifiers):
+        paths = {}
+        missing = []
+        with self.lock:
+            for identifier in identifiers:
+                if identifier in paths:
+                    continue
+                path = self.cache.get(identifier)
+                if path is None:
+                    missing.append(identifier)
+                    paths[identifier] = None
+                else:
+                    self.hits += 1
+                    paths[identifier] = path
+        compute = self.compute
+        resolved = {identifier: compute(identifier) for identifier in missing}
+        self.store(resolved)
+        paths.update(resolved)
+        return paths
+
+    # Adds resolved paths to the cache, evicting the least recently used.
+    def store(self, paths):
+        with self.lock:
+            self.misses += len(paths)
+            self.cache.update(paths)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    # Saves cached paths into a PID index, so later runs can preload them.
+    def persist(self, index):
+        with self.lock:
+            entries = list(self.cache.items())
+        index.save_resolved_paths(self.pattern, entries)
+
+    # Fills the cache with paths saved in a PID index for this pattern.
+    def preload(self, index, limit=None):
+        entries = index.load_resolved_paths(self.pattern, limit or self.cache_size)
+        with self.lock:
+            self.cache.update(entries)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return len(entries)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'cached': len(self.cache)}
+
+
+resolver = PathResolver()
@@ -0,0 +1,208 @@
+import argparse
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import unquote
+
+import FoxmlWorker as FW
+
+# State recorded for FOXML files that cannot be parsed, counted apart from inactive objects.
+UNREADABLE = 'Unreadable'
+
+
+# On-disk index of the FOXML files in a Fedora objectStore.
+# Built on first use, then refreshed incrementally when asked: only the levels of directories above the hash
+# directories are listed, and only hash directories whose mtime has changed are re-scanned. Lookups read the index
+# as it stands unless called with refresh=True.
+class PidIndex:
+    def __init__(self, object_store='/usr/local/fedora/data/objectStore', database='cairn.db', hash_pattern='##'):
+        self.objectStore = object_store.rstrip('/')
+        # Hash directories sit this many levels below the store, e.g. 2 for '##/##'.
+        self.depth = hash_pattern.count('/') + 1
+        self.conn = sqlite3.connect(database)
+        self.conn.execute("""
+            CREATE TABLE if not exists objectstore_index(
+            pid TEXT PRIMARY KEY,
+            namespace TEXT,
+            hash_dir TEXT,
+            path TEXT,
+            mtime INTEGER,
+            size INTEGER,
+            state TEXT,
+            managed_bytes INTEGER
+            )""")
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(objectstore_index)")]
+        if 'state' not in columns:
+            self.conn.execute("ALTER TABLE objectstore_index ADD COLUMN state TEXT")
+            self.conn.execute("ALTER TABLE objectstore_index ADD COLUMN managed_bytes INTEGER")
+        self.conn.execute("""
+            CREATE TABLE if not exists objectstore_dirs(
+            hash_dir TEXT PRIMARY KEY,
+            mtime INTEGER
+            )""")
+        self.conn.execute("""
+            CREATE TABLE if not exists resolved_paths(
+            identifier TEXT,
+            pattern TEXT,
+            path TEXT,
+            PRIMARY KEY (identifier, pattern)
+            )""")
+        self.conn.execute("CREATE INDEX if not exists objectstore_index_namespace ON objectstore_index(namespace)")
+        self.conn.execute("CREATE INDEX if not exists objectstore_index_hash_dir ON objectstore_index(hash_dir)")
+        self.conn.commit()
+
+    # Re-scans hash directories that are new or have changed since the last refresh.
+    # Set full to re-scan every directory regardless of mtime.
+    def refresh(self, full=False):
+        start = time.time()
+        known = dict(self.conn.execute("SELECT hash_dir, mtime FROM objectstore_dirs"))
+        seen = set()
+        scanned = 0
+        with self.conn:
+            for hash_dir, entry in self.hash_directories(self.objectStore):
+                seen.add(hash_dir)
+                mtime = entry.stat().st_mtime_ns
+                if not full and known.get(hash_dir) == mtime:
+                    continue
+                self.conn.execute("DELETE FROM objectstore_index WHERE hash_dir = ?", (hash_dir,))
+                self.conn.executemany("INSERT OR REPLACE INTO objectstore_index "
+                                      "(pid, namespace, hash_dir, path, mtime, size) VALUES(?, ?, ?, ?, ?, ?)",
+                                      self.scan_directory(hash_dir, entry))
+                self.conn.execute("INSERT OR REPLACE INTO objectstore_dirs VALUES(?, ?)", (hash_dir, mtime))
+                scanned += 1
+            for hash_dir in set(known) - seen:
+                self.conn.execute("DELETE FROM objectstore_index WHERE hash_dir = ?", (hash_dir,))
+                self.conn.execute("DELETE FROM objectstore_dirs WHERE hash_dir = ?", (hash_dir,))
+        return {'scanned': scanned, 'directories': len(seen), 'seconds': round(time.time() - start, 2)}
+
+    # Yields (path relative to the store, entry) for every hash directory, so nested hash patterns such as
+    # '##/##' are indexed one leaf directory at a time. Hash directories themselves are not listed here.
+    def hash_directories(self, path, prefix='', depth=None):
+        depth = self.depth if depth is None else depth
+        for entry in os.scandir(path):
+            if entry.is_dir():
+                name = f"{prefix}{entry.name}"
+                if depth == 1:
+                    yield name, entry
+                else:
+                    yield from self.hash_directories(entry.path, f"{name}/", depth - 1)
+
+    # Builds the index when it has never been refreshed, or refreshes it when refresh is set.
+    def ensure(self, refresh=False):
+        if refresh or not self.conn.execute("SELECT 1 FROM objectstore_dirs LIMIT 1").fetchone():
+            self.refresh()
+
+    # Yields index rows for every FOXML file in a hash directory.
+    def scan_directory(self, hash_dir, directory):
+        for entry in os.scandir(directory.path):
+            if not entry.is_file():
+                continue
+            pid = unquote(entry.name).replace('info:fedora/', '')
+            stat = entry.stat()
+            yield pid, pid.split(':')[0], hash_dir, entry.path, stat.st_mtime_ns, stat.st_size
+
+    # Gets PIDs, optionally restricted to a namespace.
+    def get_pids(self, namespace='', refresh=False):
+        self.ensure(refresh)
+        return list(self.iter_pids(namespace))
+
+    # Yields PIDs, in PID order, from a cursor over the index rather than a list.
+    def iter_pids(self, namespace='', refresh=False):
+        self.ensure(refresh)
+        if namespace:
+            rows = self.conn.execute("SELECT pid FROM objectstore_index WHERE namespace = ? ORDER BY pid", (namespace,))
+        else:
+            rows = self.conn.execute("SELECT pid FROM objectstore_index ORDER BY pid")
+        for row in rows:
+            yield row[0]
+
+    # Gets FOXML path for a PID, or None if it is not in the index.
+    def get_path(self, pid):
+        row = self.conn.execute("SELECT path FROM objectstore_index WHERE pid = ?", (pid,)).fetchone()
+        return row[0] if row else None
+
+    # Saves (identifier, path) pairs resolved with a hash pattern.
+    def save_resolved_paths(self, pattern, entries):
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO resolved_paths VALUES(?, ?, ?)",
+                                  ((identifier, pattern, path) for identifier, path in entries))
+
+    # Gets up to limit saved paths for a hash pattern, topped up with the FOXML paths found by scanning,
+    # which hold whatever pattern the objectStore was written with.
+    def load_resolved_paths(self, pattern, limit=-1):
+        rows = self.conn.execute("SELECT identifier, path FROM resolved_paths WHERE pattern = ? LIMIT ?",
+                                 (pattern, limit))
+        paths = dict(rows)
+        if limit < 0 or len(paths) < limit:
+            prefix = len(self.objectStore) + 1
+            rows = self.conn.execute("SELECT pid, substr(path, ?) FROM objectstore_index LIMIT ?",
+                                     (prefix + 1, limit - len(paths) if limit >= 0 else -1))
+            for pid, path in rows:
+                paths.setdefault(pid, path)
+        return paths
+
+    # Gets all namespaces in the index.
+    def get_namespaces(self, refresh=False):
+        self.ensure(refresh)
+        return [row[0] for row in self.conn.execute("SELECT DISTINCT namespace FROM objectstore_index ORDER BY 1")]
+
+    # Counts objects, active, inactive and unreadable objects and managed datastream bytes per namespace.
+    # State and sizes are read from FOXML only for entries not yet described, one hash directory per task.
+    def census(self, workers=None, refresh=False):
+        self.ensure(refresh)
+        pending = {}
+        command = "SELECT hash_dir, pid, path FROM objectstore_index WHERE state IS NULL"
+        for hash_dir, pid, path in self.conn.execute(command):
+            pending.setdefault(hash_dir, []).append((pid, path))
+        if pending:
+            with ProcessPoolExecutor(max_workers=workers) as executor, self.conn:
+                for rows in executor.map(describe_objects, pending.values()):
+                    self.conn.executemany("UPDATE objectstore_index SET state = ?, managed_bytes = ? WHERE pid = ?",
+                                          rows)
+        command = """SELECT namespace, COUNT(*), SUM(state = 'Active'), SUM(state NOT IN ('Active', ?)),
+                     SUM(state = ?), SUM(managed_bytes)
+                     FROM objectstore_index GROUP BY namespace ORDER BY namespace"""
+        census = {}
+        for namespace, objects, active, inactive, unreadable, managed_bytes in self.conn.execute(
+                command, (UNREADABLE, UNREADABLE)):
+            census[namespace] = {'objects': objects,
+                                 'active': active,
+                                 'inactive': inactive,
+                                 'unreadable': unreadable,
+                                 'managed_bytes': managed_bytes}
+        return census
+
+
+# Reads state and total managed datastream bytes from each FOXML file.
+def describe_objects(objects):
+    rows = []
+    for pid, path in objects:
+        try:
+            fw = FW.FWorker(path)
+        except Exception:
+            rows.append((UNREADABLE, 0, pid))
+            continue
+        managed_bytes = 0
+        for record in fw.get_datastream_records().values():
+            if record.control_group == 'M' and record.size:
+                managed_bytes += record.size
+        rows.append((fw.properties.get('state', 'Unknown'), managed_bytes, pid))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintain and query the objectStore PID index.')
+    parser.add_argument('command', choices=['refresh', 'census'])
+    parser.add_argument('--object-store', default='/usr/local/fedora/data/objectStore')
+    parser.add_argument('--database', default='cairn.db')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--hash-pattern', default='##')
+    args = parser.parse_args()
+    if args.command == 'refresh':
+        print(PidIndex(args.object_store, args.database, args.hash_pattern).refresh(full=True))
+    else:
+        import CairnCli
+        CairnCli.main(['census', '--refresh', '--object-store', args.object_store, '--database', args.database,
+                       '--hash-pattern', args.hash_pattern]
+                      + (['--workers', str(args.workers)] if args.workers else []))
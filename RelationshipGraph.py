@@ -0,0 +1,206 @@
+import sqlite3
+import threading
+from array import array
+from collections import deque
+from contextlib import nullcontext
+
+COLLECTION_MODEL = 'islandora:collectionCModel'
+BOOK_MODEL = 'islandora:bookCModel'
+RELATIONS = ('collection_pid', 'page_of', 'constituent_of')
+# Collection members read per indexed query when walking an institution table.
+MEMBER_PAGE = 1000
+
+
+# Compact in-memory copy of an institution table.
+# PIDs are interned to integers and each relation is stored as CSR child arrays (offsets + targets),
+# so collection, book and page traversals never go back to SQLite.
+class RelationshipGraph:
+    def __init__(self, conn, table):
+        self.table = table
+        self.pids = []
+        self.ids = {}
+        self.models = ['']
+        self.model_codes = {'': 0}
+        self.node_models = array('H')
+        self.sequences = array('q')
+        self.offsets = {}
+        self.targets = {}
+        self.load(conn, table)
+
+    # Returns node id for a PID, adding it if unseen.
+    def intern(self, pid):
+        node = self.ids.get(pid)
+        if node is None:
+            node = len(self.pids)
+            self.ids[pid] = node
+            self.pids.append(pid)
+            self.node_models.append(0)
+            self.sequences.append(0)
+        return node
+
+    def model_code(self, model):
+        code = self.model_codes.get(model)
+        if code is None:
+            code = len(self.models)
+            self.model_codes[model] = code
+            self.models.append(model)
+        return code
+
+    # Reads the table once and builds a child array per relation.
+    def load(self, conn, table):
+        parents = {relation: array('L') for relation in RELATIONS}
+        children = {relation: array('L') for relation in RELATIONS}
+        command = f"SELECT pid, content_model, collection_pid, page_of, sequence, constituent_of FROM {table}"
+        for pid, model, *values in conn.execute(command):
+            node = self.intern(pid)
+            self.node_models[node] = self.model_code(model or '')
+            self.sequences[node] = page_sequence(values[2])
+            for relation, parent in zip(RELATIONS, (values[0], values[1], values[3])):
+                if parent and parent.strip():
+                    parents[relation].append(self.intern(parent.strip()))
+                    children[relation].append(node)
+        for relation in RELATIONS:
+            self.offsets[relation], self.targets[relation] = self.build_csr(parents[relation], children[relation])
+
+    # Packs (parent, child) edges into offsets/targets arrays, keeping table order within each parent.
+    def build_csr(self, parents, children):
+        offsets = array('L', bytes(array('L').itemsize * (len(self.pids) + 1)))
+        for parent in parents:
+            offsets[parent + 1] += 1
+        for node in range(len(self.pids)):
+            offsets[node + 1] += offsets[node]
+        cursor = array('L', offsets)
+        targets = array('L', bytes(array('L').itemsize * len(children)))
+        for parent, child in zip(parents, children):
+            targets[cursor[parent]] = child
+            cursor[parent] += 1
+        return offsets, targets
+
+    def model_of(self, node):
+        return self.models[self.node_models[node]]
+
+    # Gets child node ids of a PID for a relation.
+    def child_nodes(self, relation, pid):
+        node = self.ids.get(pid)
+        if node is None:
+            return []
+        offsets = self.offsets[relation]
+        return self.targets[relation][offsets[node]:offsets[node + 1]]
+
+    def get_collection_pids(self, collection):
+        return list(self.iter_collection_pids(collection))
+
+    # Yields the direct members of a collection in table order.
+    def iter_collection_pids(self, collection):
+        node = self.ids.get(collection)
+        if node is None:
+            return
+        offsets = self.offsets['collection_pid']
+        targets = self.targets['collection_pid']
+        for position in range(offsets[node], offsets[node + 1]):
+            yield self.pids[targets[position]]
+
+    def get_collection_pid_model_map(self, collection):
+        return {self.pids[node]: self.model_of(node) for node in self.child_nodes('collection_pid', collection)}
+
+    def get_subcollections(self, collection):
+        code = self.model_codes.get(COLLECTION_MODEL)
+        return [self.pids[node] for node in self.child_nodes('collection_pid', collection)
+                if self.node_models[node] == code]
+
+    def get_books(self, collection):
+        code = self.model_codes.get(BOOK_MODEL)
+        return [self.pids[node] for node in self.child_nodes('collection_pid', collection)
+                if self.node_models[node] == code]
+
+    # Gets pages of a book ordered by sequence number.
+    def get_pages(self, book_pid):
+        nodes = sorted(self.child_nodes('page_of', book_pid), key=lambda node: (self.sequences[node], node))
+        return [self.pids[node] for node in nodes]
+
+    def get_constituents(self, parent_pid):
+        return [self.pids[node] for node in self.child_nodes('constituent_of', parent_pid)]
+
+    # Gets every non-collection descendant of a collection, walking sub-collections breadth first.
+    def get_collection_recursive_pid_model_map(self, collection_pid):
+        return dict(self.iter_collection_members(collection_pid))
+
+    # Yields (pid, model) for every non-collection descendant of a collection, breadth first and in table order
+    # within each collection. Items in several sub-collections are yielded once, where first reached.
+    # Only a byte per node and the queue of sub-collections are held, whatever the size of the collection.
+    def iter_collection_members(self, collection_pid):
+        code = self.model_codes.get(COLLECTION_MODEL)
+        offsets = self.offsets['collection_pid']
+        targets = self.targets['collection_pid']
+        start = self.ids.get(collection_pid)
+        if start is None:
+            return
+        visited = bytearray(len(self.pids))
+        visited[start] = 1
+        queue = deque([start])
+        while queue:
+            parent = queue.popleft()
+            for position in range(offsets[parent], offsets[parent + 1]):
+                node = targets[position]
+                if visited[node]:
+                    continue
+                visited[node] = 1
+                if self.node_models[node] == code:
+                    queue.append(node)
+                else:
+                    yield self.pids[node], self.model_of(node)
+
+
+# Indexed queries over an institution table, for walks that should not load the whole table into a
+# RelationshipGraph: memory follows the collection walked, not the table. Members and pages come back in the
+# same order as from the graph. Queries use a connection of their own, guarded by a lock, so walks and page
+# lookups can run on pipeline threads; no cursor is held open between yields. Given ExportMetrics, walks time
+# each query as a db_query stage.
+class TableRelations:
+    def __init__(self, conn, table):
+        self.table = table
+        path = conn.execute("PRAGMA database_list").fetchone()[2]
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False) if path else conn
+        self.lock = threading.Lock()
+
+    def query(self, command, parameters, metrics=None):
+        with self.lock, metrics.timer('db_query') if metrics else nullcontext():
+            return self.conn.execute(command, parameters).fetchall()
+
+    # Yields (pid, model) of the direct members of a collection in table order, MEMBER_PAGE rows per query.
+    def collection_members(self, collection, metrics=None):
+        last = -1
+        while True:
+            rows = self.query(f"SELECT rowid, pid, content_model FROM {self.table} WHERE collection_pid = ? "
+                              f"AND rowid > ? ORDER BY rowid LIMIT {MEMBER_PAGE}", (collection, last), metrics)
+            for last, pid, model in rows:
+                yield pid, model
+            if len(rows) < MEMBER_PAGE:
+                return
+
+    # Yields (pid, model) for every non-collection descendant of a collection, as
+    # RelationshipGraph.iter_collection_members does, paging through the collection_pid index of each
+    # sub-collection. A PID has a single collection_pid row, so only collections are tracked, to stop cycles.
+    def iter_collection_members(self, collection_pid, metrics=None):
+        visited = {collection_pid}
+        queue = deque([collection_pid])
+        while queue:
+            for pid, model in self.collection_members(queue.popleft(), metrics):
+                if model != COLLECTION_MODEL:
+                    yield pid, model or ''
+                elif pid not in visited:
+                    visited.add(pid)
+                    queue.append(pid)
+
+    # Gets pages of a book ordered by sequence number, then table order.
+    def get_pages(self, book_pid):
+        rows = self.query(f"SELECT pid, sequence FROM {self.table} WHERE page_of = ? ORDER BY rowid", (book_pid,))
+        return [pid for position, (pid, sequence) in
+                sorted(enumerate(rows), key=lambda row: (page_sequence(row[1][1]), row[0]))]
+
+    def close(self):
+        self.conn.close()
+
+
+def page_sequence(sequence):
+    return int(sequence) if sequence and sequence.strip().isdigit() else 0
@@ -0,0 +1,126 @@
+import csv
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from itertools import islice
+from pathlib import Path
+
+import FoxmlWorker as FW
+import PathResolver as PR
+
+HEADERS = ['pid', 'content_model', 'collection_pid', 'page_of', 'sequence', 'constituent_of']
+# Rows are buffered and written to a shard this many at a time.
+WRITE_BATCH = 1000
+
+
+# Harvests state and RELS-EXT relationships from the objectStore into institution table rows.
+# PIDs are read from any iterable in shards of shard_size objects; worker processes read each FOXML only as far as
+# its RELS-EXT and write the active objects of their shard to a CSV. Only twice as many shards as workers are in
+# flight, so a PID cursor is never read far ahead. Shards are kept in PID order, so merging them gives the same
+# CSV a serial harvest would, and they can be loaded straight into an institution table.
+class RelsExtHarvester:
+    def __init__(self, object_store, rels_map, workers=None, shard_size=5000, resolver=None):
+        self.object_store = object_store
+        self.rels_map = rels_map
+        self.workers = workers or os.cpu_count()
+        self.shard_size = shard_size
+        self.resolver = resolver or PR.resolver
+        self.counts = {'objects': 0, 'rows': 0, 'inactive': 0, 'failed': 0}
+
+    # Harvests pids into CSV shards in shard_dir, printing throughput as shards finish.
+    # Returns the shard paths in PID order.
+    def harvest(self, pids, shard_dir):
+        start = time.time()
+        pids = iter(pids)
+        shards = []
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            running = set()
+            while True:
+                batch = list(islice(pids, self.shard_size))
+                if not batch:
+                    break
+                paths = self.resolver.resolve_many(batch)
+                shard = f"{shard_dir}/shard_{len(shards):05d}.csv"
+                shards.append(shard)
+                running.add(executor.submit(harvest_shard, self.object_store, self.rels_map, shard,
+                                            [(pid, paths[pid]) for pid in batch]))
+                if len(running) >= self.workers * 2:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    self.collect(done, start)
+            self.collect(as_completed(running), start)
+        elapsed = time.time() - start
+        print(f"Harvested {self.counts['rows']} active objects ({self.counts['inactive']} inactive, "
+              f"{self.counts['failed']} unreadable) from {self.counts['objects']} FOXML files in "
+              f"{round(elapsed, 2)} seconds with {self.workers} workers")
+        return shards
+
+    def collect(self, futures, start):
+        for future in futures:
+            shard, counts = future.result()
+            for key, value in counts.items():
+                self.counts[key] += value
+            elapsed = time.time() - start
+            print(f"Harvested {self.counts['objects']} objects "
+                  f"({int(self.counts['objects'] / elapsed) if elapsed else self.counts['objects']} objects/sec)")
+
+    # Writes the shards into one CSV with a single header.
+    def merge(self, shards, output_file):
+        with open(output_file, 'w', newline='') as out:
+            csv.writer(out).writerow(HEADERS)
+            for shard in shards:
+                with open(shard, newline='') as f:
+                    f.readline()
+                    shutil.copyfileobj(f, out)
+
+    # Yields shard rows in the column order of the institution table.
+    def rows(self, shards):
+        for shard in shards:
+            with open(shard, newline='') as f:
+                reader = csv.reader(f)
+                next(reader)
+                for pid, content_model, collection_pid, page_of, sequence, constituent_of in reader:
+                    yield pid, content_model, collection_pid, page_of or ' ', sequence, constituent_of or ' '
+
+    # Harvests pids into output_file, and/or straight into an institution table through load(institution, rows).
+    def run(self, pids, output_file=None, institution=None, load=None):
+        parent = Path(output_file).resolve().parent if output_file else None
+        with tempfile.TemporaryDirectory(prefix='rels_ext_', dir=parent) as shard_dir:
+            shards = self.harvest(pids, shard_dir)
+            if output_file:
+                self.merge(shards, output_file)
+            if institution:
+                load(institution, self.rows(shards))
+        return self.counts
+
+
+# Harvests one shard of (pid, FOXML path) entries into a CSV of active objects.
+def harvest_shard(object_store, rels_map, shard, entries):
+    counts = {'objects': len(entries), 'rows': 0, 'inactive': 0, 'failed': 0}
+    rows = []
+    with open(shard, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADERS)
+        for pid, path in entries:
+            try:
+                properties, relations = FW.read_relationships(f"{object_store}/{path}")
+            except Exception as e:
+                print(f"Could not read {pid}: {e}")
+                counts['failed'] += 1
+                continue
+            if properties.get('state') != 'Active':
+                counts['inactive'] += 1
+                continue
+            row = {'pid': pid}
+            for relation, value in relations.items():
+                if relation in rels_map:
+                    row[rels_map[relation]] = value
+            rows.append([row.get(header, '') for header in HEADERS])
+            if len(rows) >= WRITE_BATCH:
+                writer.writerows(rows)
+                counts['rows'] += len(rows)
+                rows.clear()
+        writer.writerows(rows)
+        counts['rows'] += len(rows)
+    return shard, counts
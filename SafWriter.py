@@ -0,0 +1,281 @@
+import errno
+import hashlib
+import os
+import shutil
+import sys
+import zipfile
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+CHUNK_SIZE = 1024 * 1024
+# Linux FICLONE ioctl request number (_IOW(0x94, 9, int)).
+FICLONE = 0x40049409
+MATERIALIZE_STRATEGIES = ('copy', 'copy_file_range', 'reflink', 'hardlink')
+# hashlib algorithms of the FOXML contentDigest types.
+DIGEST_ALGORITHMS = {'MD5': 'md5', 'SHA-1': 'sha1', 'SHA-256': 'sha256', 'SHA-384': 'sha384', 'SHA-512': 'sha512'}
+# Checksum recorded for datastreams whose FOXML digest is missing or DISABLED.
+DEFAULT_DIGEST = 'MD5'
+# Date of generated zip entries (metadata, directories, nested book zips), fixed so that serial, pooled and
+# resumed runs write byte-identical archives. Datastream entries keep their source file's mtime.
+ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+
+
+# Raised when the bytes written for a datastream do not match its FOXML contentDigest.
+class FixityError(ValueError):
+    pass
+
+
+# Checksum of a datastream, taken as its bytes are written.
+# fixity is the FOXML (digest type, digest); the written bytes must match it unless the type has no hashlib
+# algorithm (DISABLED), in which case an MD5 is only recorded.
+class Checksum:
+    def __init__(self, fixity):
+        digest_type, expected = fixity
+        if digest_type not in DIGEST_ALGORITHMS:
+            digest_type, expected = DEFAULT_DIGEST, None
+        self.digest_type = digest_type
+        self.expected = expected.lower() if expected else None
+        self.hash = hashlib.new(DIGEST_ALGORITHMS[digest_type])
+
+    # Copies src to dst in chunks, hashing every chunk on the way.
+    def copy(self, src, dst):
+        while True:
+            chunk = src.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            self.hash.update(chunk)
+            dst.write(chunk)
+
+    def read(self, path):
+        with open(path, 'rb') as src:
+            while True:
+                chunk = src.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.hash.update(chunk)
+
+    # Returns (digest type, checksum), raising FixityError if it differs from the FOXML digest.
+    def verify(self, source):
+        checksum = self.hash.hexdigest()
+        if self.expected and checksum != self.expected:
+            raise FixityError(f"{self.digest_type} mismatch for {source}: expected {self.expected}, read {checksum}")
+        return self.digest_type, checksum
+
+
+# Writes SAF package entries straight into a zip archive, one entry at a time.
+# The target may be a path or any writable file object, including an entry of another archive. A path is written
+# as <path>.partial and renamed into place on close; after a FixityError the archive is marked failed and the
+# .partial file is left behind instead, so no finished archive ever holds an unverified entry.
+class SafZipWriter:
+    def __init__(self, target, compression=zipfile.ZIP_DEFLATED):
+        self.path = os.fspath(target) if isinstance(target, (str, os.PathLike)) else None
+        self.zip = zipfile.ZipFile(f"{self.path}.partial" if self.path else target, 'w', compression=compression,
+                                   allowZip64=True)
+        self.failed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write_directory(self, arcname):
+        self.zip.writestr(zipfile.ZipInfo(f"{arcname.rstrip('/')}/", ZIP_DATE), '')
+
+    def write_text(self, arcname, text):
+        info = zipfile.ZipInfo(arcname, ZIP_DATE)
+        info.compress_type = self.zip.compression
+        self.zip.writestr(info, text)
+
+    # Streams a file into the archive, reading the source once and hashing it on the way when fixity is given.
+    # Returns (size, (digest type, checksum) or None). Entries cannot be taken out of a zip, so a mismatch fails
+    # the whole archive.
+    def write_file(self, arcname, source, fixity=None):
+        info = zipfile.ZipInfo.from_file(source, arcname)
+        info.compress_type = self.zip.compression
+        checksum = Checksum(fixity) if fixity else None
+        with open(source, 'rb') as src, self.zip.open(info, 'w', force_zip64=info.file_size > zipfile.ZIP64_LIMIT) as dst:
+            if checksum:
+                checksum.copy(src, dst)
+            else:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        try:
+            return info.file_size, checksum.verify(source) if checksum else None
+        except FixityError:
+            self.failed = True
+            raise
+
+    # Writes a zip archive directly into an entry of this one.
+    # The nested archive is stored rather than deflated, since its members are already compressed.
+    @contextmanager
+    def nested(self, arcname):
+        info = zipfile.ZipInfo(arcname, ZIP_DATE)
+        try:
+            with self.zip.open(info, 'w', force_zip64=True) as entry:
+                with SafZipWriter(entry) as inner:
+                    yield inner
+        except FixityError:
+            self.failed = True
+            raise
+
+    def close(self):
+        self.zip.close()
+        if self.path and not self.failed:
+            os.replace(f"{self.path}.partial", self.path)
+
+
+# Writes SAF package entries into an unzipped directory tree.
+# Datastreams are materialized with the configured strategy (see materialize). Files that fail their fixity
+# check are removed, so a directory package is never failed as a whole.
+class SafDirectoryWriter:
+    def __init__(self, root, strategy='copy', verify_links=False):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.strategy = strategy
+        self.verify_links = verify_links
+        self.methods = Counter()
+        self.failed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def path(self, arcname):
+        path = self.root / arcname
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def write_directory(self, arcname):
+        (self.root / arcname).mkdir(parents=True, exist_ok=True)
+
+    def write_text(self, arcname, text):
+        self.path(arcname).write_text(text)
+
+    # Places a file in the tree. Returns (size, (digest type, checksum) or None), like SafZipWriter.write_file.
+    # With fixity, plain copies are hashed as they are written. The other strategies never pass the bytes through
+    # this process, so checking them costs a full read of the source; they are checked only with verify_links
+    # and are otherwise placed unchecked and left out of the fixity manifest. A file that fails is removed.
+    def write_file(self, arcname, source, fixity=None):
+        destination = self.path(arcname)
+        if not fixity or (self.strategy != 'copy' and not self.verify_links):
+            self.methods[materialize(source, destination, self.strategy)] += 1
+            return destination.stat().st_size, None
+        checksum = Checksum(fixity)
+        if self.strategy == 'copy':
+            if os.path.lexists(destination):
+                os.remove(destination)
+            with open(source, 'rb') as src, open(destination, 'wb') as dst:
+                checksum.copy(src, dst)
+            self.methods['copy'] += 1
+        else:
+            self.methods[materialize(source, destination, self.strategy)] += 1
+            checksum.read(source)
+        try:
+            return destination.stat().st_size, checksum.verify(source)
+        except FixityError:
+            os.remove(destination)
+            raise
+
+    # Streams a zip archive into a file in the tree, removing it if one of its files fails its fixity check.
+    @contextmanager
+    def nested(self, arcname):
+        path = self.path(arcname)
+        try:
+            with open(path, 'wb') as target:
+                with SafZipWriter(target) as inner:
+                    yield inner
+        except FixityError:
+            os.remove(path)
+            raise
+
+    def close(self):
+        pass
+
+
+# Writes (path, digest type, checksum, size) entries as "digest type, checksum, size, path" lines.
+def write_fixity_manifest(manifest_path, entries, mode='w'):
+    with open(manifest_path, mode) as f:
+        f.writelines(f"{digest_type}\t{checksum}\t{size}\t{path}\n" for path, digest_type, checksum, size in entries)
+
+
+def open_writer(output, path, strategy='copy', verify_links=False):
+    if output == 'directory':
+        return SafDirectoryWriter(path, strategy, verify_links)
+    return SafZipWriter(f"{path}.zip")
+
+
+# Places a datastream at destination and returns the method actually used.
+# Strategies fall back in order hardlink -> reflink -> copy_file_range/sendfile -> copy, so an unsupported
+# filesystem or a cross-device export still succeeds. Hardlinked files share the datastreamStore inode and
+# must not be modified in place.
+def materialize(source, destination, strategy='copy'):
+    if strategy not in MATERIALIZE_STRATEGIES:
+        raise ValueError(f"Unknown materialize strategy {strategy}")
+    if os.path.lexists(destination):
+        os.remove(destination)
+    if strategy == 'hardlink' and hardlink_file(source, destination):
+        return 'hardlink'
+    if strategy in ('hardlink', 'reflink') and reflink_file(source, destination):
+        return 'reflink'
+    if strategy != 'copy':
+        method = kernel_copy_file(source, destination)
+        if method:
+            return method
+    shutil.copyfile(source, destination)
+    return 'copy'
+
+
+def hardlink_file(source, destination):
+    try:
+        os.link(source, destination)
+        return True
+    except OSError:
+        return False
+
+
+# Clones the source extents (btrfs, XFS, bcachefs ...) so no data is copied.
+def reflink_file(source, destination):
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError:
+            pass
+    os.remove(destination)
+    return False
+
+
+# Copies inside the kernel with copy_file_range, or sendfile where that is unavailable.
+# Returns the method used, or None if neither could be used.
+def kernel_copy_file(source, destination):
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        size = os.fstat(src.fileno()).st_size
+        for method in ('copy_file_range', 'sendfile'):
+            if not hasattr(os, method):
+                continue
+            try:
+                copied = 0
+                while copied < size:
+                    if method == 'copy_file_range':
+                        sent = os.copy_file_range(src.fileno(), dst.fileno(), size - copied, copied, copied)
+                    else:
+                        sent = os.sendfile(dst.fileno(), src.fileno(), copied, size - copied)
+                    if sent == 0:
+                        break
+                    copied += sent
+                if copied == size:
+                    return method
+            except OSError as e:
+                if e.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF,
+                                   errno.ENOTSUP):
+                    raise
+            dst.seek(0)
+            dst.truncate()
+    os.remove(destination)
+    return None
@@ -0,0 +1,70 @@
+from urllib.parse import unquote
+
+import PathResolver as PR
+
+PREFIX_LENGTH = len(PR.ENCODED_PREFIX)
+SEPARATOR = '%2F'
+
+
+# Listings of the objectStore or datastreamStore hold one store file per line, as written by find or ls, e.g.
+#   ab/info%3Afedora%2Fnscc%3A123                   (FOXML of nscc:123)
+#   cd/info%3Afedora%2Fnscc%3A123%2FMODS%2FMODS.2   (version 2 of its MODS datastream)
+# Each line is split once on the encoded file name, so filters are set lookups in a single streaming pass.
+
+# Splits the file name on a listing line into its still-encoded (pid, dsid, version) parts.
+# dsid and version are '' for FOXML lines; returns None for lines that are not Fedora store files.
+def split_line(line):
+    start = line.find(PR.ENCODED_PREFIX)
+    if start < 0:
+        return None
+    parts = line[start + PREFIX_LENGTH:].rstrip('\r\n').split(SEPARATOR, 2)
+    parts += [''] * (3 - len(parts))
+    return parts
+
+
+# Gets the number of a datastream version ID such as 'MODS.12', or -1 when it has none.
+# Version numbers are digits after the last '.', which store file names never encode.
+def version_number(version):
+    number = version.rpartition('.')[2]
+    return int(number) if number.isdigit() else -1
+
+
+# Parses a listing line into (pid, dsid, version number), decoded; dsid is None and version -1 for FOXML lines.
+def parse_line(line):
+    parts = split_line(line)
+    if parts is None:
+        return None
+    pid, dsid, version = parts
+    return unquote(pid), unquote(dsid) or None, version_number(version)
+
+
+# Writes the lines of a listing that belong to any of pids to output, returning how many were written.
+def filter_listing(listing, pids, output):
+    wanted = {PR.encode(pid) for pid in pids}
+    count = 0
+    with open(listing) as f, open(output, 'w') as out:
+        for line in f:
+            parts = split_line(line)
+            if parts and parts[0] in wanted:
+                out.write(line)
+                count += 1
+    return count
+
+
+# Gets the line of the highest-numbered version of a datastream for every PID in a listing, keyed by PID.
+def latest_versions(listing, dsid):
+    encoded_dsid = PR.encode(dsid)
+    marker = f"{SEPARATOR}{encoded_dsid}{SEPARATOR}"
+    latest = {}
+    with open(listing) as f:
+        for line in f:
+            if marker not in line:
+                continue
+            parts = split_line(line)
+            if not parts or parts[1] != encoded_dsid:
+                continue
+            number = version_number(parts[2])
+            current = latest.get(parts[0])
+            if current is None or number > current[0]:
+                latest[parts[0]] = (number, line)
+    return {unquote(pid): line for pid, (number, line) in latest.items()}
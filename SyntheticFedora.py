@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import hashlib
+import os
+import random
+import re
+from pathlib import Path
+from xml.sax.saxutils import escape, quoteattr
+
+import CairnUtilities as CA
+
+COLLECTION_MODEL = 'islandora:collectionCModel'
+BOOK_MODEL = 'islandora:bookCModel'
+PAGE_MODEL = 'islandora:pageCModel'
+# Item models with the managed datastreams each one carries; the exporter's stream_map picks from these.
+ITEM_MODELS = {
+    'islandora:sp_basic_image': [('OBJ', 'image/jpeg'), ('TN', 'image/jpeg')],
+    'islandora:sp_large_image_cmodel': [('OBJ', 'image/tiff'), ('JP2', 'image/jp2'), ('TN', 'image/jpeg')],
+    'islandora:sp_pdf': [('OBJ', 'application/pdf'), ('PDF', 'application/pdf'), ('FULL_TEXT', 'text/plain')],
+    'ir:thesisCModel': [('OBJ', 'application/pdf'), ('PDF', 'application/pdf'), ('FULL_TEXT', 'text/plain')],
+}
+PAGE_STREAMS = [('OBJ', 'image/tiff'), ('OCR', 'text/plain'), ('HOCR', 'text/html'), ('TN', 'image/jpeg')]
+CREATED = '2017-05-25T13:36:34.177Z'
+MODIFIED = '2017-08-17T15:45:06.877Z'
+
+
+# Builds a Fedora 3 objectStore and datastreamStore for offline testing and benchmarking.
+# Files are laid out with CairnUtilities.dereference, FOXML follows inputs/sample_foxml.xml (audit trail, inline
+# RELS-EXT and DC, managed datastreams with MD5 content digests) and managed MODS follows assets/MODS/nscc_3150.xml.
+# The tree is a root collection with nested sub-collections of items and books of pages; the same seed always
+# produces the same tree.
+class SyntheticFedora:
+    def __init__(self, root, namespace='bench', seed=0, file_size=64 * 1024, audit_records=20, hash_pattern='##'):
+        self.root = Path(root)
+        self.objectStore = self.root / 'objectStore'
+        self.datastreamStore = self.root / 'datastreamStore'
+        self.namespace = namespace
+        self.random = random.Random(seed)
+        self.file_size = file_size
+        self.audit_records = audit_records
+        self.ca = CA.CairnUtilities()
+        self.ca.use_hash_pattern(hash_pattern)
+        self.mods_template = Path(__file__).with_name('assets').joinpath('MODS', 'nscc_3150.xml').read_text()
+        self.rows = []
+        self.counts = {'objects': 0, 'datastreams': 0, 'bytes': 0}
+        self.next_id = 0
+
+    def pid(self):
+        self.next_id += 1
+        return f"{self.namespace}:{self.next_id}"
+
+    # Builds the tree and writes the relationship CSV read by CairnUtilities.process_clean_institution.
+    # Returns the root collection PID.
+    def build(self, collections=4, depth=2, items=50, books=2, pages=10):
+        root_pid = f"{self.namespace}:root"
+        self.add_object(root_pid, COLLECTION_MODEL, 'islandora:root', label='Synthetic root collection')
+        parents = [root_pid]
+        for level in range(depth):
+            children = []
+            for parent in parents:
+                for _ in range(collections if level == 0 else max(1, collections // 2)):
+                    pid = self.pid()
+                    self.add_object(pid, COLLECTION_MODEL, parent, label=f"Collection {pid}")
+                    children.append(pid)
+            parents = children
+        for collection in parents:
+            for _ in range(items):
+                pid = self.pid()
+                model = self.random.choice(list(ITEM_MODELS))
+                self.add_object(pid, model, collection, ITEM_MODELS[model], mods=True)
+            for _ in range(books):
+                book = self.pid()
+                self.add_object(book, BOOK_MODEL, collection, [('TN', 'image/jpeg')], mods=True)
+                for sequence in range(1, pages + 1):
+                    self.add_object(self.pid(), PAGE_MODEL, book_pid=book, streams=PAGE_STREAMS, sequence=sequence)
+        self.write_csv()
+        return root_pid
+
+    def write_csv(self):
+        with open(self.root / f"{self.namespace}.csv", 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['pid', 'content_model', 'collection_pid', 'page_of', 'sequence', 'constituent_of'])
+            writer.writerows(self.rows)
+
+    # Writes an object's datastreams and FOXML and records its relationship row.
+    def add_object(self, pid, model, collection='', streams=(), mods=False, book_pid='', sequence=None, label=None):
+        label = label or f"{pid} {model.split(':')[1]}"
+        datastreams = []
+        for dsid, mimetype in streams:
+            size = self.stream_size(mimetype)
+            datastreams.append(self.add_datastream(pid, dsid, mimetype, self.random.randbytes(size)))
+        if mods:
+            datastreams.append(self.add_datastream(pid, 'MODS', 'application/xml', self.mods(pid, label).encode('utf-8')))
+        relations = []
+        if collection:
+            relations.append(f'<fedora:isMemberOfCollection rdf:resource="info:fedora/{collection}"/>')
+        if book_pid:
+            relations.append(f'<islandora:isPageOf rdf:resource="info:fedora/{book_pid}"/>')
+            relations.append(f'<islandora:isSequenceNumber>{sequence}</islandora:isSequenceNumber>')
+            relations.append(f'<islandora:isPageNumber>{sequence}</islandora:isPageNumber>')
+            relations.append(f'<fedora:isMemberOf rdf:resource="info:fedora/{book_pid}"/>')
+        relations.append(f'<fedora-model:hasModel rdf:resource="info:fedora/{model}"/>')
+        self.write(self.objectStore, pid, self.foxml(pid, label, relations, datastreams, inline_mods=not mods))
+        self.rows.append((pid, model, collection, book_pid, sequence or '', ''))
+        self.counts['objects'] += 1
+
+    # Sizes vary around the configured size; text derivatives are small.
+    def stream_size(self, mimetype):
+        if mimetype.startswith('text/') or self.file_size == 0:
+            return self.random.randint(50, 2000)
+        return max(1, int(self.file_size * self.random.uniform(0.5, 1.5)))
+
+    # Writes a managed datastream. Some get an earlier version so the FOXML carries more than one.
+    def add_datastream(self, pid, dsid, mimetype, data):
+        versions = 2 if self.random.random() < 0.2 else 1
+        for version in range(versions):
+            location = f"{pid}+{dsid}+{dsid}.{version}"
+            self.write(self.datastreamStore, location, data)
+            self.counts['datastreams'] += 1
+            self.counts['bytes'] += len(data)
+        return dsid, mimetype, len(data), hashlib.md5(data).hexdigest(), versions
+
+    def write(self, store, identifier, data):
+        path = store / self.ca.dereference(identifier)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        path.write_bytes(data)
+
+    def mods(self, pid, label):
+        mods = self.mods_template.replace('WKM-M-037', pid)
+        return re.sub(r'<title>[^<]*</title>', lambda match: f"<title>{escape(label)}</title>", mods, count=1)
+
+    def foxml(self, pid, label, relations, datastreams, inline_mods):
+        parts = [f"""<?xml version="1.0" encoding="UTF-8"?>
+<foxml:digitalObject VERSION="1.1" PID={quoteattr(pid)}
+                     xmlns:foxml="info:fedora/fedora-system:def/foxml#"
+                     xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+                     xsi:schemaLocation="info:fedora/fedora-system:def/foxml# http://www.fedora.info/definitions/1/0/foxml1-1.xsd">
+    <foxml:objectProperties>
+        <foxml:property NAME="info:fedora/fedora-system:def/model#state" VALUE="Active"/>
+        <foxml:property NAME="info:fedora/fedora-system:def/model#label" VALUE={quoteattr(label)}/>
+        <foxml:property NAME="info:fedora/fedora-system:def/model#ownerId" VALUE="fedoraAdmin"/>
+        <foxml:property NAME="info:fedora/fedora-system:def/model#createdDate" VALUE="{CREATED}"/>
+        <foxml:property NAME="info:fedora/fedora-system:def/view#lastModifiedDate" VALUE="{MODIFIED}"/>
+    </foxml:objectProperties>
+    <foxml:datastream ID="AUDIT" STATE="A" CONTROL_GROUP="X" VERSIONABLE="false">
+        <foxml:datastreamVersion ID="AUDIT.0" LABEL="Audit Trail for this object" CREATED="{CREATED}"
+                                 MIMETYPE="text/xml" FORMAT_URI="info:fedora/fedora-system:format/xml.fedora.audit">
+            <foxml:xmlContent>
+                <audit:auditTrail xmlns:audit="info:fedora/fedora-system:def/audit#">
+"""]
+        for record in range(1, self.audit_records + 1):
+            dsid = datastreams[record % len(datastreams)][0] if datastreams else ''
+            parts.append(f"""                    <audit:record ID="AUDREC{record}">
+                        <audit:process type="Fedora API-M"/>
+                        <audit:action>modifyDatastreamByReference</audit:action>
+                        <audit:componentID>{dsid}</audit:componentID>
+                        <audit:responsibility>fedoraAdmin</audit:responsibility>
+                        <audit:date>{MODIFIED}</audit:date>
+                        <audit:justification></audit:justification>
+                    </audit:record>
+""")
+        parts.append(f"""                </audit:auditTrail>
+            </foxml:xmlContent>
+        </foxml:datastreamVersion>
+    </foxml:datastream>
+    <foxml:datastream ID="RELS-EXT" STATE="A" CONTROL_GROUP="X" VERSIONABLE="true">
+        <foxml:datastreamVersion ID="RELS-EXT.0" LABEL="Fedora Object to Object Relationship Metadata."
+                                 CREATED="{CREATED}" MIMETYPE="application/rdf+xml"
+                                 FORMAT_URI="info:fedora/fedora-system:FedoraRELSExt-1.0">
+            <foxml:xmlContent>
+                <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+                         xmlns:fedora="info:fedora/fedora-system:def/relations-external#"
+                         xmlns:fedora-model="info:fedora/fedora-system:def/model#"
+                         xmlns:islandora="http://islandora.ca/ontology/relsext#">
+                    <rdf:Description rdf:about="info:fedora/{pid}">
+                        {''.join(relations)}
+                    </rdf:Description>
+                </rdf:RDF>
+            </foxml:xmlContent>
+        </foxml:datastreamVersion>
+    </foxml:datastream>
+""")
+        if inline_mods:
+            parts.append(f"""    <foxml:datastream ID="MODS" STATE="A" CONTROL_GROUP="X" VERSIONABLE="true">
+        <foxml:datastreamVersion ID="MODS.0" LABEL="MODS Record" CREATED="{CREATED}" MIMETYPE="application/xml">
+            <foxml:xmlContent>
+                <mods:mods xmlns:mods="http://www.loc.gov/mods/v3" xmlns="http://www.loc.gov/mods/v3">
+                    <mods:titleInfo>
+                        <mods:title>{escape(label)}</mods:title>
+                    </mods:titleInfo>
+                </mods:mods>
+            </foxml:xmlContent>
+        </foxml:datastreamVersion>
+    </foxml:datastream>
+""")
+        parts.append(f"""    <foxml:datastream ID="DC" STATE="A" CONTROL_GROUP="X" VERSIONABLE="true">
+        <foxml:datastreamVersion ID="DC.0" LABEL="DC Record" CREATED="{CREATED}" MIMETYPE="application/xml">
+            <foxml:xmlContent>
+                <oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/"
+                           xmlns:dc="http://purl.org/dc/elements/1.1/">
+                    <dc:title>{escape(label)}</dc:title>
+                    <dc:identifier>{escape(pid)}</dc:identifier>
+                </oai_dc:dc>
+            </foxml:xmlContent>
+        </foxml:datastreamVersion>
+    </foxml:datastream>
+""")
+        for dsid, mimetype, size, digest, versions in datastreams:
+            parts.append(f'    <foxml:datastream ID="{dsid}" STATE="A" CONTROL_GROUP="M" VERSIONABLE="true">\n')
+            for version in range(versions):
+                parts.append(f"""        <foxml:datastreamVersion ID="{dsid}.{version}" LABEL="{dsid}" CREATED="{CREATED}" MIMETYPE="{mimetype}"
+                                 SIZE="{size}">
+            <foxml:contentDigest TYPE="MD5" DIGEST="{digest}"/>
+            <foxml:contentLocation TYPE="INTERNAL_ID" REF="{pid}+{dsid}+{dsid}.{version}"/>
+        </foxml:datastreamVersion>
+""")
+            parts.append('    </foxml:datastream>\n')
+        parts.append('</foxml:digitalObject>\n')
+        return ''.join(parts)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a synthetic Fedora objectStore and datastreamStore.')
+    parser.add_argument('root')
+    parser.add_argument('--namespace', default='bench')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--collections', type=int, default=4, help='Sub-collections under the root collection')
+    parser.add_argument('--depth', type=int, default=2, help='Levels of nested sub-collections')
+    parser.add_argument('--items', type=int, default=50, help='Items per leaf collection')
+    parser.add_argument('--books', type=int, default=2, help='Books per leaf collection')
+    parser.add_argument('--pages', type=int, default=10, help='Pages per book')
+    parser.add_argument('--file-size', type=int, default=64 * 1024, help='Typical managed datastream size in bytes')
+    parser.add_argument('--audit-records', type=int, default=20)
+    parser.add_argument('--hash-pattern', default='##')
+    args = parser.parse_args()
+    root = os.path.abspath(args.root)
+    os.makedirs(root, exist_ok=True)
+    # CairnUtilities keeps its database in the working directory, so it goes alongside the stores.
+    os.chdir(root)
+    SF = SyntheticFedora(root, args.namespace, args.seed, args.file_size, args.audit_records, args.hash_pattern)
+    root_pid = SF.build(args.collections, args.depth, args.items, args.books, args.pages)
+    print(f"Built {SF.counts['objects']} objects under {root_pid} with {SF.counts['datastreams']} datastream files "
+          f"({SF.counts['bytes'] / 1024 ** 2:.1f} MB) in {root}")
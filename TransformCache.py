@@ -0,0 +1,99 @@
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+# How many cache hits are remembered before their last-used times are written back.
+TOUCH_BATCH = 500
+
+
+# On-disk cache of MODS -> DSpace metadata transform results.
+# Entries are keyed by (hash of the MODS bytes, fingerprint of the stylesheet and its imports, PID) and hold the
+# generated dublin_core/thesis/oaire files, compressed. The total size is capped: when a write takes the cache
+# over its limit, the least recently used entries are evicted down to 90% of it.
+# The database runs in WAL mode, so pool workers and threads can share one cache file.
+class TransformCache:
+    def __init__(self, database='transform_cache.db', max_bytes=256 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(database, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE if not exists transform_cache(
+            mods_hash TEXT,
+            xsl_hash TEXT,
+            pid TEXT,
+            result BLOB,
+            size INTEGER,
+            last_used REAL,
+            PRIMARY KEY (mods_hash, xsl_hash, pid)
+            )""")
+        self.conn.execute("CREATE INDEX if not exists transform_cache_last_used ON transform_cache(last_used)")
+        self.conn.commit()
+        self.total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM transform_cache").fetchone()[0]
+        self.touched = []
+        self.hits = 0
+        self.misses = 0
+
+    # Gets cached transform output, or None.
+    def get(self, mods_hash, xsl_hash, pid):
+        with self.lock:
+            row = self.conn.execute("SELECT result FROM transform_cache WHERE mods_hash = ? AND xsl_hash = ? "
+                                    "AND pid = ?", (mods_hash, xsl_hash, pid)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.touched.append((time.time(), mods_hash, xsl_hash, pid))
+            if len(self.touched) >= TOUCH_BATCH:
+                self.write_touched()
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, mods_hash, xsl_hash, pid, result):
+        data = zlib.compress(json.dumps(result).encode('utf-8'))
+        with self.lock:
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO transform_cache VALUES(?, ?, ?, ?, ?, ?)",
+                                  (mods_hash, xsl_hash, pid, data, len(data), time.time()))
+            self.total += len(data)
+            if self.total > self.max_bytes:
+                self.evict()
+
+    # Removes least recently used entries until the cache is at 90% of its cap.
+    def evict(self):
+        self.write_touched()
+        self.total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM transform_cache").fetchone()[0]
+        excess = self.total - int(self.max_bytes * 0.9)
+        if excess <= 0:
+            return
+        victims = []
+        for rowid, size in self.conn.execute("SELECT rowid, size FROM transform_cache ORDER BY last_used"):
+            victims.append((rowid,))
+            excess -= size
+            self.total -= size
+            if excess <= 0:
+                break
+        with self.conn:
+            self.conn.executemany("DELETE FROM transform_cache WHERE rowid = ?", victims)
+
+    # Writes back last-used times of recent hits.
+    def flush(self):
+        with self.lock:
+            self.write_touched()
+
+    def write_touched(self):
+        if self.touched:
+            with self.conn:
+                self.conn.executemany("UPDATE transform_cache SET last_used = ? WHERE mods_hash = ? AND "
+                                      "xsl_hash = ? AND pid = ?", self.touched)
+            self.touched = []
+
+    def close(self):
+        with self.lock:
+            self.write_touched()
+            self.conn.close()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'bytes': self.total}
@@ -0,0 +1,97 @@
+import hashlib
+import os
+import threading
+
+import lxml.etree as ET
+
+XSL_IMPORT = '{http://www.w3.org/1999/XSL/Transform}import'
+XSL_INCLUDE = '{http://www.w3.org/1999/XSL/Transform}include'
+
+
+# Process-wide cache of compiled XSLT stylesheets.
+# Entries are keyed by absolute path and invalidated when the file's mtime or size changes,
+# so each stylesheet is parsed and compiled once per process (and once per pool worker).
+# Compiled stylesheets are not shared between threads, so each thread that applies one gets its own copy, held in
+# thread-local storage and freed with the thread.
+class XsltRegistry:
+    def __init__(self):
+        self.local = threading.local()
+        self.compiled = set()
+        self.fingerprints = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # Returns compiled transform for stylesheet, compiling it only when new or changed on disk.
+    def get(self, xsl_path):
+        path = os.path.abspath(xsl_path)
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        transforms = getattr(self.local, 'transforms', None)
+        if transforms is None:
+            transforms = self.local.transforms = {}
+        entry = transforms.get(path)
+        if entry and entry[0] == stamp:
+            with self.lock:
+                self.hits += 1
+            return entry[1]
+        transform = ET.XSLT(ET.parse(path))
+        transforms[path] = (stamp, transform)
+        with self.lock:
+            self.misses += 1
+            self.compiled.add(path)
+        return transform
+
+    # Returns a hash of a stylesheet and every stylesheet it imports or includes, recomputed when any of them
+    # changes on disk, so results of the transform can be cached across runs.
+    def fingerprint(self, xsl_path):
+        path = os.path.abspath(xsl_path)
+        entry = self.fingerprints.get(path)
+        if entry and all(self.stamp(member) == stamp for member, stamp in entry[0]):
+            return entry[1]
+        members = []
+        digest = hashlib.sha1()
+        pending = [path]
+        while pending:
+            member = pending.pop()
+            if any(member == seen for seen, stamp in members):
+                continue
+            members.append((member, self.stamp(member)))
+            with open(member, 'rb') as f:
+                data = f.read()
+            digest.update(data + b'\0')
+            for element in ET.fromstring(data).iter(XSL_IMPORT, XSL_INCLUDE):
+                pending.append(os.path.abspath(os.path.join(os.path.dirname(member), element.get('href'))))
+        fingerprint = digest.hexdigest()
+        with self.lock:
+            self.fingerprints[path] = (members, fingerprint)
+        return fingerprint
+
+    def stamp(self, path):
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    # Applies stylesheet to parsed document.
+    def apply(self, xsl_path, dom):
+        return self.get(xsl_path)(dom)
+
+    def clear(self):
+        with self.lock:
+            self.local = threading.local()
+            self.compiled.clear()
+            self.fingerprints.clear()
+            self.hits = 0
+            self.misses = 0
+
+    # Reports hit/miss counts and compiled stylesheets.
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'compiled': sorted(self.compiled)}
+
+
+registry = XsltRegistry()
+
+
+def get_transform(xsl_path):
+    return registry.get(xsl_path)
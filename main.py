@@ -2,7 +2,6 @@ import csv
 import xml.etree.cElementTree as ET
 import os
 from pathlib import Path
-import pandas as pd
 
 
 class ArchiveBuilder:
@@ -42,6 +41,7 @@ class ArchiveBuilder:
         return ET.ElementTree(root)
 
     def manipulate_mods(self):
+        import pandas as pd
         mods = pd.read_xml('inputs/sample_mods.xml')
         print(mods)
 
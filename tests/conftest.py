@@ -0,0 +1,18 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import SyntheticFedora as SF
+
+
+# Small synthetic Fedora tree: a root collection with two sub-collections of three items and a two-page book each.
+# CairnUtilities opens cairn.db in the working directory, so tests run from the tree's root.
+@pytest.fixture
+def synthetic(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    fedora = SF.SyntheticFedora(tmp_path, file_size=0, audit_records=3)
+    root = fedora.build(collections=2, depth=1, items=3, books=1, pages=2)
+    return fedora, root
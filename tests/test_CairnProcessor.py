@@ -0,0 +1,137 @@
+import os
+import sys
+import zipfile
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import CairnProcessor as CP
+import ExportJournal as EJ
+import SyntheticFedora as SF
+
+REPO = Path(__file__).resolve().parent.parent
+TABLE = 'bench'
+
+
+@pytest.fixture
+def fedora(synthetic):
+    fedora, root = synthetic
+    fedora.ca.process_clean_institution(TABLE, str(fedora.root / f"{TABLE}.csv"))
+    fedora.root_pid = root
+    return fedora
+
+
+def exporter(fedora):
+    processor = CP.CairnProcessor()
+    processor.objectStore = str(fedora.objectStore)
+    processor.datastreamStore = str(fedora.datastreamStore)
+    processor.mods_xsl = str(REPO / 'assets' / 'xsl' / 'mods_to_dc.xsl')
+    processor.export_dir = str(fedora.root / 'outputs')
+    processor.transform_cache_path = None
+    return processor
+
+
+def journal(fedora):
+    rows = fedora.ca.conn.execute("SELECT pid, item_number, status FROM export_journal WHERE collection = ?",
+                                  (fedora.root_pid,))
+    return {pid: (number, status) for pid, number, status in rows}
+
+
+def item(number):
+    return f"item_{str(number).zfill(4)}"
+
+
+# Runs a delta export and returns (failures, items in the package, deleted_items manifest).
+# The package is removed afterwards, as delta packages are named to the second.
+def delta(fedora):
+    failures = exporter(fedora).process_collection_delta(TABLE, fedora.root_pid, 'y')
+    items = set()
+    deleted = ''
+    for package in (fedora.root / 'outputs').glob('*_delta_*.zip'):
+        with zipfile.ZipFile(package) as archive:
+            names = archive.namelist()
+            items.update(name.split('/')[0] for name in names if name.startswith('item_'))
+            if 'deleted_items' in names:
+                deleted = archive.read('deleted_items').decode()
+        package.unlink()
+    return failures, items, deleted
+
+
+def foxml(fedora, pid):
+    return fedora.objectStore / fedora.ca.dereference(pid)
+
+
+def items_of(fedora):
+    return [row[0] for row in fedora.ca.conn.execute(f"SELECT pid FROM {TABLE} WHERE content_model IN "
+                                                     f"({', '.join('?' * len(SF.ITEM_MODELS))})",
+                                                     list(SF.ITEM_MODELS))]
+
+
+def test_delta_skips_unchanged_and_touched_items(fedora):
+    failures, items, deleted = delta(fedora)
+    assert failures == {}
+    assert items == {item(number) for number in range(1, 9)}
+    assert deleted == ''
+    assert {status for number, status in journal(fedora).values()} == {'done'}
+    assert delta(fedora)[1] == set()
+    touched = foxml(fedora, items_of(fedora)[0])
+    stat = touched.stat()
+    os.utime(touched, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert delta(fedora)[1] == set()
+    stamps = EJ.ExportJournal(fedora.ca.conn).stamps(fedora.root_pid)
+    assert stamps[items_of(fedora)[0]] == (SF.MODIFIED, touched.stat().st_mtime_ns)
+
+
+def test_delta_reexports_changed_items_under_their_numbers(fedora):
+    delta(fedora)
+    numbers = journal(fedora)
+    pid = items_of(fedora)[1]
+    changed = foxml(fedora, pid)
+    stat = changed.stat()
+    changed.write_text(changed.read_text().replace(SF.MODIFIED, '2024-01-01T00:00:00.000Z'))
+    os.utime(changed, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    failures, items, deleted = delta(fedora)
+    assert failures == {}
+    assert items == {item(numbers[pid][0])}
+    assert journal(fedora) == numbers
+
+
+def test_delta_lists_removed_items_and_reuses_their_numbers(fedora):
+    delta(fedora)
+    numbers = journal(fedora)
+    pid = items_of(fedora)[2]
+    row = fedora.ca.conn.execute(f"SELECT * FROM {TABLE} WHERE pid = ?", (pid,)).fetchone()
+    with fedora.ca.conn:
+        fedora.ca.conn.execute(f"DELETE FROM {TABLE} WHERE pid = ?", (pid,))
+    failures, items, deleted = delta(fedora)
+    assert items == set()
+    assert deleted == f"{item(numbers[pid][0])}\t{pid}\n"
+    assert journal(fedora)[pid] == (numbers[pid][0], 'deleted')
+    assert delta(fedora)[1] == set()
+    with fedora.ca.conn:
+        fedora.ca.conn.execute(f"INSERT INTO {TABLE} VALUES(?, ?, ?, ?, ?, ?)", tuple(row))
+    failures, items, deleted = delta(fedora)
+    assert items == {item(numbers[pid][0])}
+    assert deleted == ''
+    assert journal(fedora) == numbers
+
+
+# A crash before the last zip part closed leaves its items pending; resuming exports only those, under the same
+# numbers, into a new part.
+def test_resume_exports_only_items_of_the_unclosed_part(fedora):
+    processor = exporter(fedora)
+    assert processor.process_collection(TABLE, fedora.root_pid, 'y', checkpoint=3) == {}
+    outputs = fedora.root / 'outputs'
+    assert sorted(path.name for path in outputs.glob('*.zip')) == ['bench_root.zip', 'bench_root_part002.zip',
+                                                                   'bench_root_part003.zip']
+    numbers = journal(fedora)
+    (outputs / 'bench_root_part003.zip').unlink()
+    with fedora.ca.conn:
+        fedora.ca.conn.execute("UPDATE export_journal SET status = 'pending', archive = NULL "
+                               "WHERE archive = 'bench_root_part003.zip'")
+    assert exporter(fedora).process_collection(TABLE, fedora.root_pid, 'y', resume=True, checkpoint=3) == {}
+    with zipfile.ZipFile(outputs / 'bench_root_part003.zip') as archive:
+        assert {name.split('/')[0] for name in archive.namelist()} == {item(7), item(8)}
+    assert journal(fedora) == numbers
@@ -0,0 +1,38 @@
+import sqlite3
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import ExportJournal as EJ
+
+
+def journal():
+    return EJ.ExportJournal(sqlite3.connect(':memory:'))
+
+
+def test_assign_keeps_numbers_and_appends_new_pids():
+    exports = journal()
+    assert exports.assign('t:root', ['t:1', 't:2']) == {'t:1': 1, 't:2': 2}
+    exports.mark_deleted('t:root', ['t:1'])
+    assert exports.assign('t:root', ['t:3', 't:1']) == {'t:1': 1, 't:2': 2, 't:3': 3}
+    assert exports.assign('t:other', ['t:3']) == {'t:3': 1}
+
+
+def test_stamps_cover_done_items_and_touch_updates_mtime():
+    exports = journal()
+    exports.assign('t:root', ['t:1', 't:2', 't:3'])
+    exports.mark_done('t:root', [('t:1', 'hash1', '2017-08-17T15:45:06.877Z', 100),
+                                 ('t:2', 'hash2', '2017-08-17T15:45:06.877Z', 200)], 't_root.zip')
+    exports.touch('t:root', {'t:1': 150})
+    exports.mark_deleted('t:root', ['t:2'])
+    assert exports.stamps('t:root') == {'t:1': ('2017-08-17T15:45:06.877Z', 150)}
+
+
+def test_number_skips_completed_members_and_keeps_numbers():
+    exports = journal()
+    exports.assign('t:root', ['t:1', 't:2'])
+    exports.mark_done('t:root', [('t:1', 'hash1', None, None)], 't_root.zip')
+    members = [('t:1', 'model'), ('t:2', 'model'), ('t:3', 'model')]
+    assert list(exports.number('t:root', members)) == [('t:2', 'model', 2), ('t:3', 'model', 3)]
+    assert exports.counts == {'items': 2, 'skipped': 1}
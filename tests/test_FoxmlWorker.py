@@ -0,0 +1,92 @@
+import sys
+from pathlib import Path
+
+import lxml.etree as ET
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import FoxmlWorker as FW
+
+REPO = Path(__file__).resolve().parent.parent
+NAMESPACES = {'foxml': 'info:fedora/fedora-system:def/foxml#',
+              'oai_dc': 'http://www.openarchives.org/OAI/2.0/oai_dc/',
+              'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+              'mods': 'http://www.loc.gov/mods/v3'}
+
+
+# Values the original FWorker read from the whole parsed FOXML, with its XPath lookups.
+def baseline(foxml_file):
+    root = ET.parse(foxml_file).getroot()
+    properties = {prop.attrib['NAME'].split('#')[1]: prop.attrib['VALUE']
+                  for prop in root.findall('.//foxml:objectProperties/foxml:property', NAMESPACES)}
+    datastreams = {}
+    file_data = {}
+    for datastream in root.findall('.//foxml:datastream', NAMESPACES):
+        versions = datastream.findall('./foxml:datastreamVersion', NAMESPACES)
+        datastreams[datastream.attrib['ID']] = versions[-1].attrib['MIMETYPE']
+    for stream, mimetype in datastreams.items():
+        location = root.xpath(f'//foxml:datastream[@ID="{stream}"]/foxml:datastreamVersion/foxml:contentLocation',
+                              namespaces=NAMESPACES)
+        if location:
+            file_data[stream] = {'filename': location[-1].attrib['REF'], 'mimetype': mimetype}
+    dc = root.findall('.//foxml:datastream[@ID="DC"]/foxml:datastreamVersion/foxml:xmlContent', NAMESPACES)[-1]
+    dc_values = []
+    for child in dc.iter():
+        if child.text is not None:
+            text = ' '.join(child.text.replace('\n', '').split())
+            if text:
+                dc_values.append({child.xpath('local-name()'): text})
+    rels = {}
+    rdf = root.findall('.//foxml:datastream[@ID="RELS-EXT"]/foxml:datastreamVersion/foxml:xmlContent/rdf:RDF',
+                       NAMESPACES)[-1]
+    for child in rdf.iter():
+        tag = child.xpath('local-name()')
+        if child.text is not None:
+            text = ' '.join(child.text.replace('info:fedora/', '').replace('\n', '').split())
+            if text:
+                rels[tag] = text
+        resource = child.attrib.get('{http://www.w3.org/1999/02/22-rdf-syntax-ns#}resource')
+        if resource:
+            rels[tag] = resource.replace('info:fedora/', '')
+    mods = root.findall(".//foxml:datastream[@ID='MODS']/foxml:datastreamVersion/foxml:xmlContent/mods:mods",
+                        NAMESPACES)
+    return {'pid': root.attrib['PID'],
+            'properties': properties,
+            'datastreams': datastreams,
+            'file_data': file_data,
+            'dc': ET.tostring(dc.find('oai_dc:dc', NAMESPACES), encoding='unicode'),
+            'dc_values': dc_values,
+            'rels_ext': rels,
+            'inline_mods': ET.tostring(mods[-1], encoding='unicode') if mods else ''}
+
+
+def extracted(foxml_file):
+    fw = FW.FWorker(foxml_file)
+    return {'pid': fw.get_pid(),
+            'properties': dict(fw.get_properties()),
+            'datastreams': dict(fw.get_datastreams()),
+            'file_data': {stream: {'filename': data['filename'], 'mimetype': data['mimetype']}
+                          for stream, data in fw.get_file_data().items()},
+            'dc': fw.get_dc(),
+            'dc_values': [dict(value) for value in fw.get_dc_values()],
+            'rels_ext': dict(fw.get_rels_ext_values()),
+            'inline_mods': fw.get_inline_mods()}
+
+
+def foxml_files(fedora):
+    return [REPO / 'inputs' / 'sample_foxml.xml'] + sorted(fedora.objectStore.rglob('info*'))
+
+
+def test_streaming_extract_matches_the_full_parse(synthetic):
+    fedora, root = synthetic
+    for foxml_file in foxml_files(fedora):
+        assert extracted(foxml_file) == baseline(foxml_file), foxml_file
+
+
+def test_read_relationships_matches_the_full_parse(synthetic):
+    fedora, root = synthetic
+    for foxml_file in foxml_files(fedora):
+        properties, relationships = FW.read_relationships(foxml_file)
+        expected = baseline(foxml_file)
+        assert properties == expected['properties']
+        assert relationships == expected['rels_ext']
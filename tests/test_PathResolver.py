@@ -0,0 +1,45 @@
+import hashlib
+import sys
+import urllib.parse
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import PathResolver as PR
+
+IDENTIFIERS = ['nscc:3150', 'info:fedora/nscc:3150', 'nscc:3150+OBJ+OBJ.0', 'msvu:thesis_12+PDF+PDF.1',
+               'cbu:a b+MODS+MODS.0', 'ns:é~(x)*!', 'bench:1+DC+DC.0']
+
+
+# Path the original CairnUtilities.dereference gave an identifier, for any Fedora hash pattern.
+def baseline(identifier, pattern):
+    full = f"info:fedora/{identifier.replace('+', '/')}"
+    hash_value = hashlib.md5(full.encode('utf-8')).hexdigest()
+    result = list(pattern)
+    hash_offset = 0
+    for position, character in enumerate(result):
+        if character == '#' and hash_offset < len(hash_value):
+            result[position] = hash_value[hash_offset]
+            hash_offset += 1
+    encoded = urllib.parse.quote(full, safe='').replace('_', '%5F')
+    return f"{''.join(result)}/{encoded}"
+
+
+@pytest.mark.parametrize('pattern', ['##', '##/##', '#/##'])
+def test_resolve_matches_the_original_dereference(pattern):
+    resolver = PR.PathResolver(pattern)
+    for identifier in IDENTIFIERS:
+        assert resolver.resolve(identifier) == baseline(identifier, pattern)
+        assert resolver.resolve(identifier) == baseline(identifier, pattern)
+    assert resolver.resolve_many(IDENTIFIERS + IDENTIFIERS[:2]) == {identifier: baseline(identifier, pattern)
+                                                                   for identifier in IDENTIFIERS}
+
+
+def test_cache_evicts_least_recently_used():
+    resolver = PR.PathResolver(cache_size=2)
+    for identifier in IDENTIFIERS[:3]:
+        resolver.resolve(identifier)
+    resolver.resolve(IDENTIFIERS[0])
+    assert resolver.stats() == {'hits': 0, 'misses': 4, 'cached': 2}
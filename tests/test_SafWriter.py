@@ -0,0 +1,85 @@
+import hashlib
+import sys
+import zipfile
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import SafWriter as SW
+
+
+def test_zip_with_bad_digest_is_left_partial(tmp_path):
+    good = tmp_path / 'good.tif'
+    bad = tmp_path / 'bad.tif'
+    good.write_bytes(b'good datastream')
+    bad.write_bytes(b'corrupted datastream')
+    archive = tmp_path / 'package.zip'
+    with SW.SafZipWriter(archive) as writer:
+        size, checksum = writer.write_file('item_0001/good.tif', good,
+                                           ('MD5', hashlib.md5(b'good datastream').hexdigest()))
+        with pytest.raises(SW.FixityError):
+            writer.write_file('item_0002/bad.tif', bad, ('MD5', hashlib.md5(b'original datastream').hexdigest()))
+    assert checksum == ('MD5', hashlib.md5(b'good datastream').hexdigest())
+    assert writer.failed
+    assert not archive.exists()
+    assert (tmp_path / 'package.zip.partial').exists()
+
+
+def test_zip_is_renamed_into_place_on_clean_close(tmp_path):
+    source = tmp_path / 'source.tif'
+    source.write_bytes(b'datastream')
+    archive = tmp_path / 'package.zip'
+    with SW.SafZipWriter(archive) as writer:
+        writer.write_file('item_0001/source.tif', source, ('MD5', hashlib.md5(b'datastream').hexdigest()))
+    assert not (tmp_path / 'package.zip.partial').exists()
+    with zipfile.ZipFile(archive) as package:
+        assert package.namelist() == ['item_0001/source.tif']
+        assert package.testzip() is None
+
+
+def test_bad_page_fails_the_outer_zip(tmp_path):
+    page = tmp_path / 'page.tif'
+    page.write_bytes(b'corrupted page')
+    with SW.SafZipWriter(tmp_path / 'package.zip') as writer:
+        with pytest.raises(SW.FixityError):
+            with writer.nested('item_0001/book.zip') as book:
+                book.write_file('page.tif', page, ('MD5', hashlib.md5(b'page').hexdigest()))
+    assert writer.failed
+    assert not (tmp_path / 'package.zip').exists()
+
+
+def test_hardlinks_are_checked_only_with_verify_links(tmp_path):
+    source = tmp_path / 'source.tif'
+    source.write_bytes(b'corrupted datastream')
+    fixity = ('MD5', hashlib.md5(b'original datastream').hexdigest())
+    writer = SW.SafDirectoryWriter(tmp_path / 'package', 'hardlink')
+    assert writer.write_file('item_0001/source.tif', source, fixity) == (len(b'corrupted datastream'), None)
+    writer = SW.SafDirectoryWriter(tmp_path / 'checked', 'hardlink', verify_links=True)
+    with pytest.raises(SW.FixityError):
+        writer.write_file('item_0001/source.tif', source, fixity)
+    assert not (tmp_path / 'checked' / 'item_0001' / 'source.tif').exists()
+
+
+def test_zip_entry_without_digest_records_md5(tmp_path):
+    source = tmp_path / 'source.pdf'
+    source.write_bytes(b'pdf bytes')
+    with SW.SafZipWriter(tmp_path / 'package.zip') as writer:
+        size, checksum = writer.write_file('item_0001/source.pdf', source, ('DISABLED', 'none'))
+    assert size == len(b'pdf bytes')
+    assert checksum == ('MD5', hashlib.md5(b'pdf bytes').hexdigest())
+
+
+def test_generated_entries_have_a_fixed_date(tmp_path):
+    page = tmp_path / 'page.tif'
+    page.write_bytes(b'page')
+    with SW.SafZipWriter(tmp_path / 'package.zip') as writer:
+        writer.write_directory('item_0001')
+        writer.write_text('item_0001/contents', 'page.tif\n')
+        with writer.nested('item_0001/book.zip') as book:
+            book.write_text('contents', 'page.tif\n')
+    with zipfile.ZipFile(tmp_path / 'package.zip') as package:
+        assert {info.date_time for info in package.infolist()} == {SW.ZIP_DATE}
+        with zipfile.ZipFile(package.open('item_0001/book.zip')) as book:
+            assert book.getinfo('contents').date_time == SW.ZIP_DATE